@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+import itertools
+
+import numpy as np
+
+desc = """ Benchmarks for the SelfExplain data and model pipelines """
+
+
+def read_memory(pid) -> dict:
+    """ Rss, Pss and Private_Dirty (kB) of a process (Linux only)
+    """
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup") as handle:
+        for line in handle:
+            fields = line.split()
+            if fields[0] in ("Rss:", "Pss:", "Private_Dirty:"):
+                memory[fields[0][:-1]] = int(fields[1])
+    return memory
+
+
+def child_pids() -> list:
+    pids = []
+    for filename in glob.glob("/proc/self/task/*/children"):
+        with open(filename) as handle:
+            pids.extend(int(pid) for pid in handle.read().split())
+    return pids
+
+
+def benchmark_dataloader(args):
+    """ Iterate a split with DataLoader workers and report the memory growth of each worker.
+    Workers that copy the dataset pages (copy-on-write after refcount updates) grow towards the size
+    of the dataset, with flat arrays the growth should stay small and flat.
+    """
+    from self_explain.model import dataset_cache
+    from self_explain.model.data import ClassificationData, ARRAY_ATTRIBUTES
+
+    dm = ClassificationData(basedir=args.data_dir, tokenizer_name=args.tokenizer_name,
+                            batch_size=args.batch_size, num_workers=args.num_workers)
+    dataset = dm.get_dataset(f"{args.split}_with_parse.json")
+    dataset_size = sum(getattr(dataset, ARRAY_ATTRIBUTES.get(key, key)).nbytes for key in dataset_cache.ARRAYS)
+    print(f"{args.split}: {len(dataset)} samples, arrays {dataset_size/1e6:.1f}MB")
+    dataloader = dm.val_dataloader() if args.split == "dev" else dm.test_dataloader() if args.split == "test" \
+        else dm.train_dataloader()
+    for epoch in range(args.epochs):
+        start = time.time()
+        first, last = {}, {}
+        for i, batch in enumerate(dataloader):
+            if i % args.interval == 0:
+                for pid in child_pids():
+                    try:
+                        memory = read_memory(pid)
+                    except OSError:
+                        continue
+                    first.setdefault(pid, memory)
+                    last[pid] = memory
+        elapsed = time.time() - start
+        print(f"epoch {epoch}: {len(dataloader)} batches in {elapsed:.1f}s")
+        for pid in first:
+            growth = {key: (last[pid][key] - first[pid][key]) / 1024 for key in first[pid]}
+            print(f"  worker {pid}: Rss {last[pid]['Rss']/1024:.1f}MB (+{growth['Rss']:.1f}MB), "
+                  f"Pss {last[pid]['Pss']/1024:.1f}MB (+{growth['Pss']:.1f}MB), "
+                  f"Private_Dirty {last[pid]['Private_Dirty']/1024:.1f}MB (+{growth['Private_Dirty']:.1f}MB)")
+
+
+def benchmark_padding(args):
+    """ Padding efficiency of shuffled, bucketed and token-budget batches of a split
+    """
+    from transformers import AutoTokenizer
+    from self_explain.model.data import ClassificationDataset
+    from self_explain.model.samplers import BucketBatchSampler, padding_efficiency
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, do_lower_case=True)
+    dataset = ClassificationDataset(tokenizer=tokenizer, data_path=os.path.join(args.data_dir, f"{args.split}_with_parse.json"))
+    token_lengths, phrase_counts = dataset.token_lengths(), dataset.phrase_counts()
+    permutation = np.random.RandomState(0).permutation(len(dataset))
+    samplers = {
+        "shuffled": [permutation[i:i + args.batch_size].tolist() for i in range(0, len(dataset), args.batch_size)],
+        "in order": BucketBatchSampler(token_lengths, phrase_counts, batch_size=args.batch_size, shuffle=False),
+        "bucketed": BucketBatchSampler(token_lengths, phrase_counts, batch_size=args.batch_size),
+    }
+    if args.max_tokens is not None:
+        samplers["in order, max_tokens"] = BucketBatchSampler(token_lengths, phrase_counts, batch_size=None,
+                                                              max_tokens=args.max_tokens, shuffle=False)
+        samplers["bucketed, max_tokens"] = BucketBatchSampler(token_lengths, phrase_counts, batch_size=None,
+                                                              max_tokens=args.max_tokens)
+    print(f"{args.split}: {len(dataset)} samples, mean tokens {token_lengths.mean():.1f}, max tokens {token_lengths.max()}")
+    for key, batches in samplers.items():
+        batches = list(batches)
+        efficiency = padding_efficiency(batches, token_lengths, phrase_counts)
+        print(f"  {key:24s}: {len(batches):6d} batches, token efficiency {efficiency['tokens']:.2f}, "
+              f"phrase matrix efficiency {efficiency['phrases']:.2f}")
+
+
+def lil_interpret_loop(logits, list_of_interpret_dict, dev_samples, current_idx, k=5):
+    """ Previous implementation of lil_interpret (Python loops over every phrase), the baseline
+    """
+    import torch
+    sf_logits = torch.softmax(logits, dim=1).tolist()
+    lil_sf_logits = torch.softmax(list_of_interpret_dict["lil_logits"], dim=-1).tolist()
+    lil_outputs = []
+    for idx, sf_item in enumerate(sf_logits):
+        dev_sample = dev_samples[current_idx + idx]
+        lil_dict = {}
+        argmax_sf = max(range(len(sf_item)), key=lambda i: sf_item[i])
+        for phrase_idx, phrase in enumerate(dev_sample["parse_tree"]):
+            relevance_score = lil_sf_logits[idx][phrase_idx][argmax_sf] - sf_item[argmax_sf]
+            if phrase_idx != 0:
+                lil_dict[phrase["phrase"]] = relevance_score
+        lil_outputs.append(sorted(lil_dict.items(), key=lambda item: item[1], reverse=True)[:k])
+    return lil_outputs
+
+
+def gil_interpret_loop(concept_map, list_of_interpret_dict, k=10):
+    """ Previous implementation of gil_interpret (converts all the top-k indices), the baseline
+    """
+    return [[concept_map[x] for x in topk_concepts.tolist()][:k] for topk_concepts in list_of_interpret_dict["topk_indices"]]
+
+
+def benchmark_interpret(args):
+    """ Time of the LIL/GIL interpretation post-processing of a dev set, with random model outputs 
+    (the post-processing does not depend on the model)
+    """
+    import torch
+    from self_explain.model.infer_model import gil_interpret, lil_interpret, load_dev_examples
+
+    rng = np.random.RandomState(args.seed)
+    if args.dev_file is not None:
+        dev_samples = load_dev_examples(args.dev_file)[:args.num_samples]
+    else:
+        words = [f"w{i}" for i in range(1000)]
+        dev_samples = [dict(parse_tree=[dict(phrase=" ".join(rng.choice(words, size=rng.randint(1, 6))))
+                                        for _ in range(rng.randint(2, args.max_phrases))])
+                       for _ in range(args.num_samples)]
+    concept_map = {i: f"concept {i}" for i in range(args.num_concepts)}
+    generator = torch.Generator().manual_seed(args.seed)
+    batches = []
+    for start in range(0, len(dev_samples), args.batch_size):
+        samples = dev_samples[start:start + args.batch_size]
+        max_phrases = max(len(sample["parse_tree"]) for sample in samples)
+        interpret_dict = dict(lil_logits=torch.randn(len(samples), max_phrases, args.num_classes, generator=generator),
+                              topk_indices=torch.randint(args.num_concepts, (len(samples), args.topk), generator=generator))
+        batches.append((start, torch.randn(len(samples), args.num_classes, generator=generator), interpret_dict))
+    num_phrases = sum(len(sample["parse_tree"]) for sample in dev_samples)
+    print(f"{len(dev_samples)} samples, {num_phrases / len(dev_samples):.1f} phrases per sample, "
+          f"{len(batches)} batches of {args.batch_size}, gil_k={args.gil_k}, lil_k={args.lil_k}")
+
+    timings, outputs = {}, {}
+    implementations = dict(loop=(lil_interpret_loop, gil_interpret_loop), vectorized=(lil_interpret, gil_interpret))
+    for key, (lil, gil) in implementations.items():
+        start = time.time()
+        outputs[key] = [(lil(logits, interpret_dict, dev_samples, current_idx, k=args.lil_k),
+                         gil(concept_map, interpret_dict, k=args.gil_k))
+                        for current_idx, logits, interpret_dict in batches]
+        timings[key] = time.time() - start
+        print(f"  {key:10s}: {timings[key]:.3f}s ({1e6 * timings[key] / len(dev_samples):.1f}us per sample)")
+    print(f"speed-up {timings['loop'] / timings['vectorized']:.1f}x")
+    for (lil_loop, gil_loop), (lil_vectorized, gil_vectorized) in zip(outputs["loop"], outputs["vectorized"]):
+        if gil_loop != gil_vectorized or [[phrase for phrase, _ in sample] for sample in lil_loop] != \
+                [[phrase for phrase, _ in sample] for sample in lil_vectorized]:
+            logging.warning("the loop and vectorized interpretations differ")
+            break
+
+
+def benchmark_explain(args):
+    """ Latency of SelfExplainCharacterizer.process_many for each explain mode, and the largest 
+    score difference with the full model (the LIL logits are left out without LIL)
+    """
+    import csv
+    from self_explain.json_util import load_json
+    from self_explain.self_explain import SelfExplainCharacterizer, BUNDLE_PATH_KEYS
+
+    with open(args.tsv_filename) as handle:
+        texts = [row["sentence"] for row in csv.DictReader(handle, delimiter="\t")][:args.number]
+    ch = SelfExplainCharacterizer(**load_json(args.model_conf, keys=BUNDLE_PATH_KEYS))
+    # warm up (parser and model)
+    ch.process_many(texts[:args.batch_size], batch_size=args.batch_size, explain="full")
+    print(f"{len(texts)} texts from {args.tsv_filename}, batch_size={args.batch_size}")
+    scores = {}
+    for explain in ["full", "lil", "gil", False]:
+        start = time.time()
+        outputs = ch.process_many(texts, batch_size=args.batch_size, explain=explain)
+        elapsed = time.time() - start
+        scores[explain] = np.array([np.nan if prob is None else prob for prob, _ in outputs])
+        difference = np.nanmax(np.abs(scores[explain] - scores["full"])) if len(texts) else 0.
+        print(f"  explain={str(explain):5s}: {elapsed:.2f}s ({1000 * elapsed / max(len(texts), 1):.1f}ms per text), "
+              f"max score difference {difference:.4f}")
+
+
+def evaluate_latency(model, dataloader, explain, num_batches=None):
+    """ Predicted labels, true labels, positive class probabilities and time (s) per batch of model
+    on the batches of dataloader
+    """
+    import torch
+    predicted, labels, scores, times = [], [], [], []
+    with torch.no_grad():
+        for batch in itertools.islice(dataloader, num_batches):
+            start = time.time()
+            logits, _, _ = model(batch, explain=explain)
+            times.append(time.time() - start)
+            predicted.append(logits.argmax(-1).numpy())
+            labels.append(batch[3].numpy())
+            scores.append(torch.softmax(logits, -1)[:, -1].numpy())
+    return np.concatenate(predicted), np.concatenate(labels), np.concatenate(scores), np.array(times)
+
+
+def benchmark_quantize(args):
+    """ Accuracy and latency of the fp32 checkpoint and its dynamic int8 quantization (CPU) on a 
+    dev split (e.g. SST-2), with the agreement of their predictions and the size of their weights
+    """
+    import torch
+    from self_explain.model.infer_model import load_model
+    from self_explain.model.quantization import state_dict_size
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model, _, dm = load_model(args.checkpoint, batch_size=args.batch_size, gpus=0, dataset_basedir=args.data_dir)
+    dm.num_workers = 0
+    filename = os.path.join(args.data_dir or model.hparams.dataset_basedir, f"{args.split}_with_parse.json")
+    explain = False if args.explain == "none" else args.explain
+    print(f"{filename}, batch_size={args.batch_size}, explain={explain}, {torch.get_num_threads()} threads")
+    results = {}
+    for name in ["fp32", "int8"]:
+        if name == "int8":
+            model.quantize()
+        size = state_dict_size({key: value for key, value in model.state_dict().items() if key != "concept_store"})
+        dataloader = dm.ordered_dataloader(filename)
+        # warm up
+        evaluate_latency(model, dataloader, explain, num_batches=1)
+        predicted, labels, scores, times = evaluate_latency(model, dataloader, explain, num_batches=args.num_batches)
+        results[name] = predicted, scores
+        print(f"  {name}: accuracy {np.mean(predicted == labels):.4f}, {1000 * times.sum() / len(labels):.2f}ms per "
+              f"sample ({1000 * np.median(times):.1f}ms median batch), {size / 1e6:.0f}MB weights")
+    agreement = np.mean(results["fp32"][0] == results["int8"][0])
+    difference = np.abs(results["fp32"][1] - results["int8"][1])
+    print(f"  agreement {agreement:.4f}, score difference mean {difference.mean():.4f} max {difference.max():.4f}")
+
+
+def tensor_bytes(outputs) -> int:
+    """ Size of the tensors in the (nested) outputs of a model
+    """
+    import torch
+    if isinstance(outputs, torch.Tensor):
+        return outputs.numel() * outputs.element_size()
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    if isinstance(outputs, (list, tuple)):
+        return sum(tensor_bytes(output) for output in outputs)
+    return 0
+
+
+def reset_peak_rss() -> bool:
+    """ Resets the peak resident set size of the process (Linux 4.0+), False if not supported
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as handle:
+            handle.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """ Peak resident set size of the process (bytes) since the last reset_peak_rss
+    """
+    with open("/proc/self/status") as handle:
+        for line in handle:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def benchmark_encoder(args):
+    """ Memory and throughput of the encoder (randomly initialized) with every hidden state returned 
+    (output_hidden_states=True, the previous SEXLNet.forward_classifier), only the last one, and
+    truncated to fewer layers (--encoder_layers)
+    """
+    import torch
+    from transformers import AutoConfig, AutoModel
+    from self_explain.model.model_utils import encoder_kwargs, encoder_layers, truncate_encoder
+
+    device = torch.device(args.device)
+    config = AutoConfig.from_pretrained(args.model_name)
+    encoder = AutoModel.from_config(config).to(device).eval()
+    num_layers = len(encoder_layers(encoder))
+    tokens = torch.randint(config.vocab_size, (args.batch_size, args.num_tokens), device=device)
+    mask, token_types = torch.ones_like(tokens), torch.zeros_like(tokens)
+    settings = [(f"{num_layers} layers, all hidden states", num_layers, dict(output_hidden_states=True)),
+                (f"{num_layers} layers, last hidden state", num_layers, encoder_kwargs(config))]
+    settings += [(f"{layers} layers, last hidden state", layers, encoder_kwargs(config))
+                 for layers in sorted(args.encoder_layers or [], reverse=True) if layers < num_layers]
+    print(f"{args.model_name} on {device}: batch_size={args.batch_size}, num_tokens={args.num_tokens}")
+    for name, layers, kwargs in settings:
+        # settings are in decreasing number of layers
+        if layers < len(encoder_layers(encoder)):
+            truncate_encoder(encoder, layers)
+        with torch.no_grad():
+            encoder(input_ids=tokens, token_type_ids=token_types, attention_mask=mask, **kwargs)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            cpu_peak = device.type == "cpu" and reset_peak_rss()
+            start = time.time()
+            for _ in range(args.repeats):
+                outputs = encoder(input_ids=tokens, token_type_ids=token_types, attention_mask=mask, **kwargs)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = (time.time() - start) / args.repeats
+        # the outputs are kept until the encoder returns, the peaks include the weights
+        memory = f"outputs {tensor_bytes(outputs) / 2 ** 20:.0f}MB"
+        if device.type == "cuda":
+            memory += f", peak {torch.cuda.max_memory_allocated() / 2 ** 20:.0f}MB"
+        elif cpu_peak:
+            memory += f", peak RSS {peak_rss() / 2 ** 20:.0f}MB"
+        del outputs
+        print(f"  {name:32s}: {args.batch_size / elapsed:7.1f} sentences/s, {memory}")
+
+
+# modules that should not be imported by "import self_explain"
+HEAVY_MODULES = ["torch", "transformers", "pytorch_lightning", "spacy", "benepar", "nltk", "pandas", "matplotlib"]
+
+
+def import_times(statement) -> list:
+    """ (module, self us, cumulative us) of the modules imported by statement in a new interpreter 
+    (python -X importtime)
+    """
+    import subprocess
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def benchmark_import(args):
+    """ Import time of the package (and the slowest modules), fails if a heavy module is imported 
+    or the import takes longer than max_ms, to guard against startup regressions
+    """
+    statement = f"import {args.module}"
+    runs = [import_times(statement) for _ in range(args.repeats)]
+    totals = [sum(self_us for _, self_us, _ in times) / 1000 for times in runs]
+    times = runs[-1]
+    print(f"{statement}: {min(totals):.1f}ms (best of {args.repeats}), {len(times)} modules")
+    for module, self_us, cumulative_us in sorted(times, key=lambda item: -item[2])[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f}ms cumulative {self_us / 1000:8.1f}ms self  {module}")
+    forbidden = args.forbid if args.forbid is not None else HEAVY_MODULES if args.module == "self_explain" else []
+    heavy = sorted({module.split(".")[0] for module, _, _ in times} & set(forbidden))
+    failed = False
+    if len(heavy):
+        print(f"FAIL: {statement} imports {', '.join(heavy)}")
+        failed = True
+    if args.max_ms is not None and min(totals) > args.max_ms:
+        print(f"FAIL: {statement} takes {min(totals):.1f}ms > {args.max_ms}ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparser = subparsers.add_parser("dataloader", help="Memory growth of DataLoader workers")
+    subparser.add_argument("--data_dir", type=str, required=True, help="Dataset folder")
+    subparser.add_argument("--split", default="train", choices=["train", "dev", "test"], help="Split to iterate")
+    subparser.add_argument("--tokenizer_name", default="xlnet-base-cased", type=str, help="Tokenizer name")
+    subparser.add_argument("--batch_size", default=16, type=int, help="Batch size")
+    subparser.add_argument("--num_workers", default=16, type=int, help="Number of DataLoader workers")
+    subparser.add_argument("--epochs", default=1, type=int, help="Number of epochs")
+    subparser.add_argument("--interval", default=50, type=int, help="Read worker memory every interval batches")
+    subparser.set_defaults(run=benchmark_dataloader)
+
+    subparser = subparsers.add_parser("padding", help="Padding efficiency of batch samplers")
+    subparser.add_argument("--data_dir", type=str, required=True, help="Dataset folder")
+    subparser.add_argument("--split", default="train", choices=["train", "dev", "test"], help="Split to batch")
+    subparser.add_argument("--tokenizer_name", default="xlnet-base-cased", type=str, help="Tokenizer name")
+    subparser.add_argument("--batch_size", default=16, type=int, help="Batch size")
+    subparser.add_argument("--max_tokens", default=None, type=int, help="Maximum number of padded tokens per batch")
+    subparser.set_defaults(run=benchmark_padding)
+
+    subparser = subparsers.add_parser("interpret", help="LIL/GIL interpretation post-processing time")
+    subparser.add_argument("--dev_file", type=str, default=None, 
+                           help="Parse file (*_with_parse.json), random parse trees otherwise")
+    subparser.add_argument("--num_samples", default=10000, type=int, help="Number of samples")
+    subparser.add_argument("--max_phrases", default=40, type=int, help="Maximum number of phrases of random samples")
+    subparser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    subparser.add_argument("--num_classes", default=2, type=int, help="Number of classes")
+    subparser.add_argument("--num_concepts", default=100000, type=int, help="Number of concepts")
+    subparser.add_argument("--topk", default=100, type=int, help="Number of concepts retrieved by GIL")
+    subparser.add_argument("--gil_k", default=10, type=int, help="Number of concepts in the GIL interpretations")
+    subparser.add_argument("--lil_k", default=5, type=int, help="Number of phrases in the LIL interpretations")
+    subparser.add_argument("--seed", default=0, type=int, help="Random seed")
+    subparser.set_defaults(run=benchmark_interpret)
+
+    subparser = subparsers.add_parser("explain", help="Characterizer latency of each explain mode")
+    subparser.add_argument("--model_conf", type=str, required=True, help="SE model configuration (see export_model.py)")
+    subparser.add_argument("--tsv_filename", type=str, required=True, help="TSV file with a sentence column")
+    subparser.add_argument("--number", "-n", default=1000, type=int, help="Number of texts")
+    subparser.add_argument("--batch_size", default=32, type=int, help="Number of sentences per model batch")
+    subparser.set_defaults(run=benchmark_explain)
+
+    subparser = subparsers.add_parser("quantize", help="Accuracy and latency of the int8 quantized model (CPU)")
+    subparser.add_argument("--checkpoint", type=str, required=True, help="Model checkpoint (fp32)")
+    subparser.add_argument("--data_dir", type=str, default=None, help="Dataset folder (default: from the checkpoint)")
+    subparser.add_argument("--split", default="dev", choices=["train", "dev", "test"], help="Split to evaluate")
+    subparser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    subparser.add_argument("--num_batches", default=None, type=int, help="Number of batches (default: all)")
+    subparser.add_argument("--num_threads", default=None, type=int, help="Number of torch threads")
+    subparser.add_argument("--explain", default="full", choices=["none", "gil", "lil", "full"], 
+                           help="Interpretation layers to run (see SEXLNet.forward)")
+    subparser.set_defaults(run=benchmark_quantize)
+
+    subparser = subparsers.add_parser("encoder", help="Memory and throughput of the encoder (hidden states, layers)")
+    subparser.add_argument("--model_name", default="xlnet-base-cased", type=str, help="Encoder name")
+    subparser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+    subparser.add_argument("--num_tokens", default=128, type=int, help="Number of tokens per sentence")
+    subparser.add_argument("--encoder_layers", default=[9, 6], type=int, nargs="*", 
+                           help="Numbers of layers of the truncated encoders")
+    subparser.add_argument("--repeats", default=5, type=int, help="Number of batches")
+    subparser.add_argument("--device", default="cpu", type=str, 
+                           help="Device (cpu or cuda)")
+    subparser.set_defaults(run=benchmark_encoder)
+
+    subparser = subparsers.add_parser("import", help="Package import time (python -X importtime)")
+    subparser.add_argument("--module", default="self_explain", type=str, help="Module to import")
+    subparser.add_argument("--repeats", default=3, type=int, help="Number of runs (the best one is reported)")
+    subparser.add_argument("--top", default=10, type=int, help="Number of slowest modules to list")
+    subparser.add_argument("--max_ms", default=None, type=float, help="Fail if the import takes longer")
+    subparser.add_argument("--forbid", default=None, nargs="*", 
+                           help="Fail if one of these modules is imported (default: heavy modules for self_explain)")
+    subparser.set_defaults(run=benchmark_import)
+
+    args = parser.parse_args()
+
+    console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
+    logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+
+    args.run(args)
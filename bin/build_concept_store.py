@@ -1,23 +1,45 @@
 import os 
 import argparse
 import logging
-from self_explain.preprocessing.build_concept_store import concept_store 
+from self_explain.preprocessing.build_concept_store import concept_store, update_concept_store, concept_index
+from self_explain.model.concept_index import INDEX_TYPES
+from self_explain.model.concept_store import DTYPES
 
 def main():
     parser = argparse.ArgumentParser()
 
     ## Required parameters
-    parser.add_argument("--input_train_file", "-i", default=None, type=str, required=True,
-                        help="The input train file")
+    parser.add_argument("--input_train_file", "-i", default=None, type=str, required=False, nargs="+",
+                        help="The input train file(s)")
 
     parser.add_argument("--output_folder", "-o", default='roberta-base', type=str, required=True,
                         help="Output folder for concept store and dict")
 
-    parser.add_argument("--model_name", "-m", default='roberta-base', type=str, required=True,
-                        help="Model name")
+    parser.add_argument("--model_name", "-m", default=None, type=str, required=False,
+                        help="Model name (default: roberta-base, or as in the manifest with --update)")
 
-    parser.add_argument("--max_concept_len", "-l", default=5, type=int, required=True,
-                        help="Max length of concept")
+    parser.add_argument("--max_concept_len", "-l", default=None, type=int, required=False,
+                        help="Max length of concept (default: 5, or as in the manifest with --update)")
+    parser.add_argument("--update", action="store_true", 
+                        help="Add the new concepts of the input files to the existing concept store")
+    parser.add_argument("--batch_size", "-b", default=256, type=int, help="Number of concepts per batch")
+    parser.add_argument("--device", default=None, type=str, help="Device to embed concepts on (default: cuda if available)")
+    parser.add_argument("--num_threads", default=None, type=int, help="Number of CPU threads")
+    parser.add_argument("--workers", "-w", default=1, type=int, help="Number of concept extraction processes")
+    parser.add_argument("--min_frequency", default=None, type=int, 
+                        help="Skip concepts that occur less often (default: 1, or as in the manifest with --update)")
+    parser.add_argument("--dtype", default="float32", choices=list(DTYPES), help="Type of the concept store")
+    parser.add_argument("--index", default=None, choices=list(INDEX_TYPES), 
+                        help="Also build a concept index for the GIL top-k search")
+    parser.add_argument("--index_only", action="store_true", 
+                        help="Only build the index of the existing concept store in the output folder")
+    parser.add_argument("--num_lists", default=1024, type=int, help="Number of clusters of the ivf index")
+    parser.add_argument("--nprobe", default=16, type=int, help="Number of clusters searched by the ivf index")
+    parser.add_argument("--num_subspaces", default=48, type=int, help="Number of subspaces of the pq index")
+    parser.add_argument("--rerank", default=10, type=int, 
+                        help="The pq index rescores rerank * k candidates exactly")
+    parser.add_argument("--recall_queries", default=1000, type=int, help="Number of queries for the recall@k report")
+    parser.add_argument("--recall_k", default=5, type=int, help="k of the recall@k report")
     parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
 
     args = parser.parse_args()
@@ -25,10 +47,36 @@ def main():
     console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
     logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
 
-    concept_store(input_file_name=args.input_train_file,
-                  output_folder=args.output_folder,
-                  model_name=args.model_name,
-                  max_concept_length=args.max_concept_len)
+    if not args.index_only and args.input_train_file is None:
+        parser.error("--input_train_file is required unless --index_only is set")
+
+    if args.update:
+        update_concept_store(input_file_names=args.input_train_file,
+                             output_folder=args.output_folder,
+                             model_name=args.model_name,
+                             max_concept_length=args.max_concept_len,
+                             batch_size=args.batch_size,
+                             device=args.device,
+                             num_threads=args.num_threads,
+                             workers=args.workers,
+                             min_frequency=args.min_frequency)
+    elif not args.index_only:
+        concept_store(input_file_name=args.input_train_file,
+                      output_folder=args.output_folder,
+                      model_name=args.model_name or 'roberta-base',
+                      max_concept_length=args.max_concept_len or 5,
+                      batch_size=args.batch_size,
+                      device=args.device,
+                      num_threads=args.num_threads,
+                      dtype=args.dtype,
+                      workers=args.workers,
+                      min_frequency=args.min_frequency or 1)
+
+    if args.index is not None:
+        index_kwargs = dict(ivf=dict(num_lists=args.num_lists, nprobe=args.nprobe),
+                            pq=dict(num_subspaces=args.num_subspaces, rerank=args.rerank)).get(args.index, {})
+        concept_index(args.output_folder, args.index, num_queries=args.recall_queries, k=args.recall_k, 
+                      **index_kwargs)
 
 
 if __name__ == "__main__":
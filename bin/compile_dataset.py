@@ -0,0 +1,33 @@
+import os
+import argparse
+import logging
+import time
+
+from transformers import AutoTokenizer
+
+from self_explain.model.dataset_cache import load_or_compile
+
+desc = """ Compile *_with_parse.json files into memory-mapped arrays used by ClassificationDataset.
+This is done automatically the first time a file is loaded, this script does it ahead of training. """
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--data_dir", type=str, required=True, help="Dataset folder")
+    parser.add_argument("--splits", default=["train", "dev", "test"], type=str, nargs="+", help="Which splits to compile")
+    parser.add_argument("--tokenizer_name", default="xlnet-base-cased", type=str, help="Tokenizer name")
+    parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
+    args = parser.parse_args()
+
+    console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
+    logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, do_lower_case=True)
+    for file_split in args.splits:
+        data_path = os.path.join(args.data_dir, file_split + "_with_parse.json")
+        if not os.path.exists(data_path):
+            print(f"input file '{data_path}' not present, skipping")
+            continue
+        start = time.time()
+        arrays, folder = load_or_compile(data_path, tokenizer, progress_bar=True)
+        print(f"{data_path}: {arrays['labels'].size} samples in {folder} ({time.time() - start:.1f}s)")
@@ -0,0 +1,82 @@
+import os
+import json
+import argparse
+import logging
+
+import torch
+import tqdm
+
+from self_explain.preprocessing.compress_concept_store import compress_concept_store
+from self_explain.preprocessing.build_concept_store import concept_store_filename, save_json_atomic
+
+desc = """ Compress a concept store by merging near-duplicate concepts (dedup) or clustering them 
+to a target size (kmeans), and report the size, GIL latency and (with --checkpoint) validation 
+accuracy before and after """
+
+
+def validation_accuracy(checkpoint, concept_store, batch_size=32, max_batches=None) -> float:
+    """ Accuracy of the model of checkpoint on the dev split of its dataset with concept_store
+    """
+    from self_explain.model.SE_XLNet import SEXLNet
+    from self_explain.model.data import ClassificationData
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = SEXLNet.load_from_checkpoint(checkpoint, concept_store=concept_store).to(device)
+    model.eval()
+    dm = ClassificationData(basedir=model.hparams.dataset_basedir, tokenizer_name=model.hparams.model_name,
+                            batch_size=batch_size, sparse_lil=getattr(model.hparams, "sparse_lil", False))
+    dataloader = dm.val_dataloader()
+    correct = total = 0
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm.tqdm(dataloader, desc=f"evaluating {os.path.basename(concept_store)}")):
+            if max_batches is not None and i >= max_batches:
+                break
+            batch = [b.to(device) if isinstance(b, torch.Tensor) else {k: v.to(device) for k, v in b.items()} for b in batch]
+            logits, _, _ = model(batch)
+            correct += (torch.argmax(logits, -1) == batch[-1]).sum().item()
+            total += batch[-1].size(0)
+    return correct / max(total, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--input_folder", "-i", type=str, required=True, help="Folder with the concept store and concept_idx.json")
+    parser.add_argument("--output_folder", "-o", type=str, required=True, help="Output folder (can be the input folder)")
+    parser.add_argument("--method", default="dedup", choices=["dedup", "kmeans"], help="Compression method")
+    parser.add_argument("--threshold", default=0.95, type=float, help="Cosine similarity of merged concepts (dedup)")
+    parser.add_argument("--num_lists", default=None, type=int, 
+                        help="Number of clusters compared separately (dedup, default: 1 per 1000 concepts)")
+    parser.add_argument("--target_size", default=None, type=int, help="Number of concepts (kmeans)")
+    parser.add_argument("--num_iterations", default=10, type=int, help="Number of k-means iterations (kmeans)")
+    parser.add_argument("--checkpoint", default=None, type=str, help="Checkpoint to compare the validation accuracy with")
+    parser.add_argument("--batch_size", default=32, type=int, help="Batch size of the validation")
+    parser.add_argument("--max_batches", default=None, type=int, help="Only validate on max_batches batches")
+    parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
+    args = parser.parse_args()
+
+    console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
+    logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+
+    input_filename = concept_store_filename(args.input_folder)
+    accuracy = {}
+    if args.checkpoint is not None:
+        accuracy["input"] = validation_accuracy(args.checkpoint, input_filename, batch_size=args.batch_size,
+                                                max_batches=args.max_batches)
+    report = compress_concept_store(args.input_folder, args.output_folder, method=args.method, threshold=args.threshold,
+                                    target_size=args.target_size, num_lists=args.num_lists, 
+                                    num_iterations=args.num_iterations)
+    if args.checkpoint is not None:
+        accuracy["output"] = validation_accuracy(args.checkpoint, concept_store_filename(args.output_folder),
+                                                 batch_size=args.batch_size, max_batches=args.max_batches)
+    for key in ["input", "output"]:
+        info = report[key]
+        text = f"{key:6s}: {info['concepts']:8d} concepts, {info['megabytes']:8.1f}MB, GIL search {info['gil_ms']:.2f}ms/batch"
+        if key in accuracy:
+            text += f", validation accuracy {accuracy[key]:.4f}"
+        print(text)
+    if len(accuracy):
+        filename = os.path.join(args.output_folder, "compression.json")
+        with open(filename, "r") as handle:
+            compression = json.load(handle)
+        compression["accuracy"] = accuracy
+        save_json_atomic(compression, filename)
@@ -0,0 +1,30 @@
+import os
+import argparse
+import logging
+
+from self_explain.model.concept_store import DTYPES, convert_concept_store, verify_concept_store
+
+desc = """ Convert a concept store (concept_store.pt) to a raw concept store that is memory-mapped 
+read-only by SEXLNet (and shared between processes) """
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("input", type=str, help="Concept store to convert (.pt or raw)")
+    parser.add_argument("--output", "-o", default=None, type=str, help="Output file (default: input with .bin extension)")
+    parser.add_argument("--dtype", default=None, choices=list(DTYPES), help="Type of the output (default: as stored)")
+    parser.add_argument("--model_name", "-m", default=None, type=str, help="Model the concept store was built with")
+    parser.add_argument("--verify", action="store_true", help="Verify the checksum of the output")
+    parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
+    args = parser.parse_args()
+
+    console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
+    logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+
+    output = os.path.splitext(args.input)[0] + ".bin" if args.output is None else args.output
+    header = convert_concept_store(args.input, output, dtype=args.dtype, model_name=args.model_name)
+    print(f"{args.input} ({os.path.getsize(args.input)/1e6:.1f}MB) -> {output} ({os.path.getsize(output)/1e6:.1f}MB): "
+          f"{header['rows']} x {header['dim']} {header['dtype']}, model {header['model_name']}")
+    if args.verify:
+        verify_concept_store(output)
+        print(f"checksum {header['checksum']} verified")
@@ -0,0 +1,42 @@
+import os
+import argparse
+import json
+import logging
+
+import tqdm
+
+from self_explain.preprocessing.utils import compact_datapoint, dense_datapoint
+
+desc = """ Convert *_with_parse.json files between the dense (nt_idx_matrix + onehot) and compact (num_tokens) formats """
+
+
+def convert(input_filename, output_filename, dense=False):
+    convert_fn = dense_datapoint if dense else compact_datapoint
+    input_size = os.path.getsize(input_filename)
+    with open(input_filename, "r") as input_file, open(output_filename, "w") as output_file:
+        for line in tqdm.tqdm(input_file, desc=f"converting {input_filename}"):
+            json.dump(convert_fn(json.loads(line)), output_file)
+            output_file.write("\n")
+    output_size = os.path.getsize(output_filename)
+    print(f"{input_filename} ({input_size/1e6:.1f}MB) -> {output_filename} ({output_size/1e6:.1f}MB)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("filenames", nargs="+", type=str, help="*_with_parse.json files to convert")
+    parser.add_argument("--suffix", default="_compact", type=str, help="Suffix added to the output filename")
+    parser.add_argument("--in_place", action="store_true", help="Replace the input file")
+    parser.add_argument("--dense", action="store_true", help="Convert to the dense format instead")
+    parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
+    args = parser.parse_args()
+
+    console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
+    logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+
+    for filename in args.filenames:
+        root, ext = os.path.splitext(filename)
+        output_filename = root + args.suffix + ext
+        convert(filename, output_filename, dense=args.dense)
+        if args.in_place:
+            print(f"replacing {filename}")
+            os.replace(output_filename, filename)
@@ -1,15 +1,18 @@
 import os
 import logging
 import json
-import resource
 import shutil
 from argparse import ArgumentParser, Namespace
 
 import torch 
 
 from self_explain.model.SE_XLNet import SEXLNet
+from self_explain.model.concept_store import DTYPES, convert_concept_store
+from self_explain.model.export import GRAPH_FORMATS, export_graph
 from self_explain.json_util import load_json, save_json
-from self_explain import SelfExplainCharacterizer
+from self_explain import SelfExplainCharacterizer, download_benepar
+from self_explain.self_explain import BUNDLE_PATH_KEYS
+from transformers import AutoTokenizer
 
 
 def check_json(var: dict):
@@ -28,8 +31,6 @@ def check_json(var: dict):
 """
 
 if __name__ == "__main__":
-    #rlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
-    #resource.setrlimit(resource.RLIMIT_NOFILE, (4096, rlimit[1]))
     base_dir = os.path.join(os.path.expanduser("~"), "malise", "models")
 
     parser = ArgumentParser()
@@ -38,12 +39,20 @@ if __name__ == "__main__":
     parser.add_argument('--name', type=str, default="self_explain_news", help="Name of model self_explain_news, self_explain_social")
     parser.add_argument('--save_dir', type=str, default=None, help="Output location")
     parser.add_argument('--version', type=str, default="0.0.1", help="Output location")
+    parser.add_argument('--concept_store_dtype', type=str, default=None, choices=list(DTYPES), help="Type of the exported concept store")
+    parser.add_argument('--quantize', action="store_true", 
+                        help="Also export the model with dynamic int8 quantization (model_int8.pt, for CPU inference)")
+    parser.add_argument('--graph_format', default=None, choices=list(GRAPH_FORMATS), 
+                        help="Also export the forward graph (model_graph.pt or model_graph.onnx) for SelfExplainRuntime")
     parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
     args = parser.parse_args()
 
     console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
     logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
 
+    # the exported model is loaded with SelfExplainCharacterizer at the end
+    download_benepar()
+
     print(f"loading from checkpoint: {args.checkpoint}")
     model = SEXLNet.load_from_checkpoint(args.checkpoint)
     dataset_basedir = model.hparams["dataset_basedir"]
@@ -74,55 +83,61 @@ if __name__ == "__main__":
     # initialize model conf with checkpoint and concept_map
     conf = dict(checkpoint_filename=checkpoint_filename, concept_map_filename=concept_map_filename)
 
-    # export concept_store and update kwargs and hparams 
-    hparams = vars(model.hparams.hparams)
-    check_json(hparams)
-
-    # copy concept store from location in hparams
+    # convert the concept store from the location in hparams to a raw concept store (memory-mapped 
+    # and shared by processes), it is passed to load_from_checkpoint as concept_store
     checkpoint_kwargs = dict()
-    for key in ["concept_store",]:
-        src = model.hparams[key]
-        dst = os.path.join(save_dir, os.path.basename(src))
-        print(f"- copying to {dst}")
-        shutil.copyfile(src, dst)
-        checkpoint_kwargs[key] = os.path.abspath(dst)
-        hparams[key] = checkpoint_kwargs[key]
-    checkpoint_kwargs.update(dict(hparams=hparams))
-
-    ## XXX not clear why concept_store is stored twice
-    #concept_store = os.path.basename(model.hparams['concept_store'])
-    #model.hparams['concept_store'] = concept_store
-    #model.hparams.hparams.concept_store = concept_store
-    #print(f"model.hparams['concept_store']={model.hparams['concept_store']}")
-    #print(f"model.hparams.hparams.concept_store={model.hparams.hparams.concept_store}")
+    src = model.hparams["concept_store"]
+    dst = os.path.join(save_dir, "concept_store.bin")
+    print(f"- converting {src} to {dst}")
+    header = convert_concept_store(src, dst, dtype=args.concept_store_dtype, model_name=model.hparams["model_name"])
+    print(f"  {header['rows']} x {header['dim']} {header['dtype']}")
+    checkpoint_kwargs["concept_store"] = os.path.abspath(dst)
+
+    # config and tokenizer of the encoder, the model is built from the config (its pretrained weights 
+    # are overwritten by the checkpoint, so they are not downloaded)
+    dst = os.path.join(save_dir, "base_model")
+    print(f"- saving config and tokenizer of {model.hparams['model_name']} to {dst}")
+    model.model.config.save_pretrained(dst)
+    AutoTokenizer.from_pretrained(model.hparams["model_name"], do_lower_case=True).save_pretrained(dst)
+    checkpoint_kwargs["base_model"] = os.path.abspath(dst)
+    checkpoint_kwargs["pretrained"] = False
+
+    if args.graph_format is not None:
+        # traced forward (encoder, LIL and GIL with the concept store) for SelfExplainRuntime
+        dst = os.path.join(save_dir, f"model_graph{GRAPH_FORMATS[args.graph_format]}")
+        print(f"- exporting {args.graph_format} graph to {dst}")
+        metadata = export_graph(model, dst, graph_format=args.graph_format)
+        print(f"  checked: {metadata.get('check', 'no')}")
+        # used instead of the checkpoint when the characterizer is loaded with use_graph=True
+        conf["graph_filename"] = os.path.abspath(dst)
+
+    if args.quantize:
+        dst = os.path.join(save_dir, "model_int8.pt")
+        print(f"- saving quantized model to {dst}")
+        model.quantize()
+        model.save_quantized(dst)
+        # used instead of the checkpoint when the characterizer is loaded with quantize=True
+        conf["quantized_filename"] = os.path.abspath(dst)
+        conf["quantize"] = True
 
     # create configuration to load model from export dir
     conf.update(dict(checkpoint_kwargs=checkpoint_kwargs))
     conf_filename = os.path.join(save_dir, "model.json")
     conf_filename = os.path.abspath(conf_filename)
     print(f"- saving conf in {conf_filename}")
-    save_json(conf, conf_filename, keys=["concept_store", ])
+    save_json(conf, conf_filename, keys=BUNDLE_PATH_KEYS)
 
     # Load SelfExplainCharacterizer from exported model
     # change working directory so that relative paths are not valid
     print("--")
     os.chdir("/tmp")
 
-    # load model conf, note that the concept_store and checkpoint_filename are expanded relative to os.path.dirname(conf_filename)
-    conf = load_json(conf_filename, keys=["concept_store",])
+    # load model conf, note that the paths (BUNDLE_PATH_KEYS and checkpoint_filename) are expanded relative to os.path.dirname(conf_filename)
+    conf = load_json(conf_filename, keys=BUNDLE_PATH_KEYS)
     # get the checkpoint_filename
     checkpoint_filename = conf["checkpoint_filename"]
-    if "checkpoint_kwargs" in conf:
-        checkpoint_kwargs = conf["checkpoint_kwargs"]
-        if "hparams" in checkpoint_kwargs:
-            checkpoint_kwargs["hparams"] = Namespace(**checkpoint_kwargs["hparams"])
+    checkpoint_kwargs = conf.get("checkpoint_kwargs", {})
     print(f"loading {checkpoint_filename}: {checkpoint_kwargs}")
 
-    # load model from exported checkpoint 
-    # kwargs are specified to override parameters in model.hparams
-    # XXX however concept_store is stored in 2 locations: 
-    #   hparams["concept_store"]
-    #   hparams.hparams.concept_store
-    #model2 = SEXLNet.load_from_checkpoint(checkpoint_filename, **conf["checkpoint_kwargs"])
-    se = SelfExplainCharacterizer(**conf)
-
+    # load model from exported checkpoint, checkpoint_kwargs override the concept store
+    se = SelfExplainCharacterizer.from_bundle(conf_filename)
@@ -1,21 +1,30 @@
 import os
 import logging
 import json
-import resource
 from argparse import ArgumentParser
+from self_explain import set_resource_limit
 from self_explain.plot_roc import plot_roc
 
 from self_explain.model.infer_model import evaluate, load_model, load_concept_map
 
 if __name__ == "__main__":
-    rlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
-    resource.setrlimit(resource.RLIMIT_NOFILE, (4096, rlimit[1]))
+    set_resource_limit()
 
     parser = ArgumentParser()
     parser.add_argument('--ckpt', type=str, required=True, help="Checkpoint to load")
     parser.add_argument('--concept_map', type=str, required=True, help="Concept store file to load")
     parser.add_argument("--dataset_basedir", help="Base directory where the dataset is located.", type=str)
     parser.add_argument('--batch_size', type=int, default=16, help="Batch size to use")
+    parser.add_argument('--max_tokens', type=int, default=None, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--gil_k', type=int, default=10, help="Number of concepts in the GIL interpretations")
+    parser.add_argument('--lil_k', type=int, default=5, help="Number of phrases in the LIL interpretations")
+    parser.add_argument('--explain', default="full", choices=["none", "gil", "lil", "full"], 
+                        help="Interpretations to compute (none: scores only)")
+    parser.add_argument('--output_format', default="tsv", choices=["tsv", "jsonl"], help="Format of the output files")
+    parser.add_argument('--resume', action="store_true", 
+                        help="Continue the output files of an interrupted run instead of overwriting them")
+    parser.add_argument('--splits', nargs="+", default=["test", "validation", "train"], 
+                        choices=["test", "validation", "train"], help="Splits to evaluate")
     parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
     args = parser.parse_args()
 
@@ -23,27 +32,26 @@ if __name__ == "__main__":
     logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
 
     print(f"loading checkpoint from: {args.ckpt}")
-    model, trainer, dm = load_model(args.ckpt, batch_size=args.batch_size)
+    model, trainer, dm = load_model(args.ckpt, batch_size=args.batch_size, max_tokens=args.max_tokens,
+                                    dataset_basedir=args.dataset_basedir)
 
     print(f"loading concept_map from: {args.concept_map}")
     concept_map = load_concept_map(args.concept_map)
 
-    splits = {"test": dict(filename="test_with_parse.json", dataloader=dm.test_dataloader()),
-        "validation": dict(filename="dev_with_parse.json", dataloader=dm.val_dataloader()),
-        "train": dict(filename="train_with_parse.json", dataloader=dm.train_dataloader()),
-        }
+    splits = {"test": "test_with_parse.json", "validation": "dev_with_parse.json", "train": "train_with_parse.json"}
 
+    for key in args.splits:
+        # all splits (also train) are evaluated in file order
+        filename = splits[key]
 
-    for key, value in splits.items():
-        # get validation dataloader
-        dataloader = value["dataloader"]
-        dev_file = os.path.join(args.dataset_basedir, value["filename"])
+        # save output to results/<split>_with_parse_output.tsv (or .jsonl)
+        paths_output_loc = os.path.splitext(filename)[0] + f"_output.{args.output_format}"
+        paths_output_loc = os.path.join(dm.basedir, "results", paths_output_loc)
 
-        # save output to dev_file + "_output.tsv" if not specified
-        paths_output_loc = os.path.splitext(value["filename"])[0] + "_output.tsv"
-        paths_output_loc = os.path.join(args.dataset_basedir, "results", paths_output_loc)
-
-        y_true, y_pred = evaluate(model, dataloader, concept_map=concept_map, dev_file=dev_file, paths_output_loc=paths_output_loc)
-        save_dir = os.path.join(args.dataset_basedir, "results", key)
+        y_true, y_pred = evaluate(model, dm, filename, concept_map=concept_map, paths_output_loc=paths_output_loc,
+                                  gil_k=args.gil_k, lil_k=args.lil_k,
+                                  explain=False if args.explain == "none" else args.explain,
+                                  output_format=args.output_format, resume=args.resume)
+        save_dir = os.path.join(dm.basedir, "results", key)
         plot_roc(y_true, y_pred, save_dir=save_dir, key=key)
 
@@ -1,15 +1,16 @@
 import logging
 import json
-import resource
 import csv 
 import os
 import tqdm
 import numpy as np
 from argparse import ArgumentParser
 
+from self_explain import download_benepar, set_resource_limit
 from self_explain.plot_roc import plot_roc
 from self_explain.json_util import load_json
-from self_explain.self_explain import SelfExplainCharacterizer
+from self_explain.self_explain import SelfExplainCharacterizer, BUNDLE_PATH_KEYS
+from self_explain.preprocessing.utils import chunks
 
 def load_tsv(filename):
     data = []
@@ -22,18 +23,59 @@ def load_tsv(filename):
     return data
 
 
+def process_chunk(ch, texts, batch_size):
+    """ Process texts with process_many, if the chunk fails process them one by one so that only 
+    the texts that fail are skipped (their outputs are (None, None))
+    """
+    try:
+        return ch.process_many(texts, batch_size=batch_size)
+    except Exception as e:
+        logging.warning(f"failed to process a chunk of {len(texts)} texts, processing them one by one: {e}")
+    outputs = []
+    for text in texts:
+        try:
+            outputs.append(ch.process(text))
+        except Exception as e:
+            logging.info(f"failed to process '{text}': {e}")
+            outputs.append((None, None))
+    return outputs
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument('--model_conf', type=str, default=None, help="SE model to load")
     parser.add_argument('--tsv_filename', "-tf", type=str, default=None, help="dev/test TSV file to load")
     parser.add_argument('--number', "-n", type=int, default=0, help="Number of samples to process")
+    parser.add_argument('--batch_size', "-b", type=int, default=32, help="Number of sentences per model batch")
+    parser.add_argument('--chunk_size', type=int, default=1024, help="Number of samples to pass to process_many at a time")
+    parser.add_argument('--concept_index', type=str, default=None, help="Concept index for the GIL search (overrides the model conf)")
+    parser.add_argument('--nprobe', type=int, default=None, help="Number of clusters searched by an ivf concept index")
+    parser.add_argument('--explain', default=None, choices=["none", "gil", "lil", "full"], 
+                        help="Interpretations to compute (none: scores only, default: as in the model conf or full)")
+    parser.add_argument('--quantize', action="store_true", help="Dynamic int8 quantization of the model (CPU)")
+    parser.add_argument('--use_graph', action="store_true", 
+                        help="Score with the exported graph of the model conf (see export_model.py --graph_format)")
+    parser.add_argument('--load_workers', type=int, default=4, help="Number of threads loading the model components")
     parser.add_argument("--verbosity", "-v", action="count", default=0, help="Verbosity level")
     args = parser.parse_args()
 
     console_level = logging.WARN if args.verbosity == 0 else logging.INFO if args.verbosity == 1 else logging.DEBUG
     logging.basicConfig(level=console_level, format='[%(asctime)s %(levelname)s] %(message)s')
+    set_resource_limit()
+    download_benepar()
 
-    kwargs = load_json(args.model_conf, keys=["concept_store",])
+    kwargs = load_json(args.model_conf, keys=BUNDLE_PATH_KEYS)
+    kwargs["load_workers"] = args.load_workers
+    if args.quantize:
+        kwargs["quantize"] = True
+    if args.use_graph:
+        kwargs["use_graph"] = True
+    if args.concept_index is not None:
+        kwargs["concept_index"] = args.concept_index
+    if args.nprobe is not None:
+        kwargs["concept_index_kwargs"] = dict(kwargs.get("concept_index_kwargs", {}), nprobe=args.nprobe)
+    if args.explain is not None:
+        kwargs["explain"] = False if args.explain == "none" else args.explain
     ch = SelfExplainCharacterizer(**kwargs)
 
     data = load_tsv(args.tsv_filename)
@@ -42,17 +84,17 @@ if __name__ == "__main__":
 
     y_true = []
     y_pred = []
-    for i, row in enumerate(tqdm.tqdm(data, desc="characterizer")):
-        text = row["sentence"]
-        #print(f"{i+1:04d}. '{text}'")
-        try:
-            prob, evidence = ch.process(text)
-        except:
-            print(f"failed to process '{text}'")
-            continue
-        result = dict(sentence=row["sentence"], label=row.get("label", None), prob=prob, evidence=evidence)
-        y_true.append(row["label"])
-        y_pred.append(prob)
+    num_chunks = (len(data) + args.chunk_size - 1) // args.chunk_size
+    for rows in tqdm.tqdm(chunks(data, n=args.chunk_size), total=num_chunks, desc="characterizer"):
+        texts = [row["sentence"] for row in rows]
+        outputs = process_chunk(ch, texts, batch_size=args.batch_size)
+        for row, (prob, evidence) in zip(rows, outputs):
+            if prob is None:
+                print(f"failed to process '{row['sentence']}'")
+                continue
+            result = dict(sentence=row["sentence"], label=row.get("label", None), prob=prob, evidence=evidence)
+            y_true.append(row["label"])
+            y_pred.append(prob)
 
     y_pred = np.array(y_pred).astype(float)
     y_true = np.array(y_true).astype(int)
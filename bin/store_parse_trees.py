@@ -2,6 +2,7 @@ import os
 import argparse
 import self_explain
 from self_explain.preprocessing.store_parse_trees import ParsedDataset
+from self_explain.preprocessing.parse_cache import default_parse_cache_filename
 
 def main():
     parser = argparse.ArgumentParser()
@@ -14,9 +15,21 @@ def main():
     parser.add_argument("--tokenizer_name", default='roberta-base', type=str, required=True,
                         help="Tokenizer name")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite even if present")
+    parser.add_argument("--workers", default=1, type=int, 
+                        help="Number of parser processes (each loads its own benepar model)")
+    parser.add_argument("--batch_size", default=64, type=int, 
+                        help="Number of sentences per call to the parser")
+    parser.add_argument("--dense", action="store_true", 
+                        help="Store the dense nt_idx_matrix/onehot vectors (format before compact files)")
+    parser.add_argument("--parse_cache", default=default_parse_cache_filename(), type=str, 
+                        help="Parse cache file shared across runs (empty string to disable)")
     args = parser.parse_args()
 
-    parsed_data = ParsedDataset(tokenizer_name=args.tokenizer_name, progress_bar=True)
+    self_explain.set_resource_limit()
+    self_explain.download_benepar()
+
+    parsed_data = ParsedDataset(tokenizer_name=args.tokenizer_name, progress_bar=True, batch_size=args.batch_size,
+                                parse_cache=args.parse_cache or None, compact=not args.dense)
 
     # Read input files from folder
     for file_split in args.splits:
@@ -28,7 +41,8 @@ def main():
         if not os.path.exists(output_file_name) or args.overwrite:
             print(f"storing parsed trees {input_file_name} -> {output_file_name}")
             parsed_data.read_and_store_from_tsv(input_file_name=input_file_name,
-                                                output_file_name=output_file_name)
+                                                output_file_name=output_file_name,
+                                                workers=args.workers)
         else:
             print(f"output file '{output_file_name}' present, skipping. Use '--overwrite' option.")
 
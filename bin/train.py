@@ -5,14 +5,14 @@ import numpy as np
 import pytorch_lightning as pl
 import logging
 from argparse import ArgumentParser
-import resource
+from pytorch_lightning.plugins.ddp_plugin import DDPPlugin
 from self_explain.model.data import ClassificationData
 from self_explain.model.SE_XLNet import SEXLNet
+from self_explain import set_resource_limit
 
 
 def main():
-    rlimit = resource.getrlimit(resource.RLIMIT_NOFILE)
-    resource.setrlimit(resource.RLIMIT_NOFILE, (4096, rlimit[1]))
+    set_resource_limit()
     # init: important to make sure every node initializes the same weights
     SEED = 18
     np.random.seed(SEED)
@@ -25,6 +25,8 @@ def main():
     parser = ArgumentParser()
     parser.add_argument('--num_gpus', type=int)
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_tokens', type=int, default=None, help="Maximum number of padded tokens per batch")
+    parser.add_argument('--bucket', action="store_true", help="Batch training examples of similar length")
     parser.add_argument('--clip_grad', type=float, default=1.0)
     parser.add_argument("--dataset_basedir", help="Base directory where the dataset is located.", type=str)
     parser.add_argument("--concept_store", help="Concept store file", type=str)
@@ -45,7 +47,8 @@ def main():
 
     # Step 1: Init Data
     logging.info("Loading the data module")
-    dm = ClassificationData(basedir=args.dataset_basedir, tokenizer_name=args.model_name, batch_size=args.batch_size)
+    dm = ClassificationData(basedir=args.dataset_basedir, tokenizer_name=args.model_name, batch_size=args.batch_size,
+                            max_tokens=args.max_tokens, bucket=args.bucket, sparse_lil=args.sparse_lil)
 
     # Step 2: Init Model
     logging.info("Initializing the model")
@@ -66,7 +69,12 @@ def main():
         mode='max'
     )
 
-    trainer = pl.Trainer.from_argparse_args(args, callbacks=[checkpoint_callback], val_check_interval=0.5, gradient_clip_val=args.clip_grad, track_grad_norm=2)
+    # BucketBatchSampler splits the batches between processes itself
+    replace_sampler_ddp = not dm.uses_batch_sampler(shuffle=True)
+    # every process loads the concept store buffer itself, do not broadcast it at every step
+    plugins = [DDPPlugin(broadcast_buffers=False)] if str(args.accelerator).startswith("ddp") else None
+    trainer = pl.Trainer.from_argparse_args(args, callbacks=[checkpoint_callback], val_check_interval=0.5, gradient_clip_val=args.clip_grad, track_grad_norm=2,
+                                            replace_sampler_ddp=replace_sampler_ddp, plugins=plugins)
     trainer.fit(model, dm)
     # trainer.test()
 
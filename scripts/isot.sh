@@ -11,7 +11,7 @@ echo python bin/store_parse_trees.py --data_dir $DATA_FOLDER  --tokenizer_name $
 # Since SST-2 already provides parsed output, easier to do it this way, for other datasets, need to adapt
 echo python bin/build_concept_store.py -i $DATA_FOLDER/train_with_parse.json -o $DATA_FOLDER -m $TOKENIZER_NAME -l $MAX_LENGTH
 
-echo python bin/train.py --dataset_basedir ${DATA_FOLDER} --lr 2e-5  --max_epochs 5 --gpus 1 --concept_store ${DATA_FOLDER}/concept_store.pt --default_root_dir ${DATA_FOLDER}
+echo python bin/train.py --dataset_basedir ${DATA_FOLDER} --lr 2e-5  --max_epochs 5 --gpus 1 --concept_store ${DATA_FOLDER}/concept_store.bin --default_root_dir ${DATA_FOLDER}
 
 echo "--"
 echo python bin/infer_model.py --concept_map ${DATA_FOLDER}/concept_idx.json \
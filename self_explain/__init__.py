@@ -1,35 +1,73 @@
+""" Importing the package is cheap and has no side effects: SelfExplainCharacterizer and the
+submodules are imported on first access, and the benepar download and the file limit are explicit
+(download_benepar, set_resource_limit).
+"""
 __project__ = "self_explain"
-from pkg_resources import get_distribution, DistributionNotFound
-try: 
-  __version__ = get_distribution(__project__).version
-except DistributionNotFound:
-  __version__ = "0.0.0"
+import os
+import importlib
 
-import os 
-from .self_explain import SelfExplainCharacterizer
+# attributes imported on first access (name: module)
+_LAZY_ATTRIBUTES = {
+    "SelfExplainCharacterizer": ".self_explain",
+}
+_SUBMODULES = ["json_util", "model", "plot_roc", "preprocessing", "self_explain"]
 
-def download_benepar():
-    """ Download benepar data to ~/nltk_data
+
+def _version() -> str:
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # python < 3.8
+        from importlib_metadata import version, PackageNotFoundError
+    try:
+        return version(__project__)
+    except PackageNotFoundError:
+        return "0.0.0"
+
+
+def __getattr__(name):
+    # __version__ is also lazy: importlib.metadata takes most of the import time of the package
+    if name == "__version__":
+        value = _version()
+    elif name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f".{name}", __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | {"__version__"} | set(_LAZY_ATTRIBUTES) | set(_SUBMODULES))
+
+
+def download_benepar(force=False):
+    """ Download benepar data to ~/nltk_data (unless it is already there)
     """
+    import nltk
     import benepar
+    if not force:
+        try:
+            nltk.data.find("models/benepar_en3")
+            return
+        except LookupError:
+            pass
     benepar.download('benepar_en3')
 
 
-def set_resource_limit():
-    """ Required by self-explain
+def set_resource_limit(limit=4096):
+    """ Raise the limit of open files (RLIMIT_NOFILE) to limit, required by self-explain
+    (DataLoader workers share tensors through file descriptors)
     """
     import resource
     rlimit_old = resource.getrlimit(resource.RLIMIT_NOFILE)
-    rlimit_new = (4096, rlimit_old[1])
+    if rlimit_old[0] >= limit:
+        return
+    rlimit_new = (limit if rlimit_old[1] == resource.RLIM_INFINITY else min(limit, rlimit_old[1]), rlimit_old[1])
     print(f"setting resource.RLIMIT_NOFILE={rlimit_new} (was {rlimit_old})")
     resource.setrlimit(resource.RLIMIT_NOFILE, rlimit_new)
 
-# do not use parallel processing for tokenizers
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
-
-# set resource limit 
-set_resource_limit()
-
-# download benepar
-download_benepar()
-
+# do not use parallel processing for tokenizers (unless it is set)
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
@@ -1,4 +1,6 @@
-from argparse import ArgumentParser
+import os
+import logging
+from argparse import ArgumentParser, Namespace
 
 import torch
 import torch.nn as nn
@@ -7,21 +9,58 @@ from torch.optim import AdamW
 from transformers import AutoModel, AutoConfig
 from transformers.modeling_utils import SequenceSummary
 
-from .model_utils import TimeDistributed
+from .model_utils import TimeDistributed, encoder_kwargs, truncate_encoder
+from .concept_store import DTYPES, load_concept_store, inner_products
+from .quantization import quantize_model, is_quantized
+
+# interpretations computed by forward: False (score only), gil, lil or full (both)
+EXPLAIN_MODES = (False, "gil", "lil", "full")
 
 
 class SEXLNet(LightningModule):
-    def __init__(self, hparams):
+    def __init__(self, hparams, concept_store=None, concept_store_dtype=None, mmap_concept_store=False, 
+                 base_model=None, pretrained=True, from_checkpoint=False):
+        """
+        Args:
+            concept_store: concept store (filename or tensor) to use instead of hparams.concept_store,
+                e.g. SEXLNet.load_from_checkpoint(checkpoint, concept_store=filename)
+            concept_store_dtype (str): float32 or float16, overrides hparams.concept_store_dtype
+            mmap_concept_store (bool): memory-map the concept store file (see load_concept_store)
+            base_model (str): folder with the config of hparams.model_name (e.g. in a model exported 
+                by bin/export_model.py), so that it is not downloaded
+            pretrained (bool): load the pretrained weights of hparams.model_name, they are not needed 
+                when the model is loaded from a checkpoint (which overwrites them)
+            from_checkpoint (bool): set by load_from_checkpoint, a missing concept store file is then 
+                restored from the checkpoint (--persistent_concept_store) instead of raising
+        """
         super().__init__()
         self.hparams = hparams
-        self.save_hyperparameters()
-        config = AutoConfig.from_pretrained(self.hparams.model_name)
-        self.model = AutoModel.from_pretrained(self.hparams.model_name)
+        # the concept_store arguments are loading options, only save hparams
+        self.save_hyperparameters("hparams")
+        config = AutoConfig.from_pretrained(base_model or self.hparams.model_name)
+        if pretrained:
+            self.model = AutoModel.from_pretrained(self.hparams.model_name, config=config)
+        else:
+            self.model = AutoModel.from_config(config)
+        # LIL, GIL and the classifier use the last layer, the upper layers are dropped with encoder_layers
+        self.encoder_layers = getattr(self.hparams, "encoder_layers", None)
+        if self.encoder_layers is not None:
+            truncate_encoder(self.model, self.encoder_layers)
+        self.encoder_kwargs = encoder_kwargs(config)
         self.pooler = SequenceSummary(config)
 
         self.classifier = nn.Linear(config.d_model, self.hparams.num_classes)
 
-        self.concept_store = torch.load(self.hparams.concept_store)
+        # the concept store is a buffer so that it moves with the model, it is only saved in 
+        # checkpoints with --persistent_concept_store
+        self.concept_store_override = concept_store is not None
+        self.persistent_concept_store = getattr(self.hparams, "persistent_concept_store", False)
+        self.from_checkpoint = from_checkpoint
+        self.register_buffer("concept_store",
+                             self.load_concept_store(concept_store, concept_store_dtype, mmap_concept_store),
+                             persistent=self.persistent_concept_store)
+        # optional approximate index for the GIL top-k search (see set_concept_index)
+        self.concept_index = None
 
         self.phrase_logits = TimeDistributed(nn.Linear(config.d_model,
                                                         self.hparams.num_classes))
@@ -64,15 +103,66 @@ class SEXLNet(LightningModule):
                             help="Weight decay rate.")
         parser.add_argument("--warmup_prop", default=0.01, type=float,
                             help="Warmup proportion.")
+        parser.add_argument("--sparse_lil", action="store_true",
+                            help="Compute LIL phrase sums from phrase token indices instead of dense matrices.")
+        parser.add_argument("--concept_store_dtype", default=None, choices=list(DTYPES),
+                            help="Type of the concept store (default: as stored).")
+        parser.add_argument("--persistent_concept_store", action="store_true",
+                            help="Save the concept store in the checkpoints.")
+        parser.add_argument("--encoder_layers", default=None, type=int,
+                            help="Number of encoder layers, LIL/GIL run on the last one (default: all).")
         return parser
 
+    def load_concept_store(self, concept_store=None, dtype=None, mmap=False):
+        dtype = dtype or getattr(self.hparams, "concept_store_dtype", None)
+        if isinstance(concept_store, torch.Tensor):
+            return concept_store if dtype is None else concept_store.to(DTYPES[dtype])
+        filename = concept_store or self.hparams.concept_store
+        if not os.path.exists(filename) and self.persistent_concept_store and self.from_checkpoint:
+            logging.warning(f"concept store {filename} not found, it should be restored from the checkpoint")
+            return None
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"concept store {filename} not found")
+        return load_concept_store(filename, dtype=dtype, mmap=mmap, model_name=self.hparams.model_name)
+
+    @classmethod
+    def load_from_checkpoint(cls, checkpoint_path, *args, **kwargs):
+        kwargs.setdefault("from_checkpoint", True)
+        return super().load_from_checkpoint(checkpoint_path, *args, **kwargs)
+
+    def on_load_checkpoint(self, checkpoint):
+        """ Use the concept store saved in the checkpoint (--persistent_concept_store) unless it 
+        was overridden with the concept_store argument
+        """
+        state_dict = checkpoint["state_dict"]
+        saved = state_dict.pop("concept_store", None)
+        if saved is not None and not self.concept_store_override:
+            dtype = getattr(self.hparams, "concept_store_dtype", None)
+            self.concept_store = saved if dtype is None else saved.to(DTYPES[dtype])
+        if self.concept_store is None:
+            raise RuntimeError(f"the checkpoint has no concept store and {self.hparams.concept_store} was not found")
+        if self.persistent_concept_store:
+            # load_state_dict expects the buffer
+            state_dict["concept_store"] = self.concept_store
+
     def configure_optimizers(self):
         return AdamW(self.parameters(), lr=self.hparams.lr, betas=(0.9, 0.99),
                      eps=1e-8)
     
-    def forward(self, batch):
-        self.concept_store = self.concept_store.to(self.model.device)
-        # print(self.concept_store.size(), self.hparams.concept_store)
+    def forward(self, batch, explain="full"):
+        """
+        Args:
+            explain: interpretations to compute, full (True), lil, gil or False (score only). GIL 
+                always runs (its logits are part of the score), LIL only runs for lil and full: 
+                without it the LIL logits (weighted by lamda) are left out, so the scores differ 
+                slightly from full, and the phrases of the batch are not used.
+        Return:
+            logits, accuracy (None without labels) and the outputs of the interpretations 
+            (lil_logits, topk_indices)
+        """
+        explain = "full" if explain is True else explain
+        if explain not in EXPLAIN_MODES:
+            raise ValueError(f"explain={explain} should be one of {EXPLAIN_MODES}")
         tokens, tokens_mask, padded_ndx_tensor, labels = batch
 
         # step 1: encode the sentence
@@ -81,12 +171,17 @@ class SEXLNet(LightningModule):
                                                              attention_mask=tokens_mask)
         logits = self.classifier(sentence_cls)
 
-        lil_logits = self.lil(hidden_state=hidden_state,
-                              nt_idx_matrix=padded_ndx_tensor)
-        lil_logits_mean = torch.mean(lil_logits, dim=1)
+        interpret_dict = {}
+        if explain in ("lil", "full"):
+            lil_logits = self.lil(hidden_state=hidden_state,
+                                  nt_idx_matrix=padded_ndx_tensor)
+            lil_logits_mean = torch.mean(lil_logits, dim=1)
+            logits = logits + self.lamda * lil_logits_mean
+            interpret_dict["lil_logits"] = lil_logits
         gil_logits, topk_indices = self.gil(pooled_input=sentence_cls)
-
-        logits = logits + self.lamda * lil_logits_mean + self.gamma * gil_logits
+        logits = logits + self.gamma * gil_logits
+        if explain in ("gil", "full"):
+            interpret_dict["topk_indices"] = topk_indices
         predicted_labels = torch.argmax(logits, -1)
         if labels is not None:
             acc = torch.true_divide(
@@ -94,14 +189,55 @@ class SEXLNet(LightningModule):
         else:
             acc = None
 
-        return logits, acc, {"topk_indices": topk_indices,
-                             "lil_logits": lil_logits}
+        return logits, acc, interpret_dict
+
+    def set_concept_index(self, concept_index):
+        """ Use concept_index (see concept_index.py) to find the top-k concepts in gil, None for 
+        the exact search over the whole concept store. The index is searched with the concept store 
+        of the model (it does not keep its own reference, which model.to would move separately).
+        """
+        if concept_index is not None:
+            concept_index.check_concepts(self.concept_store)
+            concept_index = concept_index.to(self.device)
+        self.concept_index = concept_index
+
+    def quantize(self):
+        """ Dynamic int8 quantization of the linear layers for CPU inference (see quantization.py)
+        """
+        return quantize_model(self)
+
+    def save_quantized(self, filename):
+        """ Save the hparams and state of a quantized model (without the concept store), see load_quantized
+        """
+        if not is_quantized(self):
+            raise RuntimeError("the model is not quantized, call quantize first")
+        state_dict = {key: value for key, value in self.state_dict().items() if key != "concept_store"}
+        torch.save(dict(hparams=dict(self.hparams), state_dict=state_dict), filename)
+
+    @classmethod
+    def load_quantized(cls, filename, **kwargs):
+        """ Load a model saved by save_quantized. The encoder is built from its config (without the 
+        pretrained weights) and quantized before the state is loaded. kwargs are passed to 
+        __init__ (e.g. concept_store and base_model).
+        """
+        saved = torch.load(filename, map_location="cpu")
+        kwargs.setdefault("pretrained", False)
+        model = cls(Namespace(**saved["hparams"]), **kwargs)
+        model.quantize()
+        missing, unexpected = model.load_state_dict(saved["state_dict"], strict=False)
+        missing = [key for key in missing if key != "concept_store"]
+        if len(missing) or len(unexpected):
+            raise RuntimeError(f"{filename} does not match the model: missing {missing}, unexpected {unexpected}")
+        return model
 
     def gil(self, pooled_input):
         batch_size = pooled_input.size(0)
-        inner_products = torch.mm(pooled_input, self.concept_store.T)
-        _, topk_indices = torch.topk(inner_products, k=self.topk)
-        topk_concepts = torch.index_select(self.concept_store, 0, topk_indices.view(-1))
+        if self.concept_index is not None:
+            _, topk_indices = self.concept_index.search(pooled_input, k=self.topk, concepts=self.concept_store)
+        else:
+            scores = inner_products(pooled_input, self.concept_store)
+            _, topk_indices = torch.topk(scores, k=self.topk)
+        topk_concepts = torch.index_select(self.concept_store, 0, topk_indices.view(-1)).to(pooled_input.dtype)
         topk_concepts = topk_concepts.view(batch_size, self.topk, -1).contiguous()
 
         concat_pooled_concepts = torch.cat([pooled_input.unsqueeze(1), topk_concepts], dim=1)
@@ -115,7 +251,10 @@ class SEXLNet(LightningModule):
         return gil_topk_logits, topk_indices
 
     def lil(self, hidden_state, nt_idx_matrix):
-        phrase_level_hidden = torch.bmm(nt_idx_matrix, hidden_state)
+        if isinstance(nt_idx_matrix, dict):
+            phrase_level_hidden = self.phrase_sums(hidden_state, **nt_idx_matrix)
+        else:
+            phrase_level_hidden = torch.bmm(nt_idx_matrix, hidden_state)
         phrase_level_activations = self.activation(phrase_level_hidden)
         pooled_seq_rep = self.sequence_summary(hidden_state).unsqueeze(1)
         phrase_level_activations = phrase_level_activations - pooled_seq_rep
@@ -123,16 +262,30 @@ class SEXLNet(LightningModule):
         return phrase_level_logits
 
 
+    @staticmethod
+    def phrase_sums(hidden_state, token_index, phrase_index, phrase_mask):
+        """ Sum of the hidden states of the tokens of each phrase (same as the bmm with the dense 
+        phrase/token matrix, see MyCollator with sparse_lil=True)
+        """
+        batch_size, max_tokens, hidden_size = hidden_state.size()
+        max_phrases = phrase_mask.size(1)
+        token_hidden = hidden_state.reshape(batch_size * max_tokens, hidden_size).index_select(0, token_index)
+        phrase_hidden = hidden_state.new_zeros(batch_size * max_phrases, hidden_size)
+        phrase_hidden = phrase_hidden.index_add(0, phrase_index, token_hidden)
+        return phrase_hidden.view(batch_size, max_phrases, hidden_size)
+
+
     def forward_classifier(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor = None):
         """Returns the pooled token
         """
+        # only the last hidden state is requested, so the other layers are not kept in memory
         outputs = self.model(input_ids=input_ids,
                              token_type_ids=token_type_ids,
                              attention_mask=attention_mask,
-                             output_hidden_states=True)
-        hidden_states = outputs["hidden_states"]
-        cls_hidden_state = self.dropout(self.pooler(hidden_states[-1]))
-        return cls_hidden_state, hidden_states[-1]
+                             **self.encoder_kwargs)
+        hidden_state = outputs[0]
+        cls_hidden_state = self.dropout(self.pooler(hidden_state))
+        return cls_hidden_state, hidden_state
 
     def training_step(self, batch, batch_idx):
         # Load the data into variables
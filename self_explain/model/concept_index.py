@@ -0,0 +1,303 @@
+""" Concept indexes: top-k maximum inner product search over the concept store for GIL.
+
+    exact: brute-force inner products with every concept (same as SEXLNet.gil without an index)
+    ivf: concepts are clustered with k-means, a query only scores the concepts of the nprobe
+        clusters whose centroids have the largest inner product with it
+    pq: product quantization, concepts are encoded with one byte per subspace and scored with
+        lookup tables of (query subspace x codeword) inner products, the best rerank * k
+        candidates are rescored exactly if the concepts are attached
+
+Indexes are nn.Modules whose tensors are non-persistent buffers, so they follow the model across
+devices but are not saved in checkpoints. Indexes do not hold the concepts (only their shape), the
+concept store is passed to search, so that the model keeps the only reference to it (see
+SEXLNet.gil).
+"""
+import time
+import logging
+
+import torch
+import torch.nn as nn
+
+from .concept_store import inner_products
+
+
+def kmeans(x: torch.Tensor, num_clusters: int, num_iterations: int = 20, sample_size: int = 100000,
+           seed: int = 0, chunk_size: int = 65536) -> torch.Tensor:
+    """ Centroids (num_clusters, dim) of x (num_points, dim), trained on at most sample_size points
+    """
+    generator = torch.Generator().manual_seed(seed)
+    x = x.float()
+    if sample_size is not None and x.size(0) > sample_size:
+        x = x[torch.randperm(x.size(0), generator=generator)[:sample_size].to(x.device)]
+    if x.size(0) < num_clusters:
+        raise ValueError(f"cannot train {num_clusters} clusters with {x.size(0)} points")
+    centroids = x[torch.randperm(x.size(0), generator=generator)[:num_clusters].to(x.device)].clone()
+    for iteration in range(num_iterations):
+        assignment = assign(x, centroids, chunk_size=chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(sums.dtype)
+        if empty.any():
+            # move empty clusters to random points
+            reseed = torch.randint(x.size(0), (int(empty.sum()),), generator=generator).to(x.device)
+            centroids[empty] = x[reseed]
+    return centroids
+
+
+def assign(x: torch.Tensor, centroids: torch.Tensor, chunk_size: int = 65536) -> torch.Tensor:
+    """ Index of the nearest centroid (L2) of each row of x
+    """
+    centroid_norms = (centroids * centroids).sum(1)
+    assignment = []
+    for start in range(0, x.size(0), chunk_size):
+        chunk = x[start:start + chunk_size].float()
+        # argmin |x - c|^2 = argmax 2 x.c - |c|^2
+        assignment.append(torch.argmax(2 * chunk @ centroids.T - centroid_norms, dim=1))
+    return torch.cat(assignment) if len(assignment) else torch.zeros(0, dtype=torch.long, device=x.device)
+
+
+def exact_search(queries: torch.Tensor, concepts: torch.Tensor, k: int, candidates: torch.Tensor = None):
+    """ Exact top k over all concepts or over candidates (1D tensor of concept indices)
+    """
+    if concepts is None:
+        raise ValueError("the concept store is required to search the index")
+    if candidates is not None:
+        concepts = concepts.index_select(0, candidates)
+    scores = inner_products(queries, concepts)
+    values, indices = torch.topk(scores, k=min(k, scores.size(-1)))
+    if candidates is not None:
+        indices = candidates[indices]
+    return values, indices
+
+
+class ConceptIndex(nn.Module):
+    """ Base class of concept indexes (see INDEX_TYPES)
+    """
+    index_type = None
+    # buffers saved with the index (besides the configuration)
+    state_keys = []
+
+    def __init__(self):
+        super().__init__()
+        # shape of the concept store the index was built for
+        self.num_concepts = None
+        self.dim = None
+
+    def config(self) -> dict:
+        return {}
+
+    def check_concepts(self, concepts: torch.Tensor):
+        """ Raise if concepts is not the concept store the index was built for (by its shape)
+        """
+        if tuple(concepts.size()) != (self.num_concepts, self.dim):
+            raise ValueError(f"the index was built for {self.num_concepts} concepts of dimension {self.dim}, "
+                             f"but the concept store is {tuple(concepts.size())}")
+
+    def build(self, concepts: torch.Tensor):
+        self.num_concepts, self.dim = concepts.size()
+        return self
+
+    def search(self, queries: torch.Tensor, k: int, concepts: torch.Tensor = None):
+        """ Top k concepts of each query, concepts is the concept store the index was built for 
+        (required by the exact and IVF indexes, PQ uses it to rerank)
+
+        Return:
+            tuple: inner products and indices (batch_size, k) of the top k concepts of each query
+        """
+        raise NotImplementedError
+
+    def forward(self, queries: torch.Tensor, k: int, concepts: torch.Tensor = None):
+        return self.search(queries, k, concepts=concepts)
+
+    def extra_repr(self) -> str:
+        return ", ".join(f"{key}={value}" for key, value in dict(num_concepts=self.num_concepts, **self.config()).items())
+
+
+class ExactConceptIndex(ConceptIndex):
+    index_type = "exact"
+
+    def search(self, queries, k, concepts=None):
+        return exact_search(queries, concepts, k)
+
+
+class IVFConceptIndex(ConceptIndex):
+    """ Inverted file index: the concepts of cluster c are list_ids[list_offsets[c]:list_offsets[c+1]]
+    """
+    index_type = "ivf"
+    state_keys = ["centroids", "list_ids", "list_offsets"]
+
+    def __init__(self, num_lists: int = 1024, nprobe: int = 16, num_iterations: int = 20):
+        super().__init__()
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.num_iterations = num_iterations
+        for key in self.state_keys:
+            self.register_buffer(key, None, persistent=False)
+
+    def config(self) -> dict:
+        return dict(num_lists=self.num_lists, nprobe=self.nprobe, num_iterations=self.num_iterations)
+
+    def build(self, concepts):
+        super().build(concepts)
+        num_lists = min(self.num_lists, concepts.size(0))
+        centroids = kmeans(concepts, num_lists, num_iterations=self.num_iterations)
+        assignment = assign(concepts, centroids)
+        counts = torch.bincount(assignment, minlength=num_lists)
+        self.num_lists = num_lists
+        self.centroids = centroids
+        self.list_ids = torch.argsort(assignment)
+        self.list_offsets = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+        return self
+
+    def candidates(self, lists: torch.Tensor) -> torch.Tensor:
+        """ Indices of the concepts in lists (1D tensor of list numbers)
+        """
+        starts = self.list_offsets[lists]
+        lengths = self.list_offsets[lists + 1] - starts
+        total = int(lengths.sum())
+        # position j of list i is starts[i] + j
+        list_starts = torch.cumsum(lengths, 0) - lengths
+        positions = torch.arange(total, device=lengths.device) + torch.repeat_interleave(starts - list_starts, lengths)
+        return self.list_ids[positions]
+
+    def search(self, queries, k, concepts=None):
+        nprobe = min(self.nprobe, self.num_lists)
+        _, probes = torch.topk(queries @ self.centroids.T.to(queries.dtype), k=nprobe)
+        values, indices = [], []
+        for query, lists in zip(queries, probes):
+            candidates = self.candidates(lists)
+            if candidates.numel() < k:
+                # not enough concepts in the probed lists
+                value, index = exact_search(query.unsqueeze(0), concepts, k)
+            else:
+                value, index = exact_search(query.unsqueeze(0), concepts, k, candidates=candidates)
+            values.append(value)
+            indices.append(index)
+        return torch.cat(values), torch.cat(indices)
+
+
+class PQConceptIndex(ConceptIndex):
+    """ Product quantization: each concept is split into num_subspaces subvectors that are replaced
+    by the index (code) of the nearest of num_codewords (at most 256) centroids of their subspace.
+    """
+    index_type = "pq"
+    state_keys = ["codebooks", "codes"]
+
+    def __init__(self, num_subspaces: int = 48, num_codewords: int = 256, rerank: int = 10, num_iterations: int = 20):
+        super().__init__()
+        if num_codewords > 256:
+            raise ValueError(f"num_codewords={num_codewords} but codes are stored in one byte")
+        self.num_subspaces = num_subspaces
+        self.num_codewords = num_codewords
+        self.rerank = rerank
+        self.num_iterations = num_iterations
+        for key in self.state_keys:
+            self.register_buffer(key, None, persistent=False)
+
+    def config(self) -> dict:
+        return dict(num_subspaces=self.num_subspaces, num_codewords=self.num_codewords, rerank=self.rerank,
+                    num_iterations=self.num_iterations)
+
+    def build(self, concepts):
+        super().build(concepts)
+        num_concepts, dim = concepts.size()
+        if dim % self.num_subspaces != 0:
+            raise ValueError(f"concept dimension {dim} is not divisible by num_subspaces={self.num_subspaces}")
+        num_codewords = min(self.num_codewords, num_concepts)
+        subvectors = concepts.float().view(num_concepts, self.num_subspaces, -1)
+        codebooks, codes = [], []
+        for j in range(self.num_subspaces):
+            logging.debug(f"training codebook {j+1}/{self.num_subspaces}")
+            codebook = kmeans(subvectors[:, j], num_codewords, num_iterations=self.num_iterations, seed=j)
+            codebooks.append(codebook)
+            codes.append(assign(subvectors[:, j], codebook).to(torch.uint8))
+        self.num_codewords = num_codewords
+        self.codebooks = torch.stack(codebooks)
+        self.codes = torch.stack(codes, dim=1)
+        return self
+
+    def approximate_scores(self, queries):
+        """ Approximate inner products (batch_size, num_concepts) of queries with all concepts
+        """
+        batch_size = queries.size(0)
+        subqueries = queries.float().view(batch_size, self.num_subspaces, -1)
+        # tables[b, j, c] = <query b subspace j, codeword c of subspace j>
+        tables = torch.einsum("bjd,jcd->bjc", subqueries, self.codebooks)
+        scores = queries.new_zeros(batch_size, self.codes.size(0), dtype=tables.dtype)
+        for j in range(self.num_subspaces):
+            scores += tables[:, j].index_select(1, self.codes[:, j].long())
+        return scores
+
+    def search(self, queries, k, concepts=None):
+        scores = self.approximate_scores(queries)
+        if concepts is None or self.rerank <= 1:
+            values, indices = torch.topk(scores, k=min(k, scores.size(1)))
+            return values.to(queries.dtype), indices
+        _, shortlist = torch.topk(scores, k=min(k * self.rerank, scores.size(1)))
+        values, indices = [], []
+        for query, candidates in zip(queries, shortlist):
+            value, index = exact_search(query.unsqueeze(0), concepts, k, candidates=candidates)
+            values.append(value)
+            indices.append(index)
+        return torch.cat(values), torch.cat(indices)
+
+
+INDEX_TYPES = {index.index_type: index for index in [ExactConceptIndex, IVFConceptIndex, PQConceptIndex]}
+
+
+def build_concept_index(index_type: str, concepts: torch.Tensor, **kwargs) -> ConceptIndex:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"unknown concept index '{index_type}', should be one of {', '.join(INDEX_TYPES)}")
+    start = time.time()
+    index = INDEX_TYPES[index_type](**kwargs).build(concepts)
+    logging.info(f"built {index} in {time.time() - start:.1f}s")
+    return index
+
+
+def save_concept_index(index: ConceptIndex, filename: str):
+    """ Save the configuration and state of index (not the concepts)
+    """
+    state = {key: getattr(index, key).cpu() for key in index.state_keys}
+    torch.save(dict(index_type=index.index_type, config=index.config(), num_concepts=index.num_concepts,
+                    dim=index.dim, state=state), filename)
+
+
+def load_concept_index(filename: str, concepts: torch.Tensor = None, **kwargs) -> ConceptIndex:
+    """ Load an index saved by save_concept_index, kwargs override its configuration (e.g. nprobe).
+    If concepts is given, check that the index was built for it.
+    """
+    saved = torch.load(filename, map_location="cpu")
+    config = dict(saved["config"], **kwargs)
+    index = INDEX_TYPES[saved["index_type"]](**config)
+    index.num_concepts, index.dim = saved["num_concepts"], saved["dim"]
+    for key, value in saved["state"].items():
+        setattr(index, key, value)
+    if concepts is not None:
+        index.check_concepts(concepts)
+    return index
+
+
+def recall_at_k(index: ConceptIndex, concepts: torch.Tensor, queries: torch.Tensor, k: int = 5,
+                batch_size: int = 256) -> dict:
+    """ Recall@k of index (built for concepts) with respect to exact search and the search time 
+    per query of both
+    """
+    exact = ExactConceptIndex().build(concepts)
+    found = 0
+    exact_time = index_time = 0.0
+    with torch.no_grad():
+        for start in range(0, queries.size(0), batch_size):
+            batch = queries[start:start + batch_size]
+            t0 = time.time()
+            _, expected = exact.search(batch, k, concepts=concepts)
+            t1 = time.time()
+            _, retrieved = index.search(batch, k, concepts=concepts)
+            t2 = time.time()
+            exact_time += t1 - t0
+            index_time += t2 - t1
+            for e, r in zip(expected.tolist(), retrieved.tolist()):
+                found += len(set(e) & set(r))
+    num_queries = max(queries.size(0), 1)
+    return dict(recall=found / (num_queries * k), exact_ms=1000 * exact_time / num_queries,
+                index_ms=1000 * index_time / num_queries)
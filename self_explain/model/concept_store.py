@@ -0,0 +1,248 @@
+""" Concept store files (pooled representations of the concepts used by GIL).
+
+Concept stores are either tensors saved with torch.save (concept_store.pt) or raw files 
+(concept_store.bin) that are memory-mapped read-only, so that processes on the same host share 
+the pages of the file instead of each holding a copy. Raw files are
+
+    MAGIC (8 bytes)
+    JSON header padded with spaces to HEADER_SIZE bytes: rows, dim, dtype, model_name and the 
+        sha1 checksum of the data
+    data: rows x dim little-endian float32 or float16 values (row major)
+"""
+import os
+import json
+import inspect
+import hashlib
+import logging
+import warnings
+
+import numpy as np
+import torch
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16}
+NUMPY_DTYPES = {"float32": np.dtype("<f4"), "float16": np.dtype("<f2")}
+
+MAGIC = b"SECSTOR1"
+HEADER_SIZE = 4096
+FORMAT_VERSION = 1
+
+
+def is_raw_concept_store(filename: str) -> bool:
+    with open(filename, "rb") as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def read_header(filename: str) -> dict:
+    with open(filename, "rb") as handle:
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a raw concept store")
+        return json.loads(handle.read(HEADER_SIZE - len(MAGIC)).decode("utf-8"))
+
+
+def hash_data(handle, num_bytes: int, sha1=None, block_size: int = 1 << 24):
+    """ Update sha1 with num_bytes of the data of an open raw concept store
+    """
+    sha1 = hashlib.sha1() if sha1 is None else sha1
+    handle.seek(HEADER_SIZE)
+    while num_bytes > 0:
+        block = handle.read(min(block_size, num_bytes))
+        if not block:
+            raise ValueError(f"{handle.name} is truncated")
+        sha1.update(block)
+        num_bytes -= len(block)
+    return sha1
+
+
+def data_size(header: dict) -> int:
+    return header["rows"] * header["dim"] * NUMPY_DTYPES[header["dtype"]].itemsize
+
+
+def data_checksum(filename: str, header: dict) -> str:
+    """ sha1 of the data of a raw concept store (the rows in the header)
+    """
+    with open(filename, "rb") as handle:
+        return hash_data(handle, data_size(header)).hexdigest()
+
+
+def verify_concept_store(filename: str):
+    header = read_header(filename)
+    checksum = data_checksum(filename, header)
+    if checksum != header["checksum"]:
+        raise ValueError(f"checksum mismatch in {filename}: {checksum} != {header['checksum']}")
+    return header
+
+
+class ConceptStoreWriter(object):
+    """ Write a raw concept store row by row. The file is written to filename.tmp and renamed when 
+    it is closed, or, with append=True, rows are added to an existing file (the header is only 
+    updated when the writer is closed, so an interrupted append leaves the previous rows valid).
+
+    If num_rows is given, the file is allocated and memory-mapped so that rows can be written in 
+    any order with write_rows (the checksum is computed when the writer is closed).
+    """
+    def __init__(self, filename: str, dim: int, dtype: str = "float32", model_name: str = None, append: bool = False,
+                 num_rows: int = None):
+        self.filename = filename
+        self.dim = dim
+        self.dtype = dtype
+        self.model_name = model_name
+        self.append = append
+        self.sha1 = hashlib.sha1()
+        self.rows = 0
+        self.array = None
+        if append and num_rows is not None:
+            raise ValueError("num_rows cannot be used with append")
+        if append:
+            header = read_header(filename)
+            if header["dim"] != dim or header["dtype"] != dtype:
+                raise ValueError(f"cannot append {dim} {dtype} rows to {filename} ({header['dim']} {header['dtype']})")
+            self.model_name = header["model_name"] if model_name is None else model_name
+            self.rows = header["rows"]
+            self.path = filename
+            self.handle = open(filename, "r+b")
+            # the checksum covers all the rows
+            hash_data(self.handle, data_size(header), sha1=self.sha1)
+            self.handle.seek(HEADER_SIZE + data_size(header))
+        else:
+            self.path = f"{filename}.tmp"
+            self.handle = open(self.path, "w+b")
+            self.handle.write(b"\0" * HEADER_SIZE)
+            if num_rows is not None:
+                self.rows = num_rows
+                self.handle.truncate(HEADER_SIZE + num_rows * dim * NUMPY_DTYPES[dtype].itemsize)
+                self.handle.flush()
+                if num_rows > 0:
+                    self.array = np.memmap(self.path, dtype=NUMPY_DTYPES[dtype], mode="r+", offset=HEADER_SIZE,
+                                           shape=(num_rows, dim))
+
+    def as_rows(self, rows) -> np.ndarray:
+        if isinstance(rows, torch.Tensor):
+            rows = rows.detach().cpu().float().numpy()
+        rows = np.ascontiguousarray(rows, dtype=NUMPY_DTYPES[self.dtype])
+        if rows.ndim != 2 or rows.shape[1] != self.dim:
+            raise ValueError(f"expected rows of dimension {self.dim}, got {rows.shape}")
+        return rows
+
+    def write_rows(self, indices, rows):
+        """ Write rows (tensor or array of shape (len(indices), dim)) at indices (requires num_rows)
+        """
+        if self.array is None:
+            raise RuntimeError("write_rows requires a writer created with num_rows")
+        self.array[np.asarray(indices)] = self.as_rows(rows)
+
+    def write(self, rows):
+        """ Append rows (tensor or array of shape (n, dim))
+        """
+        if self.array is not None:
+            raise RuntimeError("use write_rows with a writer created with num_rows")
+        rows = self.as_rows(rows)
+        data = rows.tobytes()
+        self.handle.write(data)
+        self.sha1.update(data)
+        self.rows += rows.shape[0]
+
+    def header(self) -> dict:
+        return dict(version=FORMAT_VERSION, rows=self.rows, dim=self.dim, dtype=self.dtype,
+                    model_name=self.model_name, checksum=self.sha1.hexdigest())
+
+    def close(self) -> dict:
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+            self.sha1 = hash_data(self.handle, self.rows * self.dim * NUMPY_DTYPES[self.dtype].itemsize)
+        header = self.header()
+        text = MAGIC + json.dumps(header).encode("utf-8")
+        if len(text) >= HEADER_SIZE:
+            raise ValueError(f"concept store header is too long: {header}")
+        self.handle.seek(HEADER_SIZE + data_size(header))
+        self.handle.truncate()
+        self.handle.seek(0)
+        self.handle.write(text + b" " * (HEADER_SIZE - len(text)))
+        self.handle.close()
+        if self.path != self.filename:
+            os.replace(self.path, self.filename)
+        return header
+
+    def abort(self):
+        self.array = None
+        self.handle.close()
+        if self.path != self.filename:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def load_raw_concept_store(filename: str, model_name: str = None) -> torch.Tensor:
+    """ Memory-map a raw concept store read-only
+    """
+    header = read_header(filename)
+    if model_name is not None and header.get("model_name") not in (None, model_name):
+        logging.warning(f"concept store {filename} was built with {header['model_name']}, not {model_name}")
+    shape = (header["rows"], header["dim"])
+    array = np.memmap(filename, dtype=NUMPY_DTYPES[header["dtype"]], mode="r", offset=HEADER_SIZE, shape=shape)
+    with warnings.catch_warnings():
+        # the tensor is read-only, nothing writes to the concept store
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(array)
+
+
+def convert_concept_store(src: str, dst: str, dtype: str = None, model_name: str = None, chunk_size: int = 65536) -> dict:
+    """ Convert a concept store (.pt or raw) to a raw concept store
+    """
+    concept_store = load_concept_store(src, mmap=True)
+    dtype = dtype or ("float16" if concept_store.dtype == torch.float16 else "float32")
+    if model_name is None and is_raw_concept_store(src):
+        model_name = read_header(src)["model_name"]
+    with ConceptStoreWriter(dst, dim=concept_store.size(1), dtype=dtype, model_name=model_name) as writer:
+        for start in range(0, concept_store.size(0), chunk_size):
+            writer.write(concept_store[start:start + chunk_size])
+    return writer.header()
+
+
+def load_concept_store(filename: str, dtype: str = None, mmap: bool = False, model_name: str = None) -> torch.Tensor:
+    """ Load a concept store (on the CPU). Raw concept stores are always memory-mapped.
+
+    Args:
+        dtype (str): float32 or float16, None to keep the stored type (converting the type makes 
+            a copy in memory, so it is not shared any more)
+        mmap (bool): memory-map a .pt file instead of reading it (requires a torch version with
+            torch.load(mmap=True), the tensor is read otherwise)
+        model_name (str): warn if a raw concept store was built with another model
+    """
+    if is_raw_concept_store(filename):
+        concept_store = load_raw_concept_store(filename, model_name=model_name)
+        if dtype is not None and concept_store.dtype != DTYPES[dtype]:
+            concept_store = concept_store.to(DTYPES[dtype])
+        logging.info(f"loaded concept store {filename}: {tuple(concept_store.size())} {concept_store.dtype}")
+        return concept_store
+    kwargs = dict(map_location="cpu")
+    if mmap:
+        if "mmap" in inspect.signature(torch.load).parameters:
+            kwargs["mmap"] = True
+        else:
+            logging.warning(f"torch {torch.__version__} cannot memory-map {filename}, loading it instead")
+    concept_store = torch.load(filename, **kwargs)
+    if dtype is not None and concept_store.dtype != DTYPES[dtype]:
+        concept_store = concept_store.to(DTYPES[dtype])
+    logging.info(f"loaded concept store {filename}: {tuple(concept_store.size())} {concept_store.dtype}")
+    return concept_store
+
+
+def inner_products(queries: torch.Tensor, concepts: torch.Tensor, chunk_size: int = 65536) -> torch.Tensor:
+    """ queries @ concepts.T in the type of queries. Concepts stored in another type (e.g. float16
+    on the CPU, where half matrix products are not available) are converted in chunks of
+    chunk_size rows instead of all at once.
+    """
+    if concepts.dtype == queries.dtype:
+        return torch.mm(queries, concepts.T)
+    if concepts.is_cuda:
+        return torch.mm(queries.to(concepts.dtype), concepts.T).to(queries.dtype)
+    return torch.cat([torch.mm(queries, concepts[start:start + chunk_size].to(queries.dtype).T)
+                      for start in range(0, concepts.size(0), chunk_size)], dim=1)
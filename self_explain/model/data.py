@@ -4,93 +4,201 @@ source[TAB]target
 import logging
 import os
 
+import numpy as np
 import pytorch_lightning as pl
 import torch
-from torch.utils.data import DataLoader
-from torch.utils.data import Dataset
-import pandas as pd
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import Dataset, Subset
 from transformers import AutoTokenizer
-from tqdm import tqdm
 
-from .data_utils import pad_nt_matrix_roberta, pad_nt_matrix_xlnet
+from .data_utils import PhraseIndices
+from .samplers import BucketBatchSampler, token_budget_batches
+from . import dataset_cache
+from .dataset_cache import compile_samples, load_or_compile, read_datapoints
+
+# attribute of ClassificationDataset for each array of the compiled dataset (if the name differs)
+ARRAY_ATTRIBUTES = {"labels": "answer_labels"}
 
 
 class ClassificationData(pl.LightningDataModule):
-    def __init__(self, basedir: str, tokenizer_name: str, batch_size: int, num_workers: int = 16):
+    def __init__(self, basedir: str, tokenizer_name: str, batch_size: int, num_workers: int = 16, 
+                 max_tokens: int = None, bucket: bool = False, sparse_lil: bool = False):
+        """ 
+        Args:
+            max_tokens (int): limit batches (of at most batch_size examples) to max_tokens padded tokens
+            bucket (bool): batch training examples of similar length (see BucketBatchSampler)
+            sparse_lil (bool): phrases as index tensors instead of dense matrices (see MyCollator)
+        """
         super().__init__()
         self.basedir = basedir
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.max_tokens = max_tokens
+        self.bucket = bucket
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, do_lower_case=True)
-        self.collator = MyCollator(tokenizer_name)
+        self.collator = MyCollator(tokenizer_name, sparse_lil=sparse_lil)
+        # datasets are loaded once and shared by the dataloaders
+        self.datasets = {}
+
+    def get_dataset(self, filename):
+        data_path = os.path.join(self.basedir, filename)
+        if data_path not in self.datasets:
+            self.datasets[data_path] = ClassificationDataset(tokenizer=self.tokenizer, data_path=data_path)
+        return self.datasets[data_path]
+
+    def uses_batch_sampler(self, shuffle) -> bool:
+        return self.max_tokens is not None or (shuffle and self.bucket)
+
+    def get_dataloader(self, filename, shuffle):
+        dataset = self.get_dataset(filename)
+        if not self.uses_batch_sampler(shuffle):
+            sampler = None
+            if not shuffle and dist.is_available() and dist.is_initialized():
+                # the trainer does not add it when the training batches are bucketed (replace_sampler_ddp=False)
+                sampler = DistributedSampler(dataset, shuffle=False)
+            return DataLoader(dataset=dataset, batch_size=self.batch_size, sampler=sampler,
+                              shuffle=shuffle, num_workers=self.num_workers, collate_fn=self.collator)
+        # evaluation batches stay in file order
+        batch_sampler = BucketBatchSampler(dataset.token_lengths(), dataset.phrase_counts(), 
+                                           batch_size=self.batch_size, max_tokens=self.max_tokens, shuffle=shuffle)
+        efficiency = ", ".join(f"{key}={value:.2f}" for key, value in batch_sampler.padding_efficiency().items())
+        logging.info(f"{filename}: {len(batch_sampler)} batches, padding efficiency: {efficiency}")
+        return DataLoader(dataset=dataset, batch_sampler=batch_sampler, 
+                          num_workers=self.num_workers, collate_fn=self.collator)
+
+    def ordered_dataloader(self, filename, start=0):
+        """ Batches of filename in file order, starting at sample start (e.g. to resume an evaluation)
+        """
+        dataset = self.get_dataset(filename)
+        subset = Subset(dataset, range(start, len(dataset)))
+        if self.max_tokens is None:
+            return DataLoader(dataset=subset, batch_size=self.batch_size, shuffle=False, 
+                              num_workers=self.num_workers, collate_fn=self.collator)
+        token_lengths = dataset.token_lengths()[start:]
+        batches = token_budget_batches(range(len(subset)), token_lengths, self.batch_size, self.max_tokens)
+        return DataLoader(dataset=subset, batch_sampler=batches, num_workers=self.num_workers, collate_fn=self.collator)
 
     def train_dataloader(self):
-        dataset = ClassificationDataset(tokenizer=self.tokenizer,
-                                        data_path=f"{self.basedir}/train_with_parse.json")
-        return DataLoader(dataset=dataset, batch_size=self.batch_size,
-                          shuffle=True, num_workers=self.num_workers, collate_fn=self.collator)
+        return self.get_dataloader("train_with_parse.json", shuffle=True)
 
     def val_dataloader(self):
-        dataset = ClassificationDataset(tokenizer=self.tokenizer,
-                                        data_path=f"{self.basedir}/dev_with_parse.json")
-        return DataLoader(dataset=dataset, batch_size=self.batch_size,
-                          shuffle=False, num_workers=self.num_workers, collate_fn=self.collator)
+        return self.get_dataloader("dev_with_parse.json", shuffle=False)
 
     def test_dataloader(self):
-        data_path = os.path.join(self.basedir, "test_with_parse.json")
-        dataset = ClassificationDataset(tokenizer=self.tokenizer, data_path=data_path)
-        return DataLoader(dataset=dataset, batch_size=self.batch_size,
-                          shuffle=False, num_workers=self.num_workers, collate_fn=self.collator)
+        return self.get_dataloader("test_with_parse.json", shuffle=False)
 
 
 
 class ClassificationDataset(Dataset):
-    def __init__(self, tokenizer, data_path: str, progress_bar=False) -> None:
+    def __init__(self, tokenizer, data_path: str = None, progress_bar=False, samples: list = None, cache=True) -> None:
+        """ Dataset read from data_path (*_with_parse.json) or built from in-memory samples
+        (list of dicts with the same keys as a line of *_with_parse.json). 
+        If cache is set, the tokenized file is compiled once into .npy files next to data_path 
+        (see dataset_cache) and memory-mapped afterwards.
+
+        Samples are kept in a few flat arrays (no per-sample Python objects), so DataLoader workers 
+        do not touch (and copy) the pages of the dataset when they read it. Memory-mapped arrays are 
+        shared through the page cache and are re-mapped (not copied) when the dataset is pickled, 
+        e.g. for spawned workers.
+        """
         super().__init__()
-        if not os.path.exists(data_path): 
-            raise RuntimeError(f"data file not present: {data_path}")
         self.data_path = data_path
         self.tokenizer = tokenizer
+        self.cache = cache
+        self.cache_folder = None
         self.disable = not progress_bar
-        self.read_dataset()
+        if samples is not None:
+            self.load_arrays(compile_samples(samples, self.tokenizer))
+        else:
+            if data_path is None or not os.path.exists(data_path):
+                raise RuntimeError(f"data file not present: {data_path}")
+            self.read_dataset()
 
 
     def read_dataset(self):
         logging.info("Reading data from {}".format(self.data_path))
-        data = pd.read_json(self.data_path, orient="records", lines=True)
-        self.sentences, self.answer_labels, self.nt_idx_matrix = [], [], []
-        logging.info(f"Reading dataset file from {self.data_path}")
-        # print(data, len(data))
-        for i, row in tqdm(data.iterrows(), total=len(data), desc="Reading dataset samples", disable=self.disable):
-            self.answer_labels.append(int(row["label"]))
-            self.sentences.append(row["sentence"])
-            self.nt_idx_matrix.append(torch.tensor(row["nt_idx_matrix"]).long())
-
-        encoded_input = self.tokenizer(self.sentences)
-        self.input_ids = encoded_input["input_ids"]
-        if "token_type_ids" in encoded_input:
-            self.token_type_ids = encoded_input["token_type_ids"]
+        if self.cache:
+            arrays, self.cache_folder = load_or_compile(self.data_path, self.tokenizer, progress_bar=not self.disable)
         else:
-            self.token_type_ids = [[0] * len(s) for s in encoded_input["input_ids"]]
+            arrays = compile_samples(read_datapoints(self.data_path), self.tokenizer, progress_bar=not self.disable)
+        self.load_arrays(arrays)
+
+
+    def load_arrays(self, arrays: dict):
+        """ Set the flat arrays of the dataset (see dataset_cache.ARRAYS)
+        """
+        for key in dataset_cache.ARRAYS:
+            setattr(self, ARRAY_ATTRIBUTES.get(key, key), arrays[key])
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the tokenizer is only needed to compile the dataset
+        state["tokenizer"] = None
+        if self.cache_folder is not None:
+            for key in dataset_cache.ARRAYS:
+                state.pop(ARRAY_ATTRIBUTES.get(key, key))
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cache_folder is not None:
+            self.load_arrays(dataset_cache.load_arrays(self.cache_folder))
+
+
+    def token_lengths(self) -> np.ndarray:
+        return np.diff(self.token_offsets)
+
+
+    def phrase_counts(self) -> np.ndarray:
+        return np.diff(self.phrase_offsets)
+
+
+    def get_phrase_indices(self, i) -> PhraseIndices:
+        """ Token indices of the phrases of sample i
+        """
+        start, end = self.phrase_offsets[i], self.phrase_offsets[i + 1]
+        offsets = np.array(self.phrase_index_offsets[start:end + 1])
+        indices = np.array(self.phrase_indices[offsets[0]:offsets[-1]])
+        return PhraseIndices(offsets - offsets[0], indices, int(self.num_tokens[i]))
+
+
+    def get_nt_idx_matrix(self, i) -> torch.Tensor:
+        """ Phrase/token matrix (num_phrases x num_tokens) of sample i
+        """
+        return self.get_phrase_indices(i).to_matrix()
 
 
     def __len__(self) -> int:
-            return len(self.sentences)
+            return len(self.answer_labels)
 
     def __getitem__(self, i):
-        # We’ll pad at the batch level.
-        return (self.input_ids[i], self.token_type_ids[i], self.nt_idx_matrix[i], self.answer_labels[i])
+        # We’ll pad at the batch level (phrase matrices are built by the collator).
+        start, end = self.token_offsets[i], self.token_offsets[i + 1]
+        return (self.input_ids[start:end].tolist(), self.token_type_ids[start:end].tolist(), 
+                self.get_phrase_indices(i), int(self.answer_labels[i]))
 
 
 
 
 class MyCollator(object):
-    def __init__(self, model_name):
+    def __init__(self, model_name, sparse_lil=False):
+        """ Pad tokens and build the phrase/token matrices of a batch. 
+        If sparse_lil, the phrases are returned as flat index tensors (see SEXLNet.lil) instead of 
+        the dense (batch_size, max_phrases, max_tokens) matrix:
+            token_index: position of each phrase token in the flattened (batch_size * max_tokens) tokens
+            phrase_index: position of its phrase in the flattened (batch_size * max_phrases) phrases
+            phrase_mask: (batch_size, max_phrases), True for phrases that are not padding
+        """
         self.model_name = model_name
+        self.sparse_lil = sparse_lil
         if "xlnet" in model_name:
-            self.pad_fn = pad_nt_matrix_xlnet
+            self.token_offset = 0
         elif "roberta" in model_name:
-            self.pad_fn = pad_nt_matrix_roberta
+            # account for the [CLS] / <s> token - offset by 1
+            self.token_offset = 1
         else:
             raise NotImplementedError
 
@@ -98,29 +206,43 @@ class MyCollator(object):
         max_token_len = 0
         max_phrase_len = 0
         num_elems = len(batch)
+        phrases = []
         for i in range(num_elems):
             tokens, _, idx_m, _ = batch[i]
+            if not isinstance(idx_m, PhraseIndices):
+                idx_m = PhraseIndices.from_matrix(idx_m)
+            phrases.append(idx_m)
             max_token_len = max(max_token_len, len(tokens))
-            max_phrase_len = max(max_phrase_len, idx_m.size(0))
+            max_phrase_len = max(max_phrase_len, idx_m.num_phrases())
 
         tokens = torch.zeros(num_elems, max_token_len).long()
         tokens_mask = torch.zeros(num_elems, max_token_len).long()
         labels = torch.zeros(num_elems).long()
-        nt_idx_matrix = []
+        batch_index, phrase_index, token_index = [], [], []
 
         for i in range(num_elems):
-            toks, _, idx_matrix, label = batch[i]
-            # idx_matrix = torch.tensor(idx_matrix).long()
-            idx_matrix = self.pad_fn(nt_idx_matrix=idx_matrix,
-                                     max_nt_len=max_phrase_len,
-                                     max_length=max_token_len)
+            toks, _, _, label = batch[i]
             length = len(toks)
             tokens[i, :length] = torch.LongTensor(toks)
             tokens_mask[i, :length] = 1
-            nt_idx_matrix.append(idx_matrix)
             labels[i] = label
-
-        padded_ndx_tensor = torch.stack(nt_idx_matrix, dim=0)
+            batch_index.append(np.full(len(phrases[i].indices), i))
+            phrase_index.append(phrases[i].rows())
+            token_index.append(phrases[i].indices + self.token_offset)
+
+        batch_index = torch.from_numpy(np.concatenate(batch_index).astype(np.int64))
+        phrase_index = torch.from_numpy(np.concatenate(phrase_index).astype(np.int64))
+        token_index = torch.from_numpy(np.concatenate(token_index).astype(np.int64))
+        if self.sparse_lil:
+            phrase_mask = torch.zeros(num_elems, max_phrase_len, dtype=torch.bool)
+            for i in range(num_elems):
+                phrase_mask[i, :phrases[i].num_phrases()] = True
+            padded_ndx_tensor = {"token_index": batch_index * max_token_len + token_index,
+                                 "phrase_index": batch_index * max_phrase_len + phrase_index,
+                                 "phrase_mask": phrase_mask}
+        else:
+            padded_ndx_tensor = torch.zeros(num_elems, max_phrase_len, max_token_len)
+            padded_ndx_tensor[batch_index, phrase_index, token_index] = 1
         return [tokens, tokens_mask, padded_ndx_tensor, labels]
 
 
@@ -1,18 +1,33 @@
 import numpy as np
 import torch
 
-def pad_nt_matrix_roberta(nt_idx_matrix, max_nt_len, max_length):
-    n_nt, n_tokens = nt_idx_matrix.size()
-    padded_matrix = torch.zeros((max_nt_len, max_length))
-    # account for the [CLS] / <s> token - offset by 1
-    padded_matrix[:n_nt, 1:n_tokens+1] = nt_idx_matrix
-    return padded_matrix
+class PhraseIndices(object):
+    """ Token indices of the phrases of a sample (CSR layout): the tokens of phrase p are 
+    indices[offsets[p]:offsets[p+1]] and the sample has num_tokens (parsed) tokens.
+    """
+    def __init__(self, offsets: np.ndarray, indices: np.ndarray, num_tokens: int):
+        self.offsets = offsets
+        self.indices = indices
+        self.num_tokens = num_tokens
 
-def pad_nt_matrix_xlnet(nt_idx_matrix, max_nt_len, max_length):
-    n_nt, n_tokens = nt_idx_matrix.size()
-    padded_matrix = torch.zeros((max_nt_len, max_length))
-    # account for the [CLS] / <s> token - offset by 1
-    # print(max_nt_len, nt_idx_matrix.size(), max_length)
-    padded_matrix[:n_nt, :n_tokens] = nt_idx_matrix
-    # padded_matrix = np.flip(padded_matrix, axis=1)
-    return padded_matrix
\ No newline at end of file
+    @classmethod
+    def from_matrix(cls, nt_idx_matrix):
+        """ From a dense (num_phrases x num_tokens) matrix
+        """
+        nt_idx_matrix = np.asarray(nt_idx_matrix)
+        rows, indices = np.nonzero(nt_idx_matrix)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=nt_idx_matrix.shape[0]))])
+        return cls(offsets, indices, nt_idx_matrix.shape[1])
+
+    def num_phrases(self) -> int:
+        return len(self.offsets) - 1
+
+    def rows(self) -> np.ndarray:
+        """ Phrase of each entry of indices
+        """
+        return np.repeat(np.arange(self.num_phrases()), np.diff(self.offsets))
+
+    def to_matrix(self) -> torch.Tensor:
+        nt_idx_matrix = torch.zeros(self.num_phrases(), self.num_tokens).long()
+        nt_idx_matrix[torch.from_numpy(self.rows()), torch.from_numpy(self.indices)] = 1
+        return nt_idx_matrix
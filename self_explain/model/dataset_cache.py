@@ -0,0 +1,138 @@
+""" Compiled dataset: token ids, labels and phrase indices of a *_with_parse.json file stored as
+flat arrays with offsets (CSR layout) in .npy files, so later runs memory-map them instead of
+parsing the JSON and tokenizing again.
+
+Layout (N samples, P phrases in total):
+    token_offsets (N+1): tokens of sample i are input_ids[token_offsets[i]:token_offsets[i+1]]
+    input_ids, token_type_ids: token ids of all samples
+    labels (N), num_tokens (N): label and number of parsed tokens of each sample
+    phrase_offsets (N+1): phrases of sample i are phrase_offsets[i]:phrase_offsets[i+1]
+    phrase_index_offsets (P+1), phrase_indices: token indices of each phrase
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+import tqdm
+
+from ..preprocessing.utils import chunks, phrase_indices_from_datapoint
+
+ARRAYS = ["token_offsets", "input_ids", "token_type_ids", "labels", "num_tokens",
+          "phrase_offsets", "phrase_index_offsets", "phrase_indices"]
+
+# bump when the layout changes so that old caches are rebuilt
+CACHE_VERSION = 1
+
+
+def file_hash(filename, block_size=1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def tokenizer_key(tokenizer) -> str:
+    """ Identify the tokenizer (name and options that change the token ids)
+    """
+    return f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{getattr(tokenizer, 'do_lower_case', None)}"
+
+
+def cache_folder(data_path, tokenizer) -> str:
+    """ Cache folder of data_path for tokenizer, it changes whenever the file or the tokenizer changes
+    """
+    key = f"{CACHE_VERSION}:{file_hash(data_path)}:{tokenizer_key(tokenizer)}"
+    return os.path.join(f"{data_path}.cache", hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+
+
+def read_datapoints(data_path):
+    with open(data_path, "r") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def compile_samples(samples, tokenizer, progress_bar=False, tokenizer_batch_size=10000) -> dict:
+    """ Tokenize samples (datapoints of *_with_parse.json) and flatten them into arrays (see ARRAYS)
+    """
+    sentences, labels, num_tokens = [], [], []
+    phrase_counts, phrase_lengths, phrase_indices = [], [], []
+    for datapoint in tqdm.tqdm(samples, desc="Compiling dataset samples", disable=not progress_bar):
+        indices, length = phrase_indices_from_datapoint(datapoint)
+        sentences.append(datapoint["sentence"])
+        labels.append(int(datapoint["label"]))
+        num_tokens.append(length)
+        phrase_counts.append(len(indices))
+        for phrase in indices:
+            phrase_lengths.append(len(phrase))
+            phrase_indices.extend(phrase)
+
+    token_lengths, input_ids, token_type_ids = [], [], []
+    for batch in chunks(sentences, n=tokenizer_batch_size):
+        encoded_input = tokenizer(batch)
+        for i, ids in enumerate(encoded_input["input_ids"]):
+            token_lengths.append(len(ids))
+            input_ids.extend(ids)
+            if "token_type_ids" in encoded_input:
+                token_type_ids.extend(encoded_input["token_type_ids"][i])
+            else:
+                token_type_ids.extend([0] * len(ids))
+
+    def offsets(lengths):
+        return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+    return dict(token_offsets=offsets(token_lengths),
+                input_ids=np.array(input_ids, dtype=np.int64),
+                token_type_ids=np.array(token_type_ids, dtype=np.int64),
+                labels=np.array(labels, dtype=np.int64),
+                num_tokens=np.array(num_tokens, dtype=np.int64),
+                phrase_offsets=offsets(phrase_counts),
+                phrase_index_offsets=offsets(phrase_lengths),
+                phrase_indices=np.array(phrase_indices, dtype=np.int64))
+
+
+def save_arrays(arrays: dict, folder, meta: dict = None):
+    """ Save arrays in folder (written to a temporary folder first so readers never see partial caches)
+    """
+    parent = os.path.dirname(folder)
+    os.makedirs(parent, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=parent, prefix=".tmp_")
+    try:
+        for key in ARRAYS:
+            np.save(os.path.join(tmp_folder, f"{key}.npy"), arrays[key])
+        with open(os.path.join(tmp_folder, "meta.json"), "w") as handle:
+            json.dump(meta or {}, handle, indent=2)
+        os.rename(tmp_folder, folder)
+    except OSError:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        if not os.path.exists(folder):
+            raise
+
+
+def load_arrays(folder, mmap_mode="r") -> dict:
+    return {key: np.load(os.path.join(folder, f"{key}.npy"), mmap_mode=mmap_mode) for key in ARRAYS}
+
+
+def load_or_compile(data_path, tokenizer, progress_bar=False):
+    """ Memory-map the compiled arrays of data_path, compile them first if needed
+    Return:
+        tuple: arrays (dict) and the cache folder they are mapped from (None if they are in memory)
+    """
+    folder = cache_folder(data_path, tokenizer)
+    if os.path.exists(os.path.join(folder, "meta.json")):
+        logging.info(f"loading compiled dataset from {folder}")
+        return load_arrays(folder), folder
+    logging.info(f"compiling {data_path} -> {folder}")
+    arrays = compile_samples(read_datapoints(data_path), tokenizer, progress_bar=progress_bar)
+    meta = dict(data_path=os.path.abspath(data_path), tokenizer=tokenizer_key(tokenizer),
+                version=CACHE_VERSION, num_samples=int(arrays["labels"].size))
+    try:
+        save_arrays(arrays, folder, meta=meta)
+    except OSError as e:
+        logging.warning(f"failed to save compiled dataset to {folder}, using it from memory. {e}")
+        return arrays, None
+    return load_arrays(folder), folder
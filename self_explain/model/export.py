@@ -0,0 +1,149 @@
+""" Export of the SelfExplain forward graph (encoder, LIL and GIL) to TorchScript or ONNX, so that
+a model can be scored with SelfExplainRuntime (runtime.py) without pytorch_lightning, transformers
+or the checkpoint hparams.
+
+The graph takes the padded tokens, their mask and the dense phrase/token matrix (see MyCollator)
+with dynamic batch, sequence and phrase axes, and returns logits, lil_logits and topk_indices (the
+outputs of SEXLNet.forward with explain="full"). GIL uses the exact top-k search over the concept
+store, which is part of the graph. Shapes that the encoder code turns into Python numbers while
+tracing are fixed in the graph, so the exported graph is checked against the model on inputs of
+another shape.
+"""
+import json
+import inspect
+import logging
+
+import torch
+import torch.nn as nn
+
+from .quantization import is_quantized
+
+GRAPH_FORMATS = {"torchscript": ".pt", "onnx": ".onnx"}
+INPUT_NAMES = ["tokens", "tokens_mask", "nt_idx_matrix"]
+OUTPUT_NAMES = ["logits", "lil_logits", "topk_indices"]
+DYNAMIC_AXES = {
+    "tokens": {0: "batch", 1: "sequence"},
+    "tokens_mask": {0: "batch", 1: "sequence"},
+    "nt_idx_matrix": {0: "batch", 1: "phrases", 2: "sequence"},
+    "logits": {0: "batch"},
+    "lil_logits": {0: "batch", 1: "phrases"},
+    "topk_indices": {0: "batch"},
+}
+
+
+def metadata_filename(filename: str) -> str:
+    """ Metadata of an exported graph (model name, number of classes, formats of inputs and outputs)
+    """
+    return f"{filename}.json"
+
+
+class SelfExplainGraph(nn.Module):
+    """ SEXLNet forward on tensors (explain="full"), for tracing
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens, tokens_mask, nt_idx_matrix):
+        logits, _, interpret_dict = self.model((tokens, tokens_mask, nt_idx_matrix, None), explain="full")
+        return logits, interpret_dict["lil_logits"], interpret_dict["topk_indices"]
+
+
+def example_inputs(model, batch_size: int = 2, num_tokens: int = 16, num_phrases: int = 4, seed: int = 0) -> tuple:
+    """ Random (tokens, tokens_mask, nt_idx_matrix) of the given shape, the last sample is padded
+    and every phrase is a span of tokens
+    """
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(model.model.config.vocab_size, (batch_size, num_tokens), generator=generator)
+    tokens_mask = torch.ones(batch_size, num_tokens, dtype=torch.long)
+    lengths = [num_tokens] * (batch_size - 1) + [max(2, num_tokens // 2)]
+    nt_idx_matrix = torch.zeros(batch_size, num_phrases, num_tokens)
+    for i, length in enumerate(lengths):
+        tokens[i, length:] = 0
+        tokens_mask[i, length:] = 0
+        for j in range(num_phrases):
+            start, end = sorted(torch.randint(length, (2,), generator=generator).tolist())
+            nt_idx_matrix[i, j, start:end + 1] = 1
+    return tokens.to(model.device), tokens_mask.to(model.device), nt_idx_matrix.to(model.device)
+
+
+def onnx_export_kwargs() -> dict:
+    # the TorchScript-based exporter takes dynamic_axes (newer torch versions default to dynamo)
+    return dict(dynamo=False) if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+
+def check_graph(filename: str, model, inputs: tuple, atol: float = 1e-4) -> dict:
+    """ Compare the outputs of the exported graph with those of model on inputs
+    """
+    from .runtime import SelfExplainRuntime
+    with torch.no_grad():
+        expected = SelfExplainGraph(model)(*inputs)
+    outputs = SelfExplainRuntime(filename).score(*[x.cpu() for x in inputs])
+    report = dict(shape=list(inputs[2].shape),
+                  logits=float((outputs[0] - expected[0].cpu()).abs().max()),
+                  lil_logits=float((outputs[1] - expected[1].cpu()).abs().max()),
+                  topk_indices=float((outputs[2] == expected[2].cpu()).float().mean()))
+    if report["logits"] > atol or report["lil_logits"] > atol:
+        raise RuntimeError(f"the graph {filename} differs from the model on inputs of shape {report['shape']} "
+                           f"(the encoder may have fixed shapes while tracing): {report}")
+    return report
+
+
+def export_graph(model, filename: str, graph_format: str = "torchscript", opset_version: int = 12, check: bool = True) -> dict:
+    """ Trace the forward of model (SEXLNet, on the CPU or GPU) into filename and save its metadata
+    (see metadata_filename)
+
+    Args:
+        graph_format (str): torchscript (torch.jit.trace) or onnx (torch.onnx.export, the graph
+            can be run with onnxruntime)
+        check (bool): compare the outputs of the graph with those of model on inputs of another
+            shape than the traced ones (requires onnxruntime for onnx)
+    Return:
+        dict: metadata
+    """
+    if graph_format not in GRAPH_FORMATS:
+        raise ValueError(f"unknown graph format '{graph_format}', should be one of {list(GRAPH_FORMATS)}")
+    if graph_format == "onnx" and is_quantized(model):
+        raise ValueError("dynamically quantized models cannot be exported to onnx")
+    model.eval()
+    # the approximate concept index is not traceable, the graph uses the exact search
+    concept_index = model.concept_index
+    if concept_index is not None:
+        logging.warning("the exported graph uses the exact GIL search, not the concept index")
+    model.concept_index = None
+    graph = SelfExplainGraph(model)
+    inputs = example_inputs(model)
+    try:
+        with torch.no_grad():
+            if graph_format == "torchscript":
+                traced = torch.jit.trace(graph, inputs, check_trace=False)
+                traced.save(filename)
+            else:
+                torch.onnx.export(graph, inputs, filename, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                                  dynamic_axes=DYNAMIC_AXES, opset_version=opset_version, do_constant_folding=True,
+                                  **onnx_export_kwargs())
+        metadata = dict(format=graph_format, model_name=model.hparams.model_name,
+                        num_classes=int(model.hparams.num_classes), topk=model.topk, lamda=model.lamda,
+                        gamma=model.gamma, num_concepts=model.concept_store.size(0), quantized=is_quantized(model),
+                        input_names=INPUT_NAMES, output_names=OUTPUT_NAMES, torch_version=torch.__version__)
+        with open(metadata_filename(filename), "w") as handle:
+            json.dump(metadata, handle, indent=2)
+        if check:
+            if graph_format == "onnx" and not onnxruntime_available():
+                logging.warning(f"onnxruntime is not installed, {filename} is not checked")
+            else:
+                metadata["check"] = check_graph(filename, model, example_inputs(model, 3, 23, 6, seed=1))
+                logging.info(f"checked {filename}: {metadata['check']}")
+                with open(metadata_filename(filename), "w") as handle:
+                    json.dump(metadata, handle, indent=2)
+    finally:
+        model.concept_index = concept_index
+    return metadata
+
+
+def onnxruntime_available() -> bool:
+    try:
+        import onnxruntime
+        return True
+    except ImportError:
+        return False
@@ -1,28 +1,31 @@
 import os
+import csv
 import json
 import logging
-from operator import itemgetter
+import itertools
 
 import torch
 import numpy as np
 from pytorch_lightning import Trainer
 from tqdm import tqdm
-import pandas as pd
 import resource
 from argparse import ArgumentParser
 
 from .SE_XLNet import SEXLNet
 from .data import ClassificationData
+from .dataset_cache import read_datapoints
 from .devices import get_gpus
 
 
-def load_model(ckpt, batch_size, gpus=1):
+def load_model(ckpt, batch_size, gpus=1, max_tokens=None, dataset_basedir=None):
     model = SEXLNet.load_from_checkpoint(ckpt)
     model.eval()
     # return number of gpus available, i.e. min(available_gpus, requested_gpus)
     gpus = get_gpus(gpus)
     trainer = Trainer(gpus=gpus)
-    dm = ClassificationData(basedir=model.hparams.dataset_basedir, tokenizer_name=model.hparams.model_name, batch_size=batch_size)
+    # dataset_basedir overrides the dataset folder of the checkpoint
+    dm = ClassificationData(basedir=dataset_basedir or model.hparams.dataset_basedir, tokenizer_name=model.hparams.model_name, batch_size=batch_size,
+                            max_tokens=max_tokens, sparse_lil=getattr(model.hparams, "sparse_lil", False))
     return model, trainer, dm
 
 
@@ -35,80 +38,199 @@ def load_dev_examples(file_name):
     return dev_samples
 
 
-def evaluate(model, dataloader, concept_map, dev_file, paths_output_loc: str = None):
-    dev_samples = load_dev_examples(dev_file)
-    total_evaluated = 0.
-    total_correct = 0.
-    i = 0
-    predicted_labels, true_labels, gil_overall, lil_overall = [], [], [], []
-    accs = []
-    y_true = []
-    y_pred = []
-    with torch.no_grad():
-        for batch in tqdm(dataloader, total=len(dataloader)):
-            input_tokens, token_type_ids, nt_idx_matrix, labels = batch
-            logits, acc, interpret_dict_list = model(batch)
-            #print(f"labels.shape={labels.shape}, logits.shape={logits.shape}")
-            gil_interpretations = gil_interpret(concept_map=concept_map,
-                                                list_of_interpret_dict=interpret_dict_list)
-            lil_interpretations = lil_interpret(logits=logits,
-                                                list_of_interpret_dict=interpret_dict_list,
-                                                dev_samples=dev_samples,
-                                                current_idx=i)
-            y_true.extend(labels.tolist())
-            output = torch.softmax(logits, dim=1).numpy()
-            y_pred.extend(output[:,1])
-
-            accs.append(acc)
-            batch_predicted_labels = torch.argmax(logits, -1)
-            predicted_labels.extend(batch_predicted_labels.tolist())
-
-            true_labels.extend(labels.tolist())
-            gil_overall.extend(gil_interpretations)
-            lil_overall.extend(lil_interpretations)
-
-            total_evaluated += len(batch)
-            total_correct += (acc.item() * len(batch))
-            logging.info(f"accuracy = {round((total_correct * 100) / (total_evaluated), 2)}, Batch accuracy = {round(acc.item(), 2)}")
-            i += input_tokens.size(0)
-        accuracy = total_correct/total_evaluated
-        print(f"accuracy = {round((total_correct * 100) / (total_evaluated), 2)}")
-        print(f"accuracy = {round(np.array(accs).mean(), 2)}")
-
-    print(f"saving to results.npz")
-    np.savez("results.npz", y_true=np.array(y_true), y_pred=np.array(y_pred))
-    if not os.path.exists(os.path.dirname(paths_output_loc)):
-        os.makedirs(os.path.dirname(paths_output_loc))
-    pd.DataFrame({"predicted_labels": predicted_labels, "true_labels": true_labels, "lil_interpretations": lil_overall,
-                  "gil_interpretations": gil_overall}).to_csv(paths_output_loc, sep="\t", index=None)
+class EvaluationWriter(object):
+    """ Write evaluation rows (see COLUMNS) to a JSONL or TSV file as they are produced, one batch 
+    at a time (flushed after each batch). With resume=True, the rows of an existing file are kept 
+    (a partially written last line is dropped) and num_rows tells where to continue.
+    """
+    COLUMNS = ["index", "predicted_labels", "true_labels", "score", "lil_interpretations", "gil_interpretations",
+               "explain"]
+
+    def __init__(self, filename, output_format=None, resume=False):
+        self.filename = filename
+        self.output_format = output_format or ("jsonl" if filename.endswith((".jsonl", ".json")) else "tsv")
+        if self.output_format not in ("jsonl", "tsv"):
+            raise ValueError(f"unknown output format {self.output_format}, should be jsonl or tsv")
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.num_rows = 0
+        if resume and os.path.exists(filename):
+            self.num_rows = self.truncate_to_last_line()
+            self.handle = open(filename, "a", newline="")
+        else:
+            self.handle = open(filename, "w", newline="")
+        self.writer = csv.writer(self.handle, delimiter="\t") if self.output_format == "tsv" else None
+        if self.writer is not None and os.path.getsize(filename) == 0:
+            self.writer.writerow(self.COLUMNS)
+            self.handle.flush()
+        if self.num_rows:
+            print(f"resuming {filename} after {self.num_rows} rows")
+
+    def truncate_to_last_line(self) -> int:
+        """ Drop a partially written last line and return the number of rows in the file
+        """
+        num_lines, size = 0, 0
+        with open(self.filename, "rb") as handle:
+            for line in handle:
+                if not line.endswith(b"\n"):
+                    break
+                num_lines += 1
+                size += len(line)
+        with open(self.filename, "r+b") as handle:
+            handle.truncate(size)
+        return num_lines - 1 if self.output_format == "tsv" and num_lines else num_lines
+
+    def write(self, rows):
+        for row in rows:
+            if self.writer is not None:
+                # interpretations as Python literals (the format written by pandas before)
+                self.writer.writerow([row[key] if key in ("index", "predicted_labels", "true_labels", "score", "explain")
+                                      else ("" if row[key] is None else str(row[key])) for key in self.COLUMNS])
+            else:
+                self.handle.write(json.dumps(row) + "\n")
+        self.handle.flush()
+        self.num_rows += len(rows)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_scores(filename, output_format=None) -> dict:
+    """ Predicted labels, true labels, scores (probability of label 1) and explain modes of an 
+    evaluation file (see EvaluationWriter) as arrays
+    """
+    output_format = output_format or ("jsonl" if filename.endswith((".jsonl", ".json")) else "tsv")
+    columns = dict(predicted_labels=(int, []), true_labels=(int, []), score=(float, []), explain=(str, []))
+    with open(filename, "r", newline="") as handle:
+        rows = csv.DictReader(handle, delimiter="\t") if output_format == "tsv" else map(json.loads, handle)
+        for row in rows:
+            # files written before the explain column were evaluated with full
+            row.setdefault("explain", "full")
+            for key, (convert, values) in columns.items():
+                values.append(convert(row[key]))
+    return {key: np.array(values) for key, (_, values) in columns.items()}
+
+
+def evaluate(model, dm, filename, concept_map, paths_output_loc: str, gil_k=10, lil_k=5, explain="full", 
+             output_format=None, resume=False):
+    """ Evaluate model on filename (*_with_parse.json in dm.basedir) in file order and write a row 
+    per sample to paths_output_loc (JSONL or TSV, see EvaluationWriter) as the batches are 
+    processed, so memory does not grow with the size of the split. explain selects the 
+    interpretations (see SEXLNet.forward), the others are left empty. With resume=True, the 
+    samples already in paths_output_loc are skipped (they should have been evaluated with the same 
+    explain mode, as the scores without LIL differ slightly).
+
+    Return:
+        y_true, y_pred: true labels and scores (probability of label 1) of all the samples
+    """
+    dev_file = os.path.join(dm.basedir, filename)
+    explain = "full" if explain is True else explain
+    explain_name = explain or "none"
+    with EvaluationWriter(paths_output_loc, output_format=output_format, resume=resume) as writer:
+        start = writer.num_rows
+        if start:
+            previous = set(read_scores(paths_output_loc, output_format=writer.output_format)["explain"].tolist())
+            if previous != {explain_name}:
+                raise ValueError(f"cannot resume {paths_output_loc} with explain={explain_name}, it was evaluated "
+                                 f"with {sorted(previous)}")
+        dataloader = dm.ordered_dataloader(filename, start=start)
+        # parse trees are read along with the batches (they are only needed for LIL)
+        need_samples = explain in ("lil", "full")
+        dev_samples = itertools.islice(read_datapoints(dev_file), start, None) if need_samples else None
+        total_evaluated = total_correct = 0
+        with torch.no_grad():
+            for batch in tqdm(dataloader, total=len(dataloader)):
+                input_tokens, token_type_ids, nt_idx_matrix, labels = batch
+                batch_size = input_tokens.size(0)
+                logits, acc, interpret_dict_list = model(batch, explain=explain)
+                gil_interpretations = lil_interpretations = [None] * batch_size
+                if "topk_indices" in interpret_dict_list:
+                    gil_interpretations = gil_interpret(concept_map=concept_map,
+                                                        list_of_interpret_dict=interpret_dict_list,
+                                                        k=gil_k)
+                if "lil_logits" in interpret_dict_list:
+                    batch_samples = list(itertools.islice(dev_samples, batch_size))
+                    if len(batch_samples) != batch_size:
+                        raise RuntimeError(f"{dev_file} has fewer samples than its compiled dataset")
+                    lil_interpretations = lil_interpret(logits=logits,
+                                                        list_of_interpret_dict=interpret_dict_list,
+                                                        dev_samples=batch_samples,
+                                                        current_idx=0,
+                                                        k=lil_k)
+                predicted_labels = torch.argmax(logits, -1)
+                scores = torch.softmax(logits, dim=1)[:, 1].tolist()
+                index = start + total_evaluated
+                writer.write([dict(index=index + j, predicted_labels=predicted, true_labels=label, score=score, 
+                                   lil_interpretations=lil, gil_interpretations=gil, explain=explain_name)
+                              for j, (predicted, label, score, lil, gil) in enumerate(zip(
+                                  predicted_labels.tolist(), labels.tolist(), scores, lil_interpretations, 
+                                  gil_interpretations))])
+
+                total_evaluated += batch_size
+                total_correct += int((predicted_labels == labels).sum())
+                logging.info(f"accuracy = {round((total_correct * 100) / (total_evaluated), 2)}, Batch accuracy = {round(acc.item(), 2)}")
+
+    results = read_scores(paths_output_loc, output_format=writer.output_format)
+    y_true, y_pred = results["true_labels"], results["score"]
+    print(f"saved {len(y_true)} rows to {paths_output_loc}")
+    if len(y_true):
+        print(f"accuracy = {round(100 * float((results['predicted_labels'] == y_true).mean()), 2)}")
     return y_true, y_pred
 
 
-def gil_interpret(concept_map, list_of_interpret_dict):
-    batch_concepts = []
-    for topk_concepts in list_of_interpret_dict["topk_indices"]:
-        concepts = [concept_map[x] for x in topk_concepts.tolist()][:10]
-        batch_concepts.append(concepts)
-    return batch_concepts
-
-
-def lil_interpret(logits, list_of_interpret_dict, dev_samples, current_idx):
-    sf_logits = torch.softmax(logits, dim=1).tolist()
-    lil_sf_logits = torch.softmax(list_of_interpret_dict["lil_logits"], dim=-1).tolist()
-
-    lil_outputs = []
-    for idx, (sf_item, lil_sf_item) in enumerate(zip(sf_logits, lil_sf_logits)):
-        dev_sample = dev_samples[current_idx + idx]
-        lil_dict = {}
-        argmax_sf, _ = max(enumerate(sf_item), key=itemgetter(1))
-        for phrase_idx, phrase in enumerate(dev_sample["parse_tree"]):
-            phrase_logits = lil_sf_logits[idx][phrase_idx]
-            relevance_score = phrase_logits[argmax_sf] - sf_item[argmax_sf]
-            if phrase_idx != 0:
-                lil_dict[phrase["phrase"]] = relevance_score
-        lil_dict = sorted(lil_dict.items(), key=lambda item: item[1], reverse=True)[:5]
-        lil_outputs.append(lil_dict)
-    return lil_outputs
+def gil_interpret(concept_map, list_of_interpret_dict, k=10):
+    """ Phrases of the k top concepts of each sample (topk_indices are sorted by score)
+    """
+    topk_indices = list_of_interpret_dict["topk_indices"][:, :k].tolist()
+    return [[concept_map[x] for x in indices] for indices in topk_indices]
+
+
+def lil_relevance(logits, lil_logits, phrase_mask):
+    """ Relevance of each phrase for the predicted label: softmax of its LIL logits minus the softmax
+    of the sentence logits, -inf where phrase_mask is False (e.g. padding phrases).
+
+    Return:
+        tensor: (batch_size, max_phrases) relevance scores (float64)
+    """
+    sf_logits = torch.softmax(logits, dim=1)
+    predicted = torch.argmax(sf_logits, dim=1)
+    sf_predicted = sf_logits.gather(1, predicted.unsqueeze(1)).double()
+    lil_sf_logits = torch.softmax(lil_logits, dim=-1)
+    index = predicted.view(-1, 1, 1).expand(-1, lil_sf_logits.size(1), 1)
+    relevance = lil_sf_logits.gather(2, index).squeeze(2).double() - sf_predicted
+    return relevance.masked_fill(~phrase_mask, float("-inf"))
+
+
+def lil_interpret(logits, list_of_interpret_dict, dev_samples, current_idx, k=5):
+    """ k most relevant phrases (and their relevance) of each sample. The first phrase (the whole 
+    sentence) is skipped and a phrase that appears several times in the parse tree is scored by its 
+    last occurrence.
+    """
+    lil_logits = list_of_interpret_dict["lil_logits"]
+    batch_size, max_phrases = lil_logits.size(0), lil_logits.size(1)
+    samples = dev_samples[current_idx:current_idx + batch_size]
+    phrases = [[leaf["phrase"] for leaf in sample["parse_tree"]] for sample in samples]
+    # position of the last occurrence of every phrase of each sample
+    rows, positions = [], []
+    for row, sample_phrases in enumerate(phrases):
+        last = {phrase: i for i, phrase in enumerate(sample_phrases) if i > 0}
+        rows.extend([row] * len(last))
+        positions.extend(last.values())
+    phrase_mask = torch.zeros(batch_size, max_phrases, dtype=torch.bool, device=lil_logits.device)
+    phrase_mask[rows, positions] = True
+
+    relevance = lil_relevance(logits, lil_logits, phrase_mask)
+    top_scores, top_indices = torch.topk(relevance, k=min(k, max_phrases), dim=1)
+    top_scores, top_indices = top_scores.tolist(), top_indices.tolist()
+    return [[(sample_phrases[i], score) for i, score in zip(indices, scores) if score != float("-inf")]
+            for sample_phrases, indices, scores in zip(phrases, top_indices, top_scores)]
 
 
 def load_concept_map(concept_map_path):
@@ -9,6 +9,7 @@ from typing import List
 
 from overrides import overrides
 import torch
+import torch.nn as nn
 
 
 class TimeDistributed(torch.nn.Module):
@@ -70,4 +71,35 @@ class TimeDistributed(torch.nn.Module):
         # Squash batch_size and time_steps into a single axis; result has shape
         # (batch_size * time_steps, **input_size).
         squashed_shape = [-1] + list(input_size[2:])
-        return input_tensor.contiguous().view(*squashed_shape)
\ No newline at end of file
+        return input_tensor.contiguous().view(*squashed_shape)
+
+
+def encoder_kwargs(config) -> dict:
+    """ Encoder arguments so that only the last hidden state is returned (XLNet also returns the 
+    hidden state of every layer as mems in eval mode by default)
+    """
+    return dict(use_mems=False) if config.model_type == "xlnet" else {}
+
+
+def encoder_layers(encoder) -> nn.ModuleList:
+    """ Layers of an XLNet (layer) or BERT-like (encoder.layer) encoder
+    """
+    if isinstance(getattr(encoder, "layer", None), nn.ModuleList):
+        return encoder.layer
+    if isinstance(getattr(getattr(encoder, "encoder", None), "layer", None), nn.ModuleList):
+        return encoder.encoder.layer
+    raise NotImplementedError(f"cannot find the layers of {type(encoder).__name__}")
+
+
+def truncate_encoder(encoder, num_layers: int):
+    """ Keep the num_layers lower layers of encoder (and update its config)
+    """
+    layers = encoder_layers(encoder)
+    if num_layers < 1 or num_layers > len(layers):
+        raise ValueError(f"num_layers={num_layers} should be between 1 and {len(layers)}")
+    del layers[num_layers:]
+    if hasattr(encoder.config, "n_layer"):
+        encoder.config.n_layer = num_layers
+    else:
+        encoder.config.num_hidden_layers = num_layers
+    return encoder
@@ -0,0 +1,41 @@
+""" Dynamic int8 quantization for CPU inference: the weights of the nn.Linear layers are stored
+as int8 and activations are quantized on the fly (torch.quantization.quantize_dynamic).
+
+This covers the encoder feed-forward layers (and the attention projections of encoders that use
+nn.Linear, e.g. RoBERTa), the sequence summaries, classifier, phrase_logits and topk_gil_mlp.
+The attention projections of XLNet are parameters used in einsum and the output projection of
+nn.MultiheadAttention is excluded by torch, they stay in float32.
+"""
+import io
+import logging
+
+import torch
+import torch.nn as nn
+
+QUANTIZED_MODULES = {nn.Linear}
+
+
+def quantize_model(model: nn.Module, dtype=torch.qint8) -> nn.Module:
+    """ Quantize the linear layers of model in place (on the CPU, in eval mode)
+    """
+    if any(parameter.is_cuda for parameter in model.parameters()):
+        raise RuntimeError("dynamic quantization is only supported on the CPU")
+    model.eval()
+    num_linear = sum(type(module) in QUANTIZED_MODULES for module in model.modules())
+    # in place, so that buffers (e.g. a memory-mapped concept store) are not copied
+    torch.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=dtype, inplace=True)
+    logging.info(f"quantized {num_linear} linear layers to {dtype}")
+    return model
+
+
+def is_quantized(model: nn.Module) -> bool:
+    return any(type(module).__module__.startswith(("torch.nn.quantized", "torch.ao.nn.quantized"))
+               for module in model.modules())
+
+
+def state_dict_size(state_dict: dict) -> int:
+    """ Size (bytes) of state_dict saved with torch.save
+    """
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    return buffer.tell()
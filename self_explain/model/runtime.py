@@ -0,0 +1,76 @@
+""" Scoring with a graph exported by export.py (TorchScript or ONNX), without pytorch_lightning or
+transformers: this module only imports torch (and onnxruntime for ONNX graphs).
+"""
+import json
+from argparse import Namespace
+
+import numpy as np
+import torch
+
+
+class SelfExplainRuntime(object):
+    """ Run an exported SelfExplain graph. forward takes the batches of MyCollator (with dense
+    phrase matrices) and returns the same outputs as SEXLNet.forward with explain="full", so that
+    the runtime can replace the model (e.g. in SelfExplainCharacterizer with use_graph=True).
+    """
+    def __init__(self, filename: str, device: str = "cpu", num_threads: int = None):
+        """
+        Args:
+            filename (str): graph exported by export_graph, its metadata is read from filename.json
+            device (str): device of a TorchScript graph (ONNX graphs run on the CPU)
+            num_threads (int): number of intra-op threads (default: torch/onnxruntime default)
+        """
+        with open(f"{filename}.json", "r") as handle:
+            self.metadata = json.load(handle)
+        self.filename = filename
+        self.format = self.metadata["format"]
+        self.device = torch.device(device)
+        # used by SelfExplainCharacterizer (tokenizer and collator)
+        self.hparams = Namespace(model_name=self.metadata["model_name"], num_classes=self.metadata["num_classes"],
+                                 topk=self.metadata["topk"], sparse_lil=False)
+        if self.format == "torchscript":
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.graph = torch.jit.load(filename, map_location=self.device)
+            self.graph.eval()
+        elif self.format == "onnx":
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(filename, options, providers=["CPUExecutionProvider"])
+        else:
+            raise ValueError(f"unknown graph format '{self.format}' in {filename}.json")
+
+    def eval(self):
+        return self
+
+    def score(self, tokens: torch.Tensor, tokens_mask: torch.Tensor, nt_idx_matrix: torch.Tensor) -> tuple:
+        """ Return:
+            logits (batch_size, num_classes), lil_logits (batch_size, num_phrases, num_classes)
+            and topk_indices (batch_size, topk) of the concepts
+        """
+        if self.format == "torchscript":
+            with torch.no_grad():
+                return tuple(self.graph(tokens.to(self.device), tokens_mask.to(self.device),
+                                        nt_idx_matrix.to(self.device)))
+        inputs = dict(zip(self.metadata["input_names"],
+                          [tokens.cpu().numpy().astype(np.int64), tokens_mask.cpu().numpy().astype(np.int64),
+                           nt_idx_matrix.cpu().numpy().astype(np.float32)]))
+        return tuple(torch.from_numpy(output) for output in self.session.run(self.metadata["output_names"], inputs))
+
+    def forward(self, batch, explain="full"):
+        """ Same as SEXLNet.forward, the graph always runs LIL and GIL (explain=full)
+        """
+        if explain not in ("full", True):
+            raise ValueError(f"the exported graph {self.filename} only supports explain=full, not {explain}")
+        tokens, tokens_mask, nt_idx_matrix, labels = batch
+        if isinstance(nt_idx_matrix, dict):
+            raise ValueError("the exported graph takes dense phrase matrices (sparse_lil=False)")
+        logits, lil_logits, topk_indices = self.score(tokens, tokens_mask, nt_idx_matrix)
+        acc = None
+        if labels is not None:
+            acc = torch.true_divide((torch.argmax(logits, -1) == labels.to(logits.device)).sum(), labels.shape[0])
+        return logits, acc, dict(lil_logits=lil_logits, topk_indices=topk_indices)
+
+    __call__ = forward
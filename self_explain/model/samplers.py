@@ -0,0 +1,119 @@
+""" Batch samplers that reduce padding: examples of similar token length and phrase count are
+batched together (bucketing) and batches can be limited by the number of padded tokens.
+"""
+from typing import List
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def token_budget_batches(indices, token_lengths, batch_size=None, max_tokens=None) -> List[List[int]]:
+    """ Split indices (in order) into batches of at most batch_size examples whose padded size
+    (number of examples x longest example) is at most max_tokens
+    """
+    batches = []
+    batch, batch_max_len = [], 0
+    for i in indices:
+        length = int(token_lengths[i])
+        max_len = max(batch_max_len, length)
+        full = batch_size is not None and len(batch) >= batch_size
+        over_budget = max_tokens is not None and (len(batch) + 1) * max_len > max_tokens
+        if len(batch) and (full or over_budget):
+            batches.append(batch)
+            batch, max_len = [], length
+        batch.append(int(i))
+        batch_max_len = max_len
+    if len(batch):
+        batches.append(batch)
+    return batches
+
+
+def padding_efficiency(batches, token_lengths, phrase_counts=None) -> dict:
+    """ Fraction of real (not padded) entries in the token tensors and phrase matrices of batches
+    """
+    real_tokens = padded_tokens = real_phrases = padded_phrases = 0
+    for batch in batches:
+        lengths = np.asarray(token_lengths)[batch]
+        real_tokens += lengths.sum()
+        padded_tokens += len(batch) * lengths.max()
+        if phrase_counts is not None:
+            counts = np.asarray(phrase_counts)[batch]
+            real_phrases += (counts * lengths).sum()
+            padded_phrases += len(batch) * counts.max() * lengths.max()
+    efficiency = dict(tokens=float(real_tokens / max(padded_tokens, 1)))
+    if phrase_counts is not None:
+        efficiency["phrases"] = float(real_phrases / max(padded_phrases, 1))
+    return efficiency
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler for ClassificationDataset.
+
+    If shuffle is set, the examples are shuffled, split into pools of bucket_size examples, sorted
+    by (token length, phrase count) within each pool and batched, and the batches are shuffled.
+    Otherwise the examples are batched in order (e.g. for evaluation, where outputs have to line up
+    with the file). Batches have at most batch_size examples and, if max_tokens is set, at most
+    max_tokens padded tokens.
+
+    The batches of each epoch are split between distributed processes (if torch.distributed is
+    initialized), so the trainer should not replace the sampler (replace_sampler_ddp=False). Every
+    process gets the same number of batches (the logged metrics are synchronized at every step): when
+    training (shuffle) the remaining batches are dropped, otherwise the first batches are repeated
+    to pad the list, as DistributedSampler does (a few examples are evaluated twice).
+    """
+    def __init__(self, token_lengths, phrase_counts=None, batch_size=None, max_tokens=None, shuffle=True,
+                 bucket_size=None, seed=0):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("batch_size or max_tokens should be specified")
+        self.token_lengths = np.asarray(token_lengths)
+        self.phrase_counts = np.zeros_like(self.token_lengths) if phrase_counts is None else np.asarray(phrase_counts)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size if bucket_size is not None else 100 * (batch_size or 32)
+        self.seed = seed
+        self.epoch = 0
+        self._batches = (None, None)
+
+    def make_batches(self, epoch) -> List[List[int]]:
+        indices = np.arange(len(self.token_lengths))
+        if not self.shuffle:
+            return token_budget_batches(indices, self.token_lengths, self.batch_size, self.max_tokens)
+        rng = np.random.RandomState(self.seed + epoch)
+        indices = rng.permutation(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            pool = indices[start:start + self.bucket_size]
+            pool = pool[np.lexsort((self.phrase_counts[pool], self.token_lengths[pool]))]
+            batches.extend(token_budget_batches(pool, self.token_lengths, self.batch_size, self.max_tokens))
+        order = rng.permutation(len(batches))
+        return [batches[i] for i in order]
+
+    def batches(self, epoch) -> List[List[int]]:
+        """ Batches of epoch for this process
+        """
+        if self._batches[0] != epoch:
+            batches = self.make_batches(epoch)
+            if dist.is_available() and dist.is_initialized():
+                num_replicas, rank = dist.get_world_size(), dist.get_rank()
+                # every process gets the same number of batches
+                if self.shuffle:
+                    batches = batches[:len(batches) - len(batches) % num_replicas]
+                else:
+                    batches = batches + batches[:(-len(batches)) % num_replicas]
+                batches = batches[rank::num_replicas]
+            self._batches = (epoch, batches)
+        return self._batches[1]
+
+    def padding_efficiency(self, epoch=None) -> dict:
+        batches = self.batches(self.epoch if epoch is None else epoch)
+        return padding_efficiency(batches, self.token_lengths, self.phrase_counts)
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self.batches(self.epoch))
@@ -1,82 +1,397 @@
+import os
+import glob
+import time
 import logging
 import json
-from collections import OrderedDict, Counter
+import multiprocessing
+from collections import Counter
 
+import numpy as np
 import tqdm
-import spacy
 import torch
 from transformers import AutoTokenizer, AutoModel, RobertaConfig, XLNetConfig
 from transformers.modeling_utils import SequenceSummary
 
-from .utils import chunks
+from .utils import chunks, load_sentence_nlp
+from ..model.concept_store import ConceptStoreWriter, load_concept_store, is_raw_concept_store, read_header
+from ..model.dataset_cache import file_hash
 
 config_dict = {'xlnet-base-cased': XLNetConfig,
                'roberta-base': RobertaConfig}
 
-def concept_store(model_name, input_file_name, output_folder, max_concept_length, batch_size=8, use_sentence=False):
+# inputs folded into the concept store of a folder (see update_concept_store)
+MANIFEST = "concept_manifest.json"
+# phrases merged into other concepts by compress_concept_store, they are not new concepts
+MERGED = "concept_merged.json"
+# number of occurrences of every concept in the inputs (also the concepts below min_frequency)
+FREQUENCIES = "concept_frequency.json"
+
+def concept_store_filename(output_folder) -> str:
+    """ Concept store in output_folder (concept_store.bin, or concept_store.pt built by older versions)
+    """
+    filename = f'{output_folder}/concept_store.bin'
+    legacy_filename = f'{output_folder}/concept_store.pt'
+    return legacy_filename if not os.path.exists(filename) and os.path.exists(legacy_filename) else filename
+
+
+def get_device(device=None, num_threads=None) -> torch.device:
+    """ Device to embed the concepts on (cuda if available by default), num_threads sets the 
+    number of CPU threads
+    """
+    device = torch.device(device if device is not None else "cuda" if torch.cuda.is_available() else "cpu")
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if device.type == "cpu":
+        print(f"embedding concepts on the CPU with {torch.get_num_threads()} threads")
+    return device
+
+
+def embed_concepts(concepts, model_name, filename, batch_size=256, device=None, num_threads=None, dtype="float32"):
+    """ Embed concepts (list of phrases) with model_name and write them to the raw concept store 
+    filename, row i is concepts[i]. Concepts are batched by token length to reduce padding. 
+    """
+    device = get_device(device, num_threads=num_threads)
     tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name).to('cuda')
+    model = AutoModel.from_pretrained(model_name).to(device)
     model.eval()
     config = config_dict[model_name]
     sequence_summary = SequenceSummary(config)
 
-    # initialize spacy 
-    nlp = spacy.load("en_core_web_sm")
+    lengths = [len(input_ids) for input_ids in tokenizer(concepts)["input_ids"]]
+    order = np.argsort(lengths, kind="stable")
+    batches = list(chunks(order, n=batch_size))
+    start = time.time()
+    with torch.no_grad(), ConceptStoreWriter(filename, dim=model.config.hidden_size, dtype=dtype, model_name=model_name, 
+                                             num_rows=len(concepts)) as writer:
+        progress = tqdm.tqdm(batches, desc="building concepts", unit="batch")
+        done = 0
+        for batch in progress:
+            inputs = tokenizer([concepts[i] for i in batch], padding=True, return_tensors="pt")
+            inputs = {key: value.to(device) for key, value in inputs.items()}
+            outputs = model(**inputs)
+            pooled_rep = sequence_summary(outputs[0])
+            writer.write_rows(batch, pooled_rep)
+            done += len(batch)
+            progress.set_postfix(concepts_per_s=f"{done / (time.time() - start):.0f}")
+    elapsed = time.time() - start
+    print(f"embedded {len(concepts)} concepts in {elapsed:.1f}s ({len(concepts) / max(elapsed, 1e-9):.0f} concepts/s) "
+          f"on {device}, batch_size={batch_size}")
 
-    concept_set = set()
 
-    total = 0
-    with open(input_file_name, 'r') as input_file:
-        total = sum(1 for line in input_file)
-    print(f"found {total} lines in {input_file_name}")
+def byte_ranges(input_file_name, chunk_size):
+    """ Split input_file_name into (start, end) byte ranges of about chunk_size bytes that start 
+    and end at line boundaries
+    """
+    size = os.path.getsize(input_file_name)
+    boundaries = [0]
+    with open(input_file_name, 'rb') as input_file:
+        while boundaries[-1] < size:
+            input_file.seek(min(boundaries[-1] + chunk_size, size))
+            input_file.readline()
+            boundaries.append(min(input_file.tell(), size))
+    return list(zip(boundaries[:-1], boundaries[1:]))
 
-    logging.info(f"loading input from {input_file_name}")
-    sentence_lengths = Counter()
-    with open(input_file_name, 'r') as input_file:
-        for i, line in enumerate(tqdm.tqdm(input_file, total=total, desc="loading concepts")):
+
+# spaCy pipeline of extraction worker processes (loaded on first use)
+_nlp = None
+
+
+def _extract_range(task) -> Counter:
+    """ Count the concepts of the lines of a byte range (in the order they first appear)
+    """
+    global _nlp
+    input_file_name, start, end, max_concept_length, use_sentence, nlp_batch_size = task
+    phrase_labels = ["NP", "VP",]
+    counts = Counter()
+    texts = []
+    with open(input_file_name, 'rb') as input_file:
+        input_file.seek(start)
+        while input_file.tell() < end:
+            line = input_file.readline()
+            if not line.strip():
+                continue
             json_line = json.loads(line)
             if use_sentence:
                 # sentence is actually the full text
-                text = json_line["sentence"].strip().strip(' .')
-                doc = nlp(text)
-                for sentence in doc.sents:
-                    sentence = sentence.text
-                    sentence_length = len(sentence.split())
-                    sentence_lengths.update([sentence_length,])
-
-                    if len(sentence.split()) <= max_concept_length:
-                        concept_set.add()
+                texts.append(json_line["sentence"].strip().strip(' .'))
             else:
-                phrase_labels = ["NP", "VP",]
                 for leaf in json_line["parse_tree"]:
                     if leaf["phrase_label"] in phrase_labels:
                         phrase = leaf["phrase"].lower()
                         phrase_len = len(phrase.split())
                         if phrase_len < max_concept_length:
-                            concept_set.add(phrase)
+                            counts[phrase] += 1
+    if use_sentence:
+        if _nlp is None:
+            _nlp = load_sentence_nlp()
+        for doc in _nlp.pipe(texts, batch_size=nlp_batch_size):
+            for sentence in doc.sents:
+                sentence = sentence.text.lower()
+                if len(sentence.split()) <= max_concept_length:
+                    counts[sentence] += 1
+    return counts
 
 
-    concept_idx = {i: value for i, value in enumerate(concept_set)}
-    print(f"mapped {total} inputs to {len(concept_set)} concepts.")
+def extract_concepts(input_file_names, max_concept_length, use_sentence=False, workers=1, chunk_size=None, 
+                     nlp_batch_size=256) -> Counter:
+    """ Count the concepts (NP/VP phrases shorter than max_concept_length, lower case, or the 
+    sentences of at most max_concept_length words with use_sentence) of input_file_names. 
+    The files are split into byte ranges of chunk_size bytes (by default about 4 ranges per worker, 
+    at most 64MB) that are processed by workers processes. Concepts are in the order they first 
+    appear in the input.
+    """
+    tasks = []
+    for input_file_name in input_file_names:
+        logging.info(f"loading input from {input_file_name}")
+        size = chunk_size or min(1 << 26, os.path.getsize(input_file_name) // (4 * workers) + 1)
+        tasks.extend((input_file_name, start, end, max_concept_length, use_sentence, nlp_batch_size)
+                     for start, end in byte_ranges(input_file_name, chunk_size=size))
+    counts = Counter()
+    start_time = time.time()
+    total_bytes = sum(task[2] - task[1] for task in tasks)
+    with tqdm.tqdm(total=total_bytes, unit="B", unit_scale=True, desc="loading concepts") as progress:
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                # imap keeps the order of the ranges so that the concept order is deterministic
+                for task, range_counts in zip(tasks, pool.imap(_extract_range, tasks)):
+                    counts.update(range_counts)
+                    progress.update(task[2] - task[1])
+        else:
+            for task in tasks:
+                counts.update(_extract_range(task))
+                progress.update(task[2] - task[1])
+    elapsed = time.time() - start_time
+    print(f"found {len(counts)} distinct concepts ({sum(counts.values())} occurrences) in {', '.join(input_file_names)} "
+          f"in {elapsed:.1f}s with {workers} worker(s)")
+    return counts
 
-    num_batches = len(concept_idx)//batch_size
-    concept_tensor = []
-    for batch in tqdm.tqdm(chunks(list(concept_idx.values()), n=batch_size), desc="building concepts", total=num_batches):
-        inputs = tokenizer(batch, padding=True, return_tensors="pt")
-        for key, value in inputs.items():
-            inputs[key] = value.to('cuda')
-        outputs = model(**inputs)
-        pooled_rep = sequence_summary(outputs[0])
-        concept_tensor.append(pooled_rep.detach().cpu())
 
-    concept_tensor = torch.cat(concept_tensor, dim=0)
+def ngram_statistics(counts: Counter) -> str:
+    """ Number of distinct concepts and occurrences by number of words
+    """
+    distinct, occurrences = Counter(), Counter()
+    for phrase, count in counts.items():
+        length = len(phrase.split())
+        distinct[length] += 1
+        occurrences[length] += count
+    return "\n".join(f"  {length}-grams: {distinct[length]} distinct, {occurrences[length]} occurrences"
+                     for length in sorted(distinct))
 
-    filename = f'{output_folder}/concept_store.pt'
-    print(f"saving concept_tensor in {filename}")
-    torch.save(concept_tensor, filename)
 
-    with open(f'{output_folder}/concept_idx.json', 'w') as out_file:
-        json.dump(concept_idx, out_file, indent=2)
+def frequent_concepts(counts: Counter, min_frequency=1, exclude=()) -> list:
+    """ Concepts of counts (in order) that occur at least min_frequency times and are not in exclude
+    """
+    concepts = [phrase for phrase, count in counts.items() if count >= min_frequency and phrase not in exclude]
+    rare = sum(1 for phrase, count in counts.items() if count < min_frequency and phrase not in exclude)
+    if min_frequency > 1:
+        print(f"skipping {rare} concepts that occur less than {min_frequency} times")
+    return concepts
+
+
+def load_frequencies(output_folder) -> Counter:
+    """ Concept frequencies of the inputs of the concept store in output_folder
+    """
+    filename = f'{output_folder}/{FREQUENCIES}'
+    if not os.path.exists(filename):
+        return Counter()
+    with open(filename, 'r') as handle:
+        return Counter(json.load(handle))
+
+
+def load_manifest(output_folder):
+    """ Manifest of the concept store in output_folder (None if there is none): model, options and 
+    the inputs that have been folded into the concept store
+    """
+    filename = f'{output_folder}/{MANIFEST}'
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as handle:
+        return json.load(handle)
+
+
+def save_json_atomic(data, filename):
+    with open(f'{filename}.tmp', 'w') as out_file:
+        json.dump(data, out_file, indent=2)
+    os.replace(f'{filename}.tmp', filename)
+
+
+# files rewritten by update_concept_store, in the order they are committed (the manifest last)
+UPDATED_FILES = ["concept_idx.json", FREQUENCIES, MANIFEST]
+
 
+def finish_update(output_folder, rows):
+    """ Complete or discard an interrupted update_concept_store. The updated files are written to
+    .pending files (the manifest last) before rows are appended to the concept store, and renamed
+    after: if every file was written and concept_idx matches the rows of the concept store, the
+    store was committed and the renames are completed, otherwise the pending files are removed.
+    """
+    pending = [f'{output_folder}/{name}.pending' for name in UPDATED_FILES]
+    if not any(os.path.exists(filename) for filename in pending):
+        return
+    concept_idx_filename = pending[0] if os.path.exists(pending[0]) else f'{output_folder}/concept_idx.json'
+    with open(concept_idx_filename, 'r') as handle:
+        num_concepts = len(json.load(handle))
+    if os.path.exists(pending[-1]) and num_concepts == rows:
+        logging.warning(f"completing an interrupted update of {output_folder}")
+        for name, filename in zip(UPDATED_FILES, pending):
+            if os.path.exists(filename):
+                os.replace(filename, f'{output_folder}/{name}')
+    else:
+        logging.warning(f"discarding an interrupted update of {output_folder}")
+        for filename in pending:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def manifest_entry(input_file_name, first_id, num_concepts) -> dict:
+    return dict(filename=os.path.abspath(input_file_name), sha1=file_hash(input_file_name), 
+                first_id=first_id, num_concepts=num_concepts, time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def concept_store(model_name, input_file_name, output_folder, max_concept_length, batch_size=256, use_sentence=False,
+                  device=None, num_threads=None, dtype="float32", workers=1, min_frequency=1):
+    """ Build the concept store (concept_store.bin), concept map (concept_idx.json), concept 
+    frequencies and manifest of the NP/VP phrases of input_file_name (filename or list of 
+    filenames) that occur at least min_frequency times. Concepts are numbered in the order they 
+    first appear in the input.
+    """
+    input_file_names = [input_file_name] if isinstance(input_file_name, str) else list(input_file_name)
+    counts = Counter()
+    first_seen = []
+    for input_file_name in input_file_names:
+        file_counts = extract_concepts([input_file_name], max_concept_length, use_sentence=use_sentence, workers=workers)
+        first_seen.append([phrase for phrase in file_counts if phrase not in counts])
+        counts.update(file_counts)
+    print(ngram_statistics(counts))
+
+    concepts = frequent_concepts(counts, min_frequency=min_frequency)
+    kept = set(concepts)
+    entries = []
+    first_id = 0
+    for input_file_name, phrases in zip(input_file_names, first_seen):
+        num_concepts = sum(1 for phrase in phrases if phrase in kept)
+        entries.append(manifest_entry(input_file_name, first_id, num_concepts))
+        first_id += num_concepts
+    concept_idx = {i: value for i, value in enumerate(concepts)}
+    print(f"mapped {', '.join(input_file_names)} to {len(concepts)} concepts.")
+
+    filename = f'{output_folder}/concept_store.bin'
+    print(f"saving concept_tensor in {filename}")
+    embed_concepts(concepts, model_name, filename, batch_size=batch_size, device=device, num_threads=num_threads, 
+                   dtype=dtype)
+
+    save_json_atomic(concept_idx, f'{output_folder}/concept_idx.json')
+    save_json_atomic(counts, f'{output_folder}/{FREQUENCIES}')
+    manifest = dict(model_name=model_name, max_concept_length=max_concept_length, use_sentence=use_sentence, 
+                    min_frequency=min_frequency, inputs=entries)
+    save_json_atomic(manifest, f'{output_folder}/{MANIFEST}')
     return
 
+
+def update_concept_store(input_file_names, output_folder, model_name=None, max_concept_length=None, batch_size=256,
+                         use_sentence=False, device=None, num_threads=None, workers=1, min_frequency=None):
+    """ Add the concepts of input_file_names that are not in the concept store of output_folder yet. 
+    New concepts get the next ids (existing ids do not change), their embeddings are appended to 
+    concept_store.bin and the inputs are recorded in the manifest, so inputs that have already been 
+    folded in (same content) are skipped. Concept frequencies are accumulated over the inputs, so a 
+    concept that was too rare is added once it occurs min_frequency times in total.
+    """
+    filename = f'{output_folder}/concept_store.bin'
+    if not os.path.exists(filename) or not is_raw_concept_store(filename):
+        raise RuntimeError(f"{filename} not found, build it first or convert concept_store.pt with "
+                           f"bin/convert_concept_store.py")
+    header = read_header(filename)
+    finish_update(output_folder, header["rows"])
+    with open(f'{output_folder}/concept_idx.json', 'r') as handle:
+        concept_idx = json.load(handle)
+    if header["rows"] != len(concept_idx):
+        raise RuntimeError(f"{filename} has {header['rows']} concepts but concept_idx.json has {len(concept_idx)}, "
+                           f"the concept store is inconsistent and should be rebuilt")
+
+    # concept stores built before manifests were added
+    manifest = load_manifest(output_folder) or dict(model_name=header["model_name"], max_concept_length=max_concept_length,
+                                                    use_sentence=use_sentence, inputs=[])
+    model_name = model_name or manifest["model_name"]
+    if header["model_name"] not in (None, model_name):
+        raise RuntimeError(f"{filename} was built with {header['model_name']}, not {model_name}")
+    max_concept_length = max_concept_length or manifest["max_concept_length"]
+    if max_concept_length is None:
+        raise RuntimeError("max_concept_length should be specified (it is not in the manifest)")
+    min_frequency = min_frequency or manifest.get("min_frequency", 1)
+    counts = load_frequencies(output_folder)
+
+    known = set(concept_idx.values())
+    if os.path.exists(f'{output_folder}/{MERGED}'):
+        with open(f'{output_folder}/{MERGED}', 'r') as handle:
+            known.update(json.load(handle))
+    folded = {entry["sha1"] for entry in manifest["inputs"]}
+    new_concepts = []
+    entries = []
+    for input_file_name in input_file_names:
+        sha1 = file_hash(input_file_name)
+        if sha1 in folded:
+            print(f"skipping {input_file_name} (already in the concept store)")
+            continue
+        folded.add(sha1)
+        first_id = len(concept_idx) + len(new_concepts)
+        file_counts = extract_concepts([input_file_name], max_concept_length, use_sentence=use_sentence, workers=workers)
+        counts.update(file_counts)
+        concepts = frequent_concepts(Counter({phrase: counts[phrase] for phrase in file_counts}), 
+                                     min_frequency=min_frequency, exclude=known)
+        known.update(concepts)
+        new_concepts.extend(concepts)
+        entries.append(manifest_entry(input_file_name, first_id, len(concepts)))
+        print(f"{input_file_name}: {len(file_counts)} concepts, {len(concepts)} new")
+    if not len(entries):
+        return
+
+    first_id = len(concept_idx)
+    concepts = new_concepts
+    new_filename = f'{filename}.new'
+    if len(concepts):
+        embed_concepts(concepts, model_name, new_filename, batch_size=batch_size, device=device, num_threads=num_threads,
+                       dtype=header["dtype"])
+        for i, concept in enumerate(concepts):
+            concept_idx[str(first_id + i)] = concept
+        save_json_atomic(concept_idx, f'{output_folder}/concept_idx.json.pending')
+    # the files are committed after the concept store (see finish_update)
+    save_json_atomic(counts, f'{output_folder}/{FREQUENCIES}.pending')
+    manifest["inputs"].extend(entries)
+    save_json_atomic(manifest, f'{output_folder}/{MANIFEST}.pending')
+    if len(concepts):
+        new_concept_tensor = load_concept_store(new_filename)
+        with ConceptStoreWriter(filename, dim=header["dim"], dtype=header["dtype"], append=True) as writer:
+            for batch in chunks(new_concept_tensor, n=65536):
+                writer.write(batch)
+        del new_concept_tensor
+        os.remove(new_filename)
+    finish_update(output_folder, len(concept_idx))
+    print(f"added {len(concepts)} concepts (ids {first_id} to {first_id + len(concepts) - 1}), "
+          f"{len(concept_idx)} concepts in {filename}")
+    for index_filename in glob.glob(f'{output_folder}/concept_index_*.pt'):
+        logging.warning(f"{index_filename} does not include the new concepts, rebuild it with --index_only")
+
+
+def concept_index(output_folder, index_type, num_queries=1000, k=5, seed=0, **index_kwargs):
+    """ Build an index of the concept store in output_folder (see model/concept_index.py), save 
+    it to concept_index_<index_type>.pt and report its recall@k with respect to exact search. 
+    The queries are midpoints of random pairs of concepts (so that they are not concepts themselves).
+    """
+    from ..model.concept_index import build_concept_index, save_concept_index, recall_at_k
+
+    concept_tensor = load_concept_store(concept_store_filename(output_folder))
+    print(f"building {index_type} index of {concept_tensor.size(0)} concepts")
+    index = build_concept_index(index_type, concept_tensor, **index_kwargs)
+
+    filename = f'{output_folder}/concept_index_{index_type}.pt'
+    print(f"saving concept index in {filename}")
+    save_concept_index(index, filename)
+
+    generator = torch.Generator().manual_seed(seed)
+    pairs = torch.randint(concept_tensor.size(0), (2, num_queries), generator=generator)
+    queries = (concept_tensor[pairs[0]].float() + concept_tensor[pairs[1]].float()) / 2
+    for batch_size in [1, 32]:
+        report = recall_at_k(index, concept_tensor, queries, k=k, batch_size=batch_size)
+        print(f"recall@{k} = {report['recall']:.3f} on {num_queries} queries, batch_size={batch_size}: "
+              f"{report['index_ms']:.2f}ms/query (exact search {report['exact_ms']:.2f}ms/query)")
+    return filename
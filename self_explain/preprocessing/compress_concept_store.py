@@ -0,0 +1,215 @@
+""" Compression of a concept store: near-duplicate concepts (e.g. "the movie", "this movie") are
+merged, either by cosine similarity (dedup) or by k-means clustering to a target size (kmeans).
+
+The compressed store is written with its concept_idx.json, concept_merged.json (the phrases that
+were merged into another concept, so that update_concept_store does not add them again),
+concept_frequency.json (the frequency of a concept is the sum over the concepts merged into it)
+and compression.json (method, options and the new id of every old concept).
+"""
+import os
+import json
+import time
+import logging
+from collections import Counter
+
+import torch
+import tqdm
+
+from ..model.concept_index import kmeans, assign
+from ..model.concept_store import ConceptStoreWriter, load_concept_store, inner_products, read_header, is_raw_concept_store
+from .utils import chunks
+from .build_concept_store import (concept_store_filename, load_frequencies, load_manifest, save_json_atomic,
+                                  FREQUENCIES, MANIFEST, MERGED)
+
+
+def normalize(x: torch.Tensor) -> torch.Tensor:
+    x = x.float()
+    return x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+
+def dedup_members(normalized: torch.Tensor, members: torch.Tensor, representative: torch.Tensor, threshold: float,
+                  block_size: int = 4096):
+    """ Merge each concept of members (ids in increasing order) into the first earlier kept member
+    whose cosine similarity is at least threshold (representative is updated). Members are compared
+    in blocks of block_size, so memory does not grow with the size of a cluster.
+    """
+    kept = []
+    for start in range(0, members.numel(), block_size):
+        block = members[start:start + block_size]
+        x = normalized[block]
+        # members of the block that are duplicates of members kept in earlier blocks
+        first = torch.full((block.numel(),), -1, dtype=torch.long)
+        for kept_block in kept:
+            similar = (x @ normalized[kept_block].T) >= threshold
+            matched = similar.any(1) & (first < 0)
+            # argmax returns the first (lowest id) similar kept member
+            first[matched] = kept_block[similar[matched].byte().argmax(1)]
+        representative[block[first >= 0]] = first[first >= 0]
+        # the other members of the block are compared with each other, only those with a later
+        # similar member need a pass
+        rest = block[first < 0]
+        similar = torch.triu((normalized[rest] @ normalized[rest].T) >= threshold, diagonal=1)
+        removed = torch.zeros(rest.numel(), dtype=torch.bool)
+        for i in torch.nonzero(similar.any(1), as_tuple=False).view(-1).tolist():
+            if removed[i]:
+                continue
+            duplicates = similar[i] & ~removed
+            representative[rest[duplicates]] = rest[i]
+            removed |= duplicates
+        if not removed.all():
+            kept.append(rest[~removed])
+
+
+def dedup_concepts(concepts: torch.Tensor, threshold: float = 0.95, num_lists: int = None, chunk_size: int = 65536,
+                   block_size: int = 4096):
+    """ Merge concepts whose cosine similarity with an earlier kept concept is at least threshold.
+    To avoid comparing all pairs, concepts are only compared within k-means clusters (num_lists
+    clusters of the normalized concepts, about 1000 concepts per cluster by default), so a few
+    near-duplicates on cluster boundaries may be kept. Clusters are compared in blocks of block_size
+    concepts (see dedup_members).
+
+    Return:
+        tensor: new id of every concept (kept concepts are numbered in their original order)
+        tensor: indices of the kept concepts (representatives)
+    """
+    num_concepts = concepts.size(0)
+    num_lists = num_lists or max(1, num_concepts // 1000)
+    normalized = torch.cat([normalize(concepts[start:start + chunk_size]) for start in range(0, num_concepts, chunk_size)])
+    centroids = kmeans(normalized, min(num_lists, num_concepts), num_iterations=10)
+    clusters = assign(normalized, centroids)
+    order = torch.argsort(clusters * num_concepts + torch.arange(num_concepts))
+    counts = torch.bincount(clusters, minlength=centroids.size(0)).tolist()
+    representative = torch.arange(num_concepts)
+    start = 0
+    for count in tqdm.tqdm(counts, desc="deduplicating concepts"):
+        members = order[start:start + count]
+        start += count
+        if count > 1:
+            dedup_members(normalized, members, representative, threshold, block_size=block_size)
+    kept = torch.nonzero(representative == torch.arange(num_concepts), as_tuple=False).view(-1)
+    new_ids = torch.full((num_concepts,), -1, dtype=torch.long)
+    new_ids[kept] = torch.arange(kept.numel())
+    return new_ids[representative], kept
+
+
+def kmeans_concepts(concepts: torch.Tensor, target_size: int, num_iterations: int = 10, sample_size: int = 100000):
+    """ Cluster concepts into (at most) target_size clusters
+
+    Return:
+        tensor: new id (cluster) of every concept
+        tensor: centroids of the non-empty clusters
+        tensor: index of the concept closest to each centroid (representative phrase)
+    """
+    x = concepts.float()
+    centroids = kmeans(x, target_size, num_iterations=num_iterations, sample_size=sample_size)
+    clusters = assign(x, centroids)
+    # drop empty clusters
+    counts = torch.bincount(clusters, minlength=target_size)
+    non_empty = torch.nonzero(counts > 0, as_tuple=False).view(-1)
+    remap = torch.full((target_size,), -1, dtype=torch.long)
+    remap[non_empty] = torch.arange(non_empty.numel())
+    new_ids = remap[clusters]
+    centroids = centroids[non_empty]
+    distances = ((x - centroids[new_ids]) ** 2).sum(1)
+    representatives = torch.full((centroids.size(0),), -1, dtype=torch.long)
+    # the concept with the smallest distance in each cluster is assigned last
+    for i in torch.argsort(distances, descending=True).tolist():
+        representatives[new_ids[i]] = i
+    return new_ids, centroids, representatives
+
+
+def gil_search_latency(concepts: torch.Tensor, k: int = 100, batch_size: int = 32, repeats: int = 10, seed: int = 0) -> float:
+    """ Time (ms) of the GIL top-k search of a batch of queries (see SEXLNet.gil)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    queries = concepts[torch.randint(concepts.size(0), (batch_size,), generator=generator)].float()
+    queries = queries + 0.1 * queries.std() * torch.randn(queries.size(), generator=generator)
+    with torch.no_grad():
+        torch.topk(inner_products(queries, concepts), k=min(k, concepts.size(0)))
+        start = time.time()
+        for _ in range(repeats):
+            torch.topk(inner_products(queries, concepts), k=min(k, concepts.size(0)))
+    return 1000 * (time.time() - start) / repeats
+
+
+def compress_concept_store(input_folder, output_folder, method="dedup", threshold=0.95, target_size=None,
+                           num_lists=None, num_iterations=10) -> dict:
+    """ Compress the concept store of input_folder into output_folder (can be the same folder)
+
+    Args:
+        method (str): dedup (merge concepts with cosine similarity >= threshold) or kmeans (cluster
+            the concepts into target_size centroids, the phrase of a centroid is the closest concept)
+    Return:
+        dict: compression report (see compression.json)
+    """
+    filename = concept_store_filename(input_folder)
+    concepts = load_concept_store(filename)
+    header = read_header(filename) if is_raw_concept_store(filename) else {}
+    with open(f'{input_folder}/concept_idx.json', 'r') as handle:
+        concept_idx = {int(key): value for key, value in json.load(handle).items()}
+    if len(concept_idx) != concepts.size(0):
+        raise RuntimeError(f"{filename} has {concepts.size(0)} concepts but concept_idx.json has {len(concept_idx)}")
+
+    start = time.time()
+    if method == "dedup":
+        new_ids, kept = dedup_concepts(concepts, threshold=threshold, num_lists=num_lists)
+        phrases = [concept_idx[i] for i in kept.tolist()]
+        rows = concepts[kept]
+        options = dict(threshold=threshold, num_lists=num_lists)
+    elif method == "kmeans":
+        if target_size is None or target_size >= concepts.size(0):
+            raise ValueError(f"target_size={target_size} should be smaller than the number of concepts {concepts.size(0)}")
+        new_ids, centroids, representatives = kmeans_concepts(concepts, target_size, num_iterations=num_iterations)
+        phrases = [concept_idx[i] for i in representatives.tolist()]
+        rows = centroids
+        options = dict(target_size=target_size, num_iterations=num_iterations)
+    else:
+        raise ValueError(f"unknown compression method '{method}', should be dedup or kmeans")
+    elapsed = time.time() - start
+    print(f"compressed {concepts.size(0)} concepts to {len(phrases)} with {method} in {elapsed:.1f}s")
+
+    os.makedirs(output_folder, exist_ok=True)
+    output_filename = f'{output_folder}/concept_store.bin'
+    dtype = "float16" if concepts.dtype == torch.float16 else "float32"
+    with ConceptStoreWriter(output_filename, dim=concepts.size(1), dtype=dtype, model_name=header.get("model_name")) as writer:
+        for batch in chunks(rows, n=65536):
+            writer.write(batch)
+    compressed = load_concept_store(output_filename)
+
+    # phrases merged into another concept (and those merged by an earlier compression)
+    merged = {}
+    if os.path.exists(f'{input_folder}/{MERGED}'):
+        with open(f'{input_folder}/{MERGED}', 'r') as handle:
+            merged = {phrase: int(new_ids[old_id]) for phrase, old_id in json.load(handle).items()}
+    kept_phrases = set(phrases)
+    for old_id, phrase in concept_idx.items():
+        if phrase not in kept_phrases:
+            merged[phrase] = int(new_ids[old_id])
+
+    # occurrences of merged phrases count for the concept they were merged into, the phrases that
+    # are not concepts keep their frequency (see update_concept_store)
+    frequencies = load_frequencies(input_folder)
+    merged_frequencies = Counter()
+    for old_id, phrase in concept_idx.items():
+        merged_frequencies[phrases[int(new_ids[old_id])]] += frequencies.pop(phrase, 0)
+    for phrase, new_id in merged.items():
+        merged_frequencies[phrases[new_id]] += frequencies.pop(phrase, 0)
+    frequencies.update(merged_frequencies)
+
+    report = dict(method=method, input_folder=os.path.abspath(input_folder),
+                  input=dict(concepts=concepts.size(0), megabytes=concepts.numel() * concepts.element_size() / 1e6,
+                             gil_ms=gil_search_latency(concepts)),
+                  output=dict(concepts=compressed.size(0), megabytes=compressed.numel() * compressed.element_size() / 1e6,
+                              gil_ms=gil_search_latency(compressed)),
+                  **options)
+    save_json_atomic({i: phrase for i, phrase in enumerate(phrases)}, f'{output_folder}/concept_idx.json')
+    save_json_atomic(merged, f'{output_folder}/{MERGED}')
+    save_json_atomic(frequencies, f'{output_folder}/{FREQUENCIES}')
+    save_json_atomic(dict(report, new_ids=new_ids.tolist()), f'{output_folder}/compression.json')
+    manifest = load_manifest(input_folder)
+    if manifest is not None:
+        manifest["compression"] = manifest.get("compression", []) + [report]
+        save_json_atomic(manifest, f'{output_folder}/{MANIFEST}')
+    for key in ["input", "output"]:
+        logging.info(f"{key}: {report[key]}")
+    return report
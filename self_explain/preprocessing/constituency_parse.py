@@ -1,3 +1,4 @@
+import logging
 from typing import Dict, List
 
 import benepar
@@ -6,10 +7,16 @@ import numpy as np
 from transformers import RobertaTokenizer, XLNetTokenizer, DistilBertTokenizer
 from nltk.tree import ParentedTree
 
+from .utils import chunks
+from .parse_cache import tree_to_string, tree_from_string
+
 
 class ParseTree():
-    def __init__(self, tokenizer_name, cached_parses=None):
-        self.parser = benepar.Parser('benepar_en3')
+    def __init__(self, tokenizer_name, cached_parses=None, batch_size=64, compact=False):
+        """ If compact, phrases are stored without the dense onehot vectors and num_tokens is 
+        returned instead of nt_idx_matrix (see utils.nt_idx_matrix_from_datapoint)
+        """
+        self.parser = benepar.Parser('benepar_en3', batch_size=batch_size)
         if 'roberta' in tokenizer_name:
             self.tokenizer = RobertaTokenizer.from_pretrained(tokenizer_name)
         if 'xlnet' in tokenizer_name:
@@ -17,6 +24,7 @@ class ParseTree():
         if 'distilbert' in tokenizer_name:
             self.tokenizer = DistilBertTokenizer.from_pretrained(tokenizer_name)
         self.cached_parses = cached_parses
+        self.compact = compact
         self.TREE_HEIGHT = 0
         self.NGRAM_LIMIT = 1000
         self.TOKEN_LIMIT = 250
@@ -55,37 +63,98 @@ class ParseTree():
 
     def get_parse_tree(self, tokenized_sent):
         combined_text = [self.remove_non_ascii(x) for x in tokenized_sent]
-        joined_text = " ".join(combined_text)
-
-        if joined_text in self.cached_parses:
-            parsed_tree = self.cached_parses[joined_text]
-            parsed_tree = ParentedTree.fromstring(parsed_tree)
-            return parsed_tree
-
-        # tokenized_sent = self.tokenizer.tokenize(line[0])
-        combined_text = [self.remove_non_ascii(x) for x in tokenized_sent]
-        parsed_tree = self.parser.parse(sentence=combined_text)
+        parsed_tree = self._get_cached_parse(combined_text)
+        if parsed_tree is None:
+            parsed_tree = self.parser.parse(sentence=combined_text)
+            self._store_parses([combined_text], [parsed_tree])
         parsed_tree = ParentedTree.convert(parsed_tree)
         parsed_tree = self.add_indices_to_terminals(parsed_tree)
         return parsed_tree
 
-    def get_parse_tree_for_raw_sent(self, raw_sent):
+    def _get_cached_parse(self, combined_text):
+        if self.cached_parses is None:
+            return None
+        parsed_tree = self.cached_parses.get(" ".join(combined_text))
+        return None if parsed_tree is None else tree_from_string(parsed_tree)
+
+    def _store_parses(self, tokenized_sents, parsed_trees):
+        if self.cached_parses is None:
+            return
+        self.cached_parses.update({" ".join(combined_text): tree_to_string(parsed_tree)
+                                   for combined_text, parsed_tree in zip(tokenized_sents, parsed_trees)
+                                   if parsed_tree is not None})
+
+    def tokenize(self, raw_sent) -> List[str]:
         tokenized_sent = self.tokenizer.tokenize(raw_sent)
         combined_text = [self.remove_non_ascii(x) for x in tokenized_sent]
-        combined_text = combined_text[:self.TOKEN_LIMIT]
+        return combined_text[:self.TOKEN_LIMIT]
 
-        parsed_tree = self.parser.parse(sentence=combined_text)
+    def tree_to_list(self, parsed_tree, num_tokens):
+        """ Convert a benepar tree into the list of phrases and the phrase/token matrix
+        (or num_tokens if compact)
+        """
         parsed_tree = ParentedTree.convert(parsed_tree)
         parsed_tree = self.add_indices_to_terminals(parsed_tree)
         parsed_tree_as_list = self.traverse_and_store(parsed_tree, parse_tree_stored=[])
+        if self.compact:
+            return parsed_tree_as_list, num_tokens
 
-        num_tokens = len(combined_text)
         parsed_tree_as_list = self.get_one_hot_encoded_vector(parse_tree_list=parsed_tree_as_list,
                                                               num_tokens=num_tokens)
 
         nt_idx_matrix = [x['onehot'] for x in parsed_tree_as_list]
         return parsed_tree_as_list, nt_idx_matrix
 
+    def get_parse_tree_for_raw_sent(self, raw_sent):
+        combined_text = self.tokenize(raw_sent)
+        parsed_tree = self._get_cached_parse(combined_text)
+        if parsed_tree is None:
+            parsed_tree = self.parser.parse(sentence=combined_text)
+            self._store_parses([combined_text], [parsed_tree])
+        return self.tree_to_list(parsed_tree, num_tokens=len(combined_text))
+
+    def get_parse_trees_for_raw_sents(self, list_of_sents, batch_size=64):
+        """ Parse sentences in batches (one call to the parser per batch), sentences 
+        found in the parse cache are not parsed again.
+        Return:
+            list: (parse_tree_list, nt_idx_matrix or num_tokens) for each sentence, None if the sentence could not be parsed
+        """
+        outputs = []
+        for batch in chunks(list_of_sents, n=batch_size):
+            tokenized_sents = [self.tokenize(raw_sent) for raw_sent in batch]
+            parsed_trees = [self._get_cached_parse(combined_text) for combined_text in tokenized_sents]
+            missing = [i for i, parsed_tree in enumerate(parsed_trees) if parsed_tree is None]
+            if len(missing):
+                missing_trees = self._parse_sents([batch[i] for i in missing], [tokenized_sents[i] for i in missing])
+                self._store_parses([tokenized_sents[i] for i in missing], missing_trees)
+                for i, parsed_tree in zip(missing, missing_trees):
+                    parsed_trees[i] = parsed_tree
+            for raw_sent, combined_text, parsed_tree in zip(batch, tokenized_sents, parsed_trees):
+                if parsed_tree is not None:
+                    try:
+                        parsed_tree = self.tree_to_list(parsed_tree, num_tokens=len(combined_text))
+                    except Exception as e:
+                        logging.error(f"failed to parse sentence '{raw_sent}'. {e}")
+                        parsed_tree = None
+                outputs.append(parsed_tree)
+        return outputs
+
+    def _parse_sents(self, raw_sents, tokenized_sents):
+        try:
+            return list(self.parser.parse_sents(tokenized_sents))
+        except Exception as e:
+            # parse one at a time to find the sentences that fail
+            logging.debug(f"failed to parse batch, parsing sentences one at a time. {e}")
+            return [self._parse_or_none(raw_sent, combined_text) 
+                    for raw_sent, combined_text in zip(raw_sents, tokenized_sents)]
+
+    def _parse_or_none(self, raw_sent, combined_text):
+        try:
+            return self.parser.parse(sentence=combined_text)
+        except Exception as e:
+            logging.error(f"failed to parse sentence '{raw_sent}'. {e}")
+            return None
+
     def get_one_hot_encoded_vector(self, parse_tree_list, num_tokens):
         for item in parse_tree_list:
             onehot_array = np.zeros((num_tokens,1))
@@ -0,0 +1,134 @@
+""" Persistent cache of constituency parses.
+
+Parses are stored in a SQLite file keyed by a hash of the tokenizer name and the tokenized text
+(i.e. the input to the parser), with an in-process LRU in front. The same file can be shared by
+store_parse_trees, SelfExplainCharacterizer and parser worker processes.
+"""
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from nltk.tree import Tree
+
+
+def default_parse_cache_filename() -> str:
+    """ Parse cache location ($SELF_EXPLAIN_PARSE_CACHE or ~/.cache/self_explain/parse_cache.sqlite)
+    """
+    default = os.path.join(os.path.expanduser("~"), ".cache", "self_explain", "parse_cache.sqlite")
+    return os.environ.get("SELF_EXPLAIN_PARSE_CACHE", default)
+
+
+def tree_to_string(tree: Tree) -> str:
+    """ Serialize a parse tree as JSON (robust to brackets in the tokens)
+    """
+    def to_list(node):
+        if isinstance(node, Tree):
+            return [node.label(), [to_list(child) for child in node]]
+        return node
+    return json.dumps(to_list(tree))
+
+
+def tree_from_string(text: str) -> Tree:
+    def from_list(node):
+        if isinstance(node, list):
+            label, children = node
+            return Tree(label, [from_list(child) for child in children])
+        return node
+    return from_list(json.loads(text))
+
+
+class ParseCache(object):
+    """ Dict-like cache from tokenized text (tokens joined by spaces) to a serialized parse tree
+    """
+    def __init__(self, filename: Optional[str], tokenizer_name: str, max_memory_items: int = 100000):
+        self.filename = filename
+        self.tokenizer_name = tokenizer_name
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pid = None
+        if filename is not None:
+            folder = os.path.dirname(filename)
+            if folder != "" and not os.path.exists(folder):
+                logging.info(f"Creating folder: {folder}")
+                os.makedirs(folder, exist_ok=True)
+            logging.info(f"parse cache: {filename}")
+
+    def key(self, joined_text: str) -> str:
+        return hashlib.sha1(f"{self.tokenizer_name}\n{joined_text}".encode("utf-8")).hexdigest()
+
+    @property
+    def connection(self) -> Optional[sqlite3.Connection]:
+        # connections cannot be shared with forked processes, so open one per process
+        if self.filename is not None and (self._connection is None or self._pid != os.getpid()):
+            self._connection = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, tree TEXT NOT NULL)")
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, joined_text: str) -> Optional[str]:
+        key = self.key(joined_text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return self.memory[key]
+            row = None
+            if self.connection is not None:
+                row = self.connection.execute("SELECT tree FROM parses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    def update(self, items: dict):
+        """ Store {joined_text: tree} in a single transaction
+        """
+        rows = [(self.key(joined_text), tree) for joined_text, tree in items.items()]
+        with self.lock:
+            for key, tree in rows:
+                self._remember(key, tree)
+            if self.connection is not None and len(rows):
+                self.connection.executemany("INSERT OR REPLACE INTO parses (key, tree) VALUES (?, ?)", rows)
+                self.connection.commit()
+
+    def _remember(self, key, tree):
+        self.memory[key] = tree
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def __contains__(self, joined_text: str) -> bool:
+        return self.get(joined_text) is not None
+
+    def __getitem__(self, joined_text: str) -> str:
+        tree = self.get(joined_text)
+        if tree is None:
+            raise KeyError(joined_text)
+        return tree
+
+    def __setitem__(self, joined_text: str, tree: str):
+        self.update({joined_text: tree})
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return dict(hits=self.hits, memory_hits=self.memory_hits, misses=self.misses,
+                    hit_rate=self.hits / total if total else 0.0)
+
+    def __repr__(self):
+        info = ", ".join(f"{key}={value}" for key, value in self.stats().items())
+        return f"ParseCache({self.filename}, {self.tokenizer_name}: {info})"
@@ -1,21 +1,109 @@
+import os
 import logging
 import argparse
 import csv
 import json
-from typing import Dict
+import multiprocessing
+import time
+from typing import Dict, List, Optional
 
+import torch
 import tqdm
 
 from .constituency_parse import ParseTree
+from .parse_cache import ParseCache
+from .utils import chunks, iter_chunks
+
+
+# ParsedDataset of a worker process (see read_and_store_from_tsv), loaded once per worker
+_worker_dataset = None
+
+
+def _init_worker(tokenizer_name, batch_size, parse_cache, compact, num_threads):
+    global _worker_dataset
+    torch.set_num_threads(num_threads)
+    _worker_dataset = ParsedDataset(tokenizer_name=tokenizer_name, batch_size=batch_size, 
+                                    parse_cache=parse_cache, compact=compact)
+
+
+def _worker_parse_rows(rows):
+    return _worker_dataset.parse_rows(rows), (os.getpid(), _worker_dataset.cache_stats())
 
 
 class ParsedDataset(object):
-    def __init__(self, tokenizer_name, progress_bar=False):
+    def __init__(self, tokenizer_name, progress_bar=False, batch_size=64, parse_cache: str = None, compact=False):
+        """ 
+        Args:
+            parse_cache (str): SQLite file to cache parses in (shared across runs and processes), None to disable
+            compact (bool): store num_tokens instead of the dense nt_idx_matrix/onehot vectors 
+                (see utils.compact_datapoint)
+        """
         self.parse_trees: Dict[str, str] = {}
-        self.parser = ParseTree(tokenizer_name=tokenizer_name)
+        self.tokenizer_name = tokenizer_name
+        self.batch_size = batch_size
+        self.parse_cache = parse_cache
+        self.compact = compact
+        self.cached_parses = None if parse_cache is None else ParseCache(parse_cache, tokenizer_name=tokenizer_name)
+        self._parser = None
         self.disable = not progress_bar
 
-    def read_and_store_from_tsv(self, input_file_name, output_file_name):
+    @property
+    def parser(self) -> ParseTree:
+        """ Parser (benepar model and tokenizer) is loaded on first use
+        """
+        if self._parser is None:
+            self._parser = ParseTree(tokenizer_name=self.tokenizer_name, cached_parses=self.cached_parses, 
+                                     batch_size=self.batch_size, compact=self.compact)
+        return self._parser
+
+    def cache_stats(self) -> dict:
+        """ Parse cache hit/miss counters (empty if there is no cache)
+        """
+        return {} if self.cached_parses is None else self.cached_parses.stats()
+
+    def parse_sentences(self, sentences: List[str], label=0) -> List[Optional[dict]]:
+        """ Parse sentences in memory into datapoints (same layout as a line of *_with_parse.json)
+        Return:
+            list: datapoint for each sentence (None for sentences that could not be parsed)
+        """
+        datapoints = []
+        batches = chunks(sentences, n=self.batch_size)
+        num_batches = (len(sentences) + self.batch_size - 1) // self.batch_size
+        for batch in tqdm.tqdm(batches, total=num_batches, desc="Parse sentences", disable=self.disable):
+            datapoints.extend(self._parse_batch(batch, labels=[label] * len(batch)))
+        return datapoints
+
+    def parse_rows(self, rows) -> List[str]:
+        """ Parse TSV rows (sentence, label) into JSON lines, rows that cannot be parsed are dropped
+        """
+        datapoints = self._parse_batch([row[0] for row in rows], labels=[row[1] for row in rows])
+        return [json.dumps(datapoint_dict) for datapoint_dict in datapoints if datapoint_dict is not None]
+
+    def _parse_batch(self, texts, labels) -> List[Optional[dict]]:
+        datapoints = []
+        parsed = self.parser.get_parse_trees_for_raw_sents(texts, batch_size=self.batch_size)
+        for text, label, parse_output in zip(texts, labels, parsed):
+            if parse_output is None:
+                # error is logged by the parser
+                datapoints.append(None)
+                continue
+            parse_tree, nt_idx = parse_output
+            key = 'num_tokens' if self.compact else 'nt_idx_matrix'
+            datapoints.append({'sentence': text,
+                               'parse_tree': parse_tree,
+                               'label': label,
+                               key: nt_idx})
+        return datapoints
+
+    def read_and_store_from_tsv(self, input_file_name, output_file_name, workers=1):
+        """ Parse sentences in input_file_name (TSV) and store them in output_file_name (JSON lines). 
+        Rows are parsed in batches of batch_size. If workers > 1, batches are parsed by a pool of 
+        processes (each with its own parser) and written in input order, so the output is the 
+        same as with a single worker.
+        """
+        start = time.time()
+        count = 0
+        cache_stats = {}
         with open(output_file_name, 'w') as output_file:
             # get total to print output
             with open(input_file_name, 'r') as open_file:
@@ -24,21 +112,36 @@ class ParsedDataset(object):
             with open(input_file_name, 'r') as open_file:
                 reader = csv.reader(open_file, delimiter='\t')
                 next(reader, None)  # skip header
-                for row in tqdm.tqdm(reader, total=total, desc="Store parsed tree", disable=self.disable):
-                    text = row[0]
-                    try:
-                        parse_tree, nt_idx_matrix = self.parser.get_parse_tree_for_raw_sent(raw_sent=text)
-                    except Exception as e:
-                        logging.error(f"failed to parse sentence '{text}', will skip it. {e}")
-                        continue
-                    datapoint_dict = {'sentence': row[0],
-                                      'parse_tree': parse_tree,
-                                      'label': row[1],
-                                      'nt_idx_matrix': nt_idx_matrix}
-                    json.dump(datapoint_dict, output_file)
-                    output_file.write('\n')
+                batches = iter_chunks(reader, n=self.batch_size)
+                with tqdm.tqdm(total=total, desc="Store parsed tree", disable=self.disable) as progress_bar:
+                    if workers > 1:
+                        num_threads = max(1, multiprocessing.cpu_count() // workers)
+                        initargs = (self.tokenizer_name, self.batch_size, self.parse_cache, self.compact, num_threads)
+                        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+                            for lines, (pid, stats) in pool.imap(_worker_parse_rows, batches):
+                                count += self._write_lines(lines, output_file, progress_bar)
+                                cache_stats[pid] = stats
+                    else:
+                        for lines in map(self.parse_rows, batches):
+                            count += self._write_lines(lines, output_file, progress_bar)
+                        cache_stats[os.getpid()] = self.cache_stats()
+        elapsed = time.time() - start
+        print(f"parsed {count} sentences with {workers} worker(s) in {elapsed:.1f}s "
+              f"({count / max(elapsed, 1e-6):.1f} sentences/s)")
+        if self.parse_cache is not None:
+            hits = sum(stats.get("hits", 0) for stats in cache_stats.values())
+            misses = sum(stats.get("misses", 0) for stats in cache_stats.values())
+            print(f"parse cache {self.parse_cache}: {hits} hits, {misses} misses")
         return
 
+    @staticmethod
+    def _write_lines(lines, output_file, progress_bar) -> int:
+        for line in lines:
+            output_file.write(line)
+            output_file.write('\n')
+        progress_bar.update(len(lines))
+        return len(lines)
+
     def store_parse_trees(self, output_file):
         with open(output_file, 'w') as open_file:
             json.dump(self.parse_trees, open_file)
@@ -1,6 +1,88 @@
+import numpy as np
+
+# spaCy components needed to split sentences
+SENTENCE_PIPES = ("tok2vec", "parser", "senter")
 
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
-        yield lst[i:i + n]
\ No newline at end of file
+        yield lst[i:i + n]
+
+
+def load_sentence_nlp(model="en_core_web_sm"):
+    """ spaCy pipeline for sentence splitting (the components that are not needed are disabled)
+    """
+    import spacy
+    nlp = spacy.load(model)
+    nlp.disable_pipes(*[name for name in nlp.pipe_names if name not in SENTENCE_PIPES])
+    return nlp
+
+
+def iter_chunks(iterable, n):
+    """Yield successive n-sized lists from an iterable (e.g. a generator)."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+
+def is_compact(datapoint) -> bool:
+    """ Compact datapoints store num_tokens instead of the dense nt_idx_matrix and onehot vectors.
+    The phrase/token matrix is rebuilt from the phrase indices (see nt_idx_matrix_from_datapoint).
+    """
+    return "nt_idx_matrix" not in datapoint
+
+
+def nt_idx_matrix_from_datapoint(datapoint) -> np.ndarray:
+    """ Phrase/token matrix (num_phrases x num_tokens) of a dense or compact datapoint
+    """
+    if not is_compact(datapoint):
+        return np.array(datapoint["nt_idx_matrix"], dtype=np.int64)
+    parse_tree = datapoint["parse_tree"]
+    nt_idx_matrix = np.zeros((len(parse_tree), int(datapoint["num_tokens"])), dtype=np.int64)
+    for i, phrase in enumerate(parse_tree):
+        nt_idx_matrix[i, phrase["indices"]] = 1
+    return nt_idx_matrix
+
+
+def compact_datapoint(datapoint) -> dict:
+    """ Convert a dense datapoint (with onehot and nt_idx_matrix) to the compact format
+    """
+    if is_compact(datapoint):
+        return datapoint
+    nt_idx_matrix = datapoint["nt_idx_matrix"]
+    num_tokens = len(nt_idx_matrix[0]) if len(nt_idx_matrix) else 0
+    parse_tree = [{key: value for key, value in phrase.items() if key != "onehot"} for phrase in datapoint["parse_tree"]]
+    return {'sentence': datapoint['sentence'],
+            'parse_tree': parse_tree,
+            'label': datapoint['label'],
+            'num_tokens': num_tokens}
+
+
+def dense_datapoint(datapoint) -> dict:
+    """ Convert a compact datapoint to the dense format
+    """
+    if not is_compact(datapoint):
+        return datapoint
+    nt_idx_matrix = nt_idx_matrix_from_datapoint(datapoint).astype(float)
+    parse_tree = [dict(phrase, onehot=onehot) for phrase, onehot in zip(datapoint["parse_tree"], nt_idx_matrix.tolist())]
+    return {'sentence': datapoint['sentence'],
+            'parse_tree': parse_tree,
+            'label': datapoint['label'],
+            'nt_idx_matrix': nt_idx_matrix.tolist()}
+
+
+def phrase_indices_from_datapoint(datapoint):
+    """ Token indices of each phrase and the number of tokens of a dense or compact datapoint
+    """
+    if is_compact(datapoint):
+        num_tokens = int(datapoint["num_tokens"])
+    else:
+        nt_idx_matrix = datapoint["nt_idx_matrix"]
+        num_tokens = len(nt_idx_matrix[0]) if len(nt_idx_matrix) else 0
+    return [phrase["indices"] for phrase in datapoint["parse_tree"]], num_tokens
@@ -1,42 +1,171 @@
 import torch
+import time
 import logging 
-import os
-import datetime
 import numpy as np
-import csv
 import re
-import spacy
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoTokenizer
 
 from typing import Tuple, List
 
-from .model.SE_XLNet import SEXLNet
-from .model.infer_model import gil_interpret, lil_interpret, load_concept_map, load_dev_examples
-from .model.data import ClassificationData
+from .model.SE_XLNet import SEXLNet, EXPLAIN_MODES
+from .model.infer_model import gil_interpret, lil_interpret, load_concept_map
+from .model.data import ClassificationDataset, MyCollator
 from .preprocessing.store_parse_trees import ParsedDataset
+from .preprocessing.utils import load_sentence_nlp
+from .model.samplers import token_budget_batches, padding_efficiency
+from .model.concept_index import load_concept_index
+from .model.runtime import SelfExplainRuntime
+from .json_util import load_json
 
 
 
+# keys of a model conf (model.json) with paths relative to its folder
+BUNDLE_PATH_KEYS = ["concept_store", "concept_index", "base_model"]
+
+
+def timed(load_times: dict, key: str, function, *args, **kwargs):
+    """ Call function and record its duration (s) in load_times[key]
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+    load_times[key] = time.time() - start
+    return result
+
+
 class SelfExplainCharacterizer(object):
     def __init__(self, checkpoint_filename=None, concept_map_filename=None, **kwargs):
-        self.nlp = spacy.load("en_core_web_sm")
-        # get override parameters for load_from_checkpoint (concept_store, hparams, etc)
-        checkpoint_kwargs = kwargs.get("checkpoint_kwargs", {})
-        # what tokenizer to use 
-        parser_tokenizer_name = kwargs.get("parser_tokenizer", "xlnet-base-cased")
+        """ 
+        Args:
+            load_workers (int): number of threads that load the independent components (sentence 
+                splitter, checkpoint, concept map, parser, tokenizer) concurrently
+            warmup (bool): process a sentence once loaded, so that the first request is not slower
+            quantize (bool): dynamic int8 quantization of the model for CPU inference (see 
+                SEXLNet.quantize), quantized_filename loads a model saved quantized instead of 
+                checkpoint_filename (see bin/export_model.py --quantize)
+            use_graph (bool): score with the graph of graph_filename (TorchScript or ONNX, see 
+                bin/export_model.py --graph_format) instead of the checkpoint, requires explain=full
+        The duration of each step is in load_times.
+        """
         if checkpoint_filename is None:
             raise RuntimeError(f"checkpoint_filename=None, but it should be specified!")
-        print(f"- loading checkpoint from {checkpoint_filename}")
-        self.model = SEXLNet.load_from_checkpoint(checkpoint_filename, **checkpoint_kwargs)
-        self.model.eval()
         if concept_map_filename is None:
             raise RuntimeError(f"concept_map_filename=None, but it should be specified!")
-        print(f"- loading concept map from {concept_map_filename}")
-        self.concept_map = load_concept_map(concept_map_filename)
-        print(f"- parser tokenizer: {parser_tokenizer_name}")
-        self.parsed_data = ParsedDataset(tokenizer_name=parser_tokenizer_name)
-        self.save_dir = os.path.join("output", datetime.datetime.now().strftime("%Y_%m_%d__%H%M%S"))
-        print(f"- save_dir: {self.save_dir}")
-        self.count = 0
+        # get override parameters for load_from_checkpoint (concept_store, hparams, etc)
+        checkpoint_kwargs = dict(kwargs.get("checkpoint_kwargs", {}))
+        # concept store loading options (see SEXLNet), e.g. concept_store_dtype="float16"
+        for key in ["concept_store_dtype", "mmap_concept_store"]:
+            if key in kwargs:
+                checkpoint_kwargs[key] = kwargs[key]
+        # what tokenizer to use 
+        parser_tokenizer_name = kwargs.get("parser_tokenizer", "xlnet-base-cased")
+        # the model tokenizer is saved with the config of the encoder in exported models
+        base_model = checkpoint_kwargs.get("base_model", None)
+
+        self.load_times = {}
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=kwargs.get("load_workers", 1)) as executor:
+            # only sentence splitting is needed
+            nlp = executor.submit(timed, self.load_times, "sentence splitter", load_sentence_nlp)
+            quantized_filename = kwargs.get("quantized_filename", None) if kwargs.get("quantize", False) else None
+            graph_filename = kwargs.get("graph_filename", None) if kwargs.get("use_graph", False) else None
+            print(f"- loading checkpoint from {graph_filename or quantized_filename or checkpoint_filename}")
+            model = executor.submit(timed, self.load_times, "checkpoint", self.load_model, checkpoint_filename, 
+                                    checkpoint_kwargs, kwargs.get("concept_index", None), 
+                                    kwargs.get("concept_index_kwargs", {}), quantize=kwargs.get("quantize", False),
+                                    quantized_filename=quantized_filename, graph_filename=graph_filename)
+            print(f"- loading concept map from {concept_map_filename}")
+            concept_map = executor.submit(timed, self.load_times, "concept map", load_concept_map, concept_map_filename)
+            print(f"- parser tokenizer: {parser_tokenizer_name}")
+            # parse_cache is an optional SQLite file with parses (shared with store_parse_trees)
+            parsed_data = executor.submit(timed, self.load_times, "parser", ParsedDataset, 
+                                          tokenizer_name=parser_tokenizer_name, 
+                                          batch_size=kwargs.get("parser_batch_size", 64),
+                                          parse_cache=kwargs.get("parse_cache", None),
+                                          compact=True)
+            tokenizer = None
+            if base_model is not None:
+                print(f"- model tokenizer: {base_model}")
+                tokenizer = executor.submit(timed, self.load_times, "tokenizer", AutoTokenizer.from_pretrained, 
+                                            base_model, do_lower_case=True)
+            self.nlp = nlp.result()
+            self.model = model.result()
+            self.concept_map = concept_map.result()
+            self.parsed_data = parsed_data.result()
+            # tokenizer and collator are shared by all calls to process
+            model_name = self.model.hparams.model_name
+            if tokenizer is None:
+                print(f"- model tokenizer: {model_name}")
+                self.tokenizer = timed(self.load_times, "tokenizer", AutoTokenizer.from_pretrained, model_name, 
+                                       do_lower_case=True)
+            else:
+                self.tokenizer = tokenizer.result()
+        # phrases as index tensors (sparse LIL) if the model was trained with it, unless overridden
+        sparse_lil = kwargs.get("sparse_lil", getattr(self.model.hparams, "sparse_lil", False))
+        self.collator = MyCollator(model_name, sparse_lil=sparse_lil)
+        # maximum number of padded tokens per batch (None for batches of batch_size sentences)
+        self.max_tokens = kwargs.get("max_tokens", None)
+        # number of concepts (GIL) and phrases (LIL) in the interpretations
+        self.gil_k = kwargs.get("gil_k", 10)
+        self.lil_k = kwargs.get("lil_k", 5)
+        # default interpretation layers (see SEXLNet.forward), without LIL sentences are not parsed
+        self.explain = self.check_explain(kwargs.get("explain", "full"))
+        if graph_filename is not None and self.explain != "full":
+            raise ValueError(f"the exported graph {graph_filename} only supports explain=full")
+        self.load_times["total"] = time.time() - start
+        if kwargs.get("warmup", False):
+            timed(self.load_times, "warmup", self.warmup)
+        print(f"- load times: " + ", ".join(f"{key} {value:.1f}s" for key, value in self.load_times.items()))
+
+
+    @classmethod
+    def from_bundle(cls, conf_filename, load_workers=4, warmup=True, **kwargs):
+        """ Load a model exported by bin/export_model.py from its conf (model.json), the components 
+        are loaded by load_workers threads and a warm-up sentence is processed. kwargs override 
+        the conf.
+        """
+        conf = load_json(conf_filename, keys=BUNDLE_PATH_KEYS)
+        conf.update(kwargs)
+        return cls(load_workers=load_workers, warmup=warmup, **conf)
+
+
+    @staticmethod
+    def load_model(checkpoint_filename, checkpoint_kwargs, concept_index_filename=None, concept_index_kwargs={}, 
+                   quantize=False, quantized_filename=None, graph_filename=None):
+        if graph_filename is not None:
+            # the graph includes the exact GIL search and is not quantized here
+            if concept_index_filename is not None or quantize:
+                logging.warning(f"concept_index and quantize are not used with the graph {graph_filename}")
+            return SelfExplainRuntime(graph_filename)
+        if quantized_filename is not None:
+            model = SEXLNet.load_quantized(quantized_filename, **checkpoint_kwargs)
+        else:
+            model = SEXLNet.load_from_checkpoint(checkpoint_filename, **checkpoint_kwargs)
+            if quantize:
+                model.quantize()
+        model.eval()
+        # optional concept index (built by bin/build_concept_store.py --index) for the GIL search,
+        # concept_index_kwargs override its search parameters (e.g. nprobe)
+        if concept_index_filename is not None:
+            print(f"- loading concept index from {concept_index_filename}")
+            concept_index = load_concept_index(concept_index_filename, concepts=model.concept_store,
+                                               **concept_index_kwargs)
+            model.set_concept_index(concept_index)
+        return model
+
+
+    def warmup(self, text="This is a warm-up sentence."):
+        """ Process text once (sentence splitter, parser and model run once before the first request)
+        """
+        self.process_many([text], batch_size=1)
+
+
+    @staticmethod
+    def check_explain(explain):
+        explain = "full" if explain is True else explain
+        if explain not in EXPLAIN_MODES:
+            raise ValueError(f"explain={explain} should be one of {EXPLAIN_MODES}")
+        return explain
 
 
     def to_sentences(self, text) -> List[str]:
@@ -49,68 +178,110 @@ class SelfExplainCharacterizer(object):
         return sentences
 
 
-    def compute_parse_tree(self, data: list) -> str:
-        """ Store in tsv format and parse into trees.
+    def compute_parse_tree(self, sentences: List[str], label=0) -> List[dict]:
+        """ Parse sentences into trees (in memory).
         Return:
-            str: JSON filename where the parse tree is stored
+            list: samples in the same format as the lines of *_with_parse.json 
+                (None for sentences that could not be parsed)
         """
-        data_dir = os.path.join(self.save_dir, f"{self.count:06d}")
-        self.count += 1
-        if not os.path.exists(data_dir):
-            logging.info(f"creating working dir: {data_dir}")
-            os.makedirs(data_dir)
-        input_filename = os.path.join(data_dir, "dev.tsv")
-        output_filename = os.path.join(data_dir, "dev_with_parse.json")
-        # write tsv
-        logging.info(f"  writing text to {input_filename}")
-        with open(input_filename, "w") as handle:
-            writer = csv.DictWriter(handle, ["sentence", "label"], delimiter="\t")
-            writer.writeheader()
-            writer.writerows(data)
-        logging.info(f"  writing parsed tree to {output_filename}")
-        self.parsed_data.read_and_store_from_tsv(input_file_name=input_filename, output_file_name=output_filename)
-        return output_filename
-
-
-    def process(self, text: str, batch_size=32, label=0):
+        samples = self.parsed_data.parse_sentences(sentences, label=label)
+        logging.debug(f"parsed {sum(s is not None for s in samples)}/{len(sentences)} sentences")
+        return samples
+
+
+    @staticmethod
+    def unparsed_samples(sentences: List[str], label=0) -> List[dict]:
+        """ Samples without phrases, for models that run without LIL
+        """
+        return [dict(sentence=sentence, parse_tree=[], label=label, num_tokens=0) for sentence in sentences]
+
+
+    def process(self, text: str, batch_size=32, label=0, explain=None):
         """ Process text to get probability and evidence
 
         Args: 
             text (str): text to process 
+            explain: interpretations to compute (see SEXLNet.forward), default: the explain option
         """
-        data = [dict(sentence=sentence, label=label) for sentence in self.to_sentences(text)]
-        # get location of parse_tree_filename
-        parse_tree_filename = self.compute_parse_tree(data)
-        batch_size = min(batch_size, len(data))
-        result = self.evaluate(parse_tree_filename, batch_size=batch_size)
-        prob = max(result["scores"])
-        evidence = dict()
+        prob, evidence = self.process_many([text], batch_size=batch_size, label=label, explain=explain)[0]
+        if prob is None:
+            raise RuntimeError(f"failed to parse any sentence in '{text}'")
         return prob, evidence
 
 
-    def evaluate(self, parse_tree_filename, batch_size=1):
-        # load dev samples from file 
-        samples = load_dev_examples(parse_tree_filename)
-        logging.debug(f"loaded {len(samples)} from {parse_tree_filename}")
-        # split it into batches to match dataloader
-        dev_samples_batches = [samples[start:start+batch_size] for start in range(0, len(samples), batch_size)]
-        # get dataloader 
-        basedir = os.path.dirname(parse_tree_filename)
-        dm = ClassificationData(basedir=basedir, tokenizer_name=self.model.hparams.model_name, batch_size=batch_size, num_workers=0)
-        dataloader = dm.val_dataloader()
+    def process_many(self, texts: List[str], batch_size=32, label=0, explain=None) -> List[Tuple[float, dict]]:
+        """ Process many documents at once. Sentences from all documents are packed into 
+        length-sorted batches and the results are scattered back to the documents. 
+
+        Args: 
+            texts (list): documents to process
+            batch_size (int): number of sentences per batch
+            explain: interpretations to compute (see SEXLNet.forward), sentences are only parsed 
+                for LIL (lil or full)
+        Return:
+            list: (prob, evidence) for each document, prob is the maximum score over its sentences 
+                (None if no sentence could be parsed), evidence["explain"] is the explain mode (none 
+                for False) as scores of different modes should not be compared
+        """
+        sentences, doc_indices = [], []
+        for doc_idx, doc in enumerate(self.nlp.pipe(texts)):
+            for sentence in doc.sents:
+                sentences.append(sentence.text)
+                doc_indices.append(doc_idx)
+        explain = self.explain if explain is None else self.check_explain(explain)
+        if explain in ("lil", "full"):
+            samples = self.compute_parse_tree(sentences, label=label)
+        else:
+            samples = self.unparsed_samples(sentences, label=label)
+        # drop sentences that could not be parsed
+        parsed = [i for i, sample in enumerate(samples) if sample is not None]
+        result = self.evaluate([samples[i] for i in parsed], batch_size=batch_size, explain=explain) if len(parsed) else None
+        # scores computed without LIL differ slightly from full, the mode is returned with them
+        evidence = [dict(sentences=[], scores=[], gil_interpretations=[], lil_interpretations=[], explain=explain or "none")
+                    for _ in texts]
+        for j, i in enumerate(parsed):
+            doc_evidence = evidence[doc_indices[i]]
+            doc_evidence["sentences"].append(sentences[i])
+            for key in ["scores", "gil_interpretations", "lil_interpretations"]:
+                doc_evidence[key].append(result[key][j])
+        return [(max(e["scores"]) if len(e["scores"]) else None, e) for e in evidence]
+
+
+    def evaluate(self, samples: List[dict], batch_size=1, sort=True, explain=None):
+        """ Run the model on parsed samples (see compute_parse_tree, or unparsed_samples without 
+        LIL). If sort is set, samples are batched by token length to reduce padding. Results are 
+        in the order of samples, the interpretations that are not computed are None.
+        """
+        explain = self.explain if explain is None else self.check_explain(explain)
+        dataset = ClassificationDataset(tokenizer=self.tokenizer, samples=samples)
+        token_lengths = dataset.token_lengths()
+        order = list(range(len(dataset)))
+        if sort:
+            order = np.argsort(token_lengths, kind="stable").tolist()
+        batches = token_budget_batches(order, token_lengths, batch_size=batch_size, max_tokens=self.max_tokens)
+        logging.debug(f"{len(batches)} batches, padding efficiency {padding_efficiency(batches, token_lengths)}")
         # initialize result 
-        result = dict(samples=samples, predicted_labels=[], true_labels=[], scores=[], gil_interpretations=[], lil_interpretations=[])
+        keys = ["predicted_labels", "true_labels", "scores", "gil_interpretations", "lil_interpretations"]
+        result = {key: [None] * len(dataset) for key in keys}
+        result["samples"] = samples
         with torch.no_grad():
-            for batch, dev_samples in zip(dataloader, dev_samples_batches):
+            for indices in batches:
+                batch = self.collator([dataset[i] for i in indices])
+                dev_samples = [samples[i] for i in indices]
                 input_tokens, token_type_ids, nt_idx_matrix, labels = batch
-                logits, acc, interpret_dict_list = self.model(batch)
-                gil_interpretations = gil_interpret(concept_map=self.concept_map,
-                                                    list_of_interpret_dict=interpret_dict_list)
-                # note that dev_samples match the logits so current_idx is set to 0
-                lil_interpretations = lil_interpret(logits=logits,
-                                                    list_of_interpret_dict=interpret_dict_list,
-                                                    dev_samples=dev_samples,
-                                                    current_idx=0)
+                logits, acc, interpret_dict_list = self.model(batch, explain=explain)
+                gil_interpretations = lil_interpretations = [None] * len(indices)
+                if "topk_indices" in interpret_dict_list:
+                    gil_interpretations = gil_interpret(concept_map=self.concept_map,
+                                                        list_of_interpret_dict=interpret_dict_list,
+                                                        k=self.gil_k)
+                if "lil_logits" in interpret_dict_list:
+                    # note that dev_samples match the logits so current_idx is set to 0
+                    lil_interpretations = lil_interpret(logits=logits,
+                                                        list_of_interpret_dict=interpret_dict_list,
+                                                        dev_samples=dev_samples,
+                                                        current_idx=0,
+                                                        k=self.lil_k)
                 # note that acc, true_labels is meaningless as the labels are meaningless
                 #accs.append(acc)
                 # XXX TODO this should return a value between 0 and 1 so that we can apply a threshold
@@ -119,11 +290,12 @@ class SelfExplainCharacterizer(object):
                 # get the score for label 1
                 scores = [ps[1] for ps, pl in zip(pred_scores, pred_labels)]
                 logging.info(f"scores={scores}, pred_labels={pred_labels}, pred_scores={pred_scores}")
-                result["predicted_labels"].extend(pred_labels)
-                result["true_labels"].extend(labels.tolist())
-                result["scores"].extend(scores)
-                result["gil_interpretations"].extend(gil_interpretations)
-                result["lil_interpretations"].extend(lil_interpretations)
+                batch_result = dict(predicted_labels=pred_labels, true_labels=labels.tolist(), scores=scores, 
+                                    gil_interpretations=gil_interpretations, lil_interpretations=lil_interpretations)
+                # scatter back to the order of samples
+                for key, values in batch_result.items():
+                    for i, value in zip(indices, values):
+                        result[key][i] = value
         return result
 
 
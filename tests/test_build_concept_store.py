@@ -0,0 +1,118 @@
+import json
+import os
+import zlib
+
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+from self_explain.model.concept_store import ConceptStoreWriter, load_concept_store, read_header
+from self_explain.preprocessing import build_concept_store
+
+
+def fake_embed_concepts(concepts, model_name, filename, dtype="float32", **kwargs):
+    """ Rows derived from the phrases (no model needed)
+    """
+    with ConceptStoreWriter(filename, dim=4, dtype=dtype, model_name=model_name) as writer:
+        for concept in concepts:
+            generator = torch.Generator().manual_seed(zlib.crc32(concept.encode("utf-8")))
+            writer.write(torch.randn(1, 4, generator=generator))
+
+
+def write_input(filename, phrases):
+    with open(filename, "w") as handle:
+        for phrase in phrases:
+            parse_tree = [{"phrase": phrase, "phrase_label": "NP"}]
+            handle.write(json.dumps({"sentence": phrase, "parse_tree": parse_tree}) + "\n")
+    return filename
+
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_concept_store, "embed_concepts", fake_embed_concepts)
+    write_input(str(tmp_path / "first.json"), ["the movie", "a plot", "the movie"])
+    write_input(str(tmp_path / "second.json"), ["a plot", "the actors", "great music"])
+    output_folder = str(tmp_path / "concepts")
+    os.makedirs(output_folder)
+    build_concept_store.concept_store("xlnet-base-cased", str(tmp_path / "first.json"), output_folder,
+                                      max_concept_length=5)
+    return output_folder
+
+
+def read_folder(output_folder):
+    files = {}
+    for name in build_concept_store.UPDATED_FILES:
+        with open(os.path.join(output_folder, name)) as handle:
+            files[name] = json.load(handle)
+    for entry in files[build_concept_store.MANIFEST]["inputs"]:
+        entry.pop("time")
+    return load_concept_store(os.path.join(output_folder, "concept_store.bin")), files
+
+
+def update(output_folder):
+    second = os.path.join(os.path.dirname(output_folder), "second.json")
+    build_concept_store.update_concept_store([second], output_folder)
+
+
+def test_update_concept_store(folder):
+    update(folder)
+    concepts, files = read_folder(folder)
+    assert list(files["concept_idx.json"].values()) == ["the movie", "a plot", "the actors", "great music"]
+    assert concepts.size(0) == 4
+    assert files[build_concept_store.FREQUENCIES]["a plot"] == 2
+    assert [entry["num_concepts"] for entry in files[build_concept_store.MANIFEST]["inputs"]] == [2, 2]
+    assert not [name for name in os.listdir(folder) if name.endswith((".pending", ".new", ".tmp"))]
+    # the input is folded in already
+    update(folder)
+    assert read_folder(folder)[0].size(0) == 4
+
+
+def test_interrupted_after_commit(folder, tmp_path, monkeypatch):
+    expected_folder = str(tmp_path / "expected")
+    os.makedirs(expected_folder)
+    for name in os.listdir(folder):
+        with open(os.path.join(folder, name), "rb") as src, open(os.path.join(expected_folder, name), "wb") as dst:
+            dst.write(src.read())
+    update(expected_folder)
+
+    finish_update = build_concept_store.finish_update
+    calls = []
+
+    def crash_after_commit(output_folder, rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+        finish_update(output_folder, rows)
+    monkeypatch.setattr(build_concept_store, "finish_update", crash_after_commit)
+    with pytest.raises(KeyboardInterrupt):
+        update(folder)
+    assert read_header(os.path.join(folder, "concept_store.bin"))["rows"] == 4
+    monkeypatch.setattr(build_concept_store, "finish_update", finish_update)
+    # the next update completes the interrupted one
+    update(folder)
+    concepts, files = read_folder(folder)
+    expected_concepts, expected_files = read_folder(expected_folder)
+    assert torch.equal(concepts, expected_concepts)
+    assert files == expected_files
+
+
+def test_interrupted_before_commit(folder, monkeypatch):
+    write = ConceptStoreWriter.write
+
+    def crash_while_appending(writer, rows):
+        if writer.append:
+            raise KeyboardInterrupt
+        write(writer, rows)
+    monkeypatch.setattr(ConceptStoreWriter, "write", crash_while_appending)
+    with pytest.raises(KeyboardInterrupt):
+        update(folder)
+    assert os.path.exists(os.path.join(folder, build_concept_store.MANIFEST + ".pending"))
+    monkeypatch.setattr(ConceptStoreWriter, "write", write)
+    assert read_header(os.path.join(folder, "concept_store.bin"))["rows"] == 2
+    # the pending files are discarded and the input is folded in again
+    update(folder)
+    concepts, files = read_folder(folder)
+    assert concepts.size(0) == 4
+    assert files[build_concept_store.FREQUENCIES]["a plot"] == 2
+    assert len(files[build_concept_store.MANIFEST]["inputs"]) == 2
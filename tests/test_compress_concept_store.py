@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+import torch
+
+pytest.importorskip("transformers")
+
+from self_explain.model.concept_store import ConceptStoreWriter
+from self_explain.preprocessing.build_concept_store import FREQUENCIES, MERGED
+from self_explain.preprocessing.compress_concept_store import compress_concept_store, dedup_concepts, normalize
+
+
+def concepts_with_duplicates(num_concepts=300, dim=16, num_duplicates=200, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    concepts = torch.randn(num_concepts, dim, generator=generator)
+    sources = torch.randint(num_concepts, (num_duplicates,), generator=generator)
+    duplicates = concepts[sources] + 0.05 * torch.randn(num_duplicates, dim, generator=generator)
+    return torch.cat([concepts, duplicates])[torch.randperm(num_concepts + num_duplicates, generator=generator)]
+
+
+def greedy_dedup(concepts, threshold):
+    """ Reference: every concept is merged into the first earlier kept concept that is similar
+    """
+    normalized = normalize(concepts)
+    similar = (normalized @ normalized.T) >= threshold
+    kept, representative = [], []
+    for i in range(concepts.size(0)):
+        matches = [j for j in kept if similar[i, j]]
+        representative.append(matches[0] if len(matches) else i)
+        if not len(matches):
+            kept.append(i)
+    return torch.tensor(representative), torch.tensor(kept)
+
+
+@pytest.mark.parametrize("block_size", [7, 64, 4096])
+def test_dedup_concepts_matches_greedy(block_size):
+    concepts = concepts_with_duplicates()
+    new_ids, kept = dedup_concepts(concepts, threshold=0.95, num_lists=1, block_size=block_size)
+    representative, expected_kept = greedy_dedup(concepts, threshold=0.95)
+    assert kept.tolist() == expected_kept.tolist()
+    # new ids are the positions of the representatives among the kept concepts
+    assert torch.equal(new_ids, torch.searchsorted(expected_kept, representative))
+    assert kept.numel() < concepts.size(0)
+
+
+def test_compress_concept_store_frequencies(tmp_path):
+    # "the film" and "this film" are near-duplicates of "the movie", "a plot" is distinct
+    movie, plot = torch.randn(2, 16, generator=torch.Generator().manual_seed(0))
+    concepts = torch.stack([movie, plot, movie + 0.01, movie - 0.01])
+    phrases = ["the movie", "a plot", "the film", "this film"]
+    input_folder, output_folder = str(tmp_path / "input"), str(tmp_path / "output")
+    os.makedirs(input_folder)
+    with ConceptStoreWriter(os.path.join(input_folder, "concept_store.bin"), dim=16) as writer:
+        writer.write(concepts)
+    with open(os.path.join(input_folder, "concept_idx.json"), "w") as handle:
+        json.dump({i: phrase for i, phrase in enumerate(phrases)}, handle)
+    with open(os.path.join(input_folder, FREQUENCIES), "w") as handle:
+        json.dump({"the movie": 3, "a plot": 2, "the film": 4, "this film": 1, "a rare phrase": 1}, handle)
+    report = compress_concept_store(input_folder, output_folder, method="dedup", num_lists=1)
+    assert report["output"]["concepts"] == 2
+    with open(os.path.join(output_folder, FREQUENCIES)) as handle:
+        frequencies = json.load(handle)
+    assert frequencies == {"the movie": 8, "a plot": 2, "a rare phrase": 1}
+    with open(os.path.join(output_folder, MERGED)) as handle:
+        assert json.load(handle) == {"the film": 0, "this film": 0}
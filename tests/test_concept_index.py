@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from self_explain.model.concept_index import (build_concept_index, save_concept_index, load_concept_index,
+                                              recall_at_k)
+
+
+def clustered_concepts(num_concepts=2000, dim=16, num_clusters=20, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = 3 * torch.randn(num_clusters, dim, generator=generator)
+    assignment = torch.randint(num_clusters, (num_concepts,), generator=generator)
+    concepts = centers[assignment] + torch.randn(num_concepts, dim, generator=generator)
+    queries = centers[torch.randint(num_clusters, (50,), generator=generator)] + torch.randn(50, dim, generator=generator)
+    return concepts, queries
+
+
+def test_exact_index():
+    concepts, queries = clustered_concepts()
+    values, indices = build_concept_index("exact", concepts).search(queries, k=5, concepts=concepts)
+    expected_values, expected_indices = torch.topk(queries @ concepts.T, k=5)
+    assert torch.equal(indices, expected_indices)
+    assert torch.allclose(values, expected_values)
+
+
+def test_ivf_probing_all_lists_is_exact():
+    concepts, queries = clustered_concepts()
+    index = build_concept_index("ivf", concepts, num_lists=16, nprobe=16)
+    assert index.list_ids.sort().values.tolist() == list(range(concepts.size(0)))
+    assert recall_at_k(index, concepts, queries, k=5)["recall"] == 1.0
+
+
+@pytest.mark.parametrize("index_type, kwargs", [("ivf", dict(num_lists=32, nprobe=8)),
+                                                ("pq", dict(num_subspaces=8, num_codewords=64, rerank=10))])
+def test_approximate_recall(index_type, kwargs):
+    concepts, queries = clustered_concepts()
+    index = build_concept_index(index_type, concepts, **kwargs)
+    _, indices = index.search(queries, k=5, concepts=concepts)
+    assert indices.size() == (queries.size(0), 5)
+    assert recall_at_k(index, concepts, queries, k=5)["recall"] >= 0.9
+
+
+def test_unknown_index_type():
+    with pytest.raises(ValueError):
+        build_concept_index("hnsw", torch.randn(10, 4))
+
+
+@pytest.mark.parametrize("index_type, kwargs", [("ivf", dict(num_lists=32, nprobe=4)),
+                                                ("pq", dict(num_subspaces=4, num_codewords=64))])
+def test_save_and_load(tmp_path, index_type, kwargs):
+    concepts, queries = clustered_concepts()
+    index = build_concept_index(index_type, concepts, **kwargs)
+    filename = str(tmp_path / "concept_index.pt")
+    save_concept_index(index, filename)
+    loaded = load_concept_index(filename, concepts)
+    assert loaded.config() == index.config()
+    for expected, result in zip(index.search(queries, k=5, concepts=concepts),
+                                loaded.search(queries, k=5, concepts=concepts)):
+        assert torch.equal(expected, result)
+    with pytest.raises(ValueError):
+        load_concept_index(filename, concepts[:10])
+
+
+@pytest.mark.parametrize("index_type, kwargs", [("exact", {}), ("ivf", dict(num_lists=32)),
+                                                ("pq", dict(num_subspaces=8, num_codewords=64))])
+def test_index_does_not_hold_the_concepts(index_type, kwargs):
+    # the model passes its concept store to search, model.to would otherwise move it twice
+    concepts, queries = clustered_concepts()
+    index = build_concept_index(index_type, concepts, **kwargs)
+    assert all(buffer.data_ptr() != concepts.data_ptr() for buffer in index.buffers())
+    index.check_concepts(concepts)
+    with pytest.raises(ValueError):
+        index.check_concepts(concepts[:10])
+    if index_type != "pq":
+        with pytest.raises(ValueError):
+            index.search(queries, k=5)
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+import torch
+
+from self_explain.model import concept_store
+from self_explain.model.concept_store import ConceptStoreWriter
+
+
+def random_concepts(rows=100, dim=8, seed=0):
+    return torch.randn(rows, dim, generator=torch.Generator().manual_seed(seed))
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_write_and_load(tmp_path, dtype):
+    filename = str(tmp_path / "concept_store.bin")
+    concepts = random_concepts()
+    with ConceptStoreWriter(filename, dim=8, dtype=dtype, model_name="xlnet-base-cased") as writer:
+        writer.write(concepts[:30])
+        writer.write(concepts[30:].numpy())
+    assert not os.path.exists(f"{filename}.tmp")
+    header = concept_store.verify_concept_store(filename)
+    assert (header["rows"], header["dim"], header["dtype"]) == (100, 8, dtype)
+    loaded = concept_store.load_concept_store(filename)
+    assert loaded.dtype == concept_store.DTYPES[dtype]
+    assert torch.equal(loaded, concepts.to(loaded.dtype))
+    assert concept_store.load_concept_store(filename, dtype="float32").dtype == torch.float32
+
+
+def test_write_rows(tmp_path):
+    filename = str(tmp_path / "concept_store.bin")
+    concepts = random_concepts()
+    with ConceptStoreWriter(filename, dim=8, num_rows=100) as writer:
+        writer.write_rows(range(50, 100), concepts[50:])
+        writer.write_rows(range(50), concepts[:50])
+    concept_store.verify_concept_store(filename)
+    assert torch.equal(concept_store.load_concept_store(filename), concepts)
+
+
+def test_append(tmp_path):
+    filename = str(tmp_path / "concept_store.bin")
+    concepts = random_concepts()
+    with ConceptStoreWriter(filename, dim=8, model_name="roberta-base") as writer:
+        writer.write(concepts[:60])
+    with ConceptStoreWriter(filename, dim=8, append=True) as writer:
+        writer.write(concepts[60:])
+    header = concept_store.verify_concept_store(filename)
+    assert header["rows"] == 100 and header["model_name"] == "roberta-base"
+    assert torch.equal(concept_store.load_concept_store(filename), concepts)
+    with pytest.raises(ValueError):
+        ConceptStoreWriter(filename, dim=16, append=True)
+
+
+def test_abort_keeps_no_file(tmp_path):
+    filename = str(tmp_path / "concept_store.bin")
+    with pytest.raises(RuntimeError):
+        with ConceptStoreWriter(filename, dim=8) as writer:
+            writer.write(random_concepts())
+            raise RuntimeError("interrupted")
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_checksum_mismatch(tmp_path):
+    filename = str(tmp_path / "concept_store.bin")
+    with ConceptStoreWriter(filename, dim=8) as writer:
+        writer.write(random_concepts())
+    with open(filename, "r+b") as handle:
+        handle.seek(concept_store.HEADER_SIZE + 5)
+        handle.write(b"\xff")
+    with pytest.raises(ValueError):
+        concept_store.verify_concept_store(filename)
+
+
+def test_convert_concept_store(tmp_path):
+    concepts = random_concepts()
+    src, dst = str(tmp_path / "concept_store.pt"), str(tmp_path / "concept_store.bin")
+    torch.save(concepts, src)
+    assert not concept_store.is_raw_concept_store(src)
+    header = concept_store.convert_concept_store(src, dst, dtype="float16", chunk_size=32)
+    assert header["rows"] == 100
+    assert concept_store.is_raw_concept_store(dst)
+    assert torch.equal(concept_store.load_concept_store(dst), concepts.half())
+
+
+def test_inner_products():
+    queries, concepts = random_concepts(rows=4, seed=1), random_concepts()
+    expected = queries @ concepts.T
+    assert torch.allclose(concept_store.inner_products(queries, concepts), expected)
+    half = concept_store.inner_products(queries, concepts.half(), chunk_size=7)
+    assert half.dtype == torch.float32
+    assert torch.allclose(half, queries @ concepts.half().float().T, atol=1e-5)
@@ -0,0 +1,18 @@
+import numpy as np
+import torch
+
+from self_explain.model.data_utils import PhraseIndices
+
+
+def test_phrase_indices_round_trip():
+    rng = np.random.RandomState(0)
+    nt_idx_matrix = (rng.rand(12, 20) < 0.3).astype(np.int64)
+    nt_idx_matrix[3] = 0
+    phrases = PhraseIndices.from_matrix(nt_idx_matrix)
+    assert phrases.num_phrases() == 12
+    assert phrases.num_tokens == 20
+    assert torch.equal(phrases.to_matrix(), torch.from_numpy(nt_idx_matrix))
+    for p in range(phrases.num_phrases()):
+        tokens = phrases.indices[phrases.offsets[p]:phrases.offsets[p + 1]]
+        assert tokens.tolist() == np.nonzero(nt_idx_matrix[p])[0].tolist()
+    assert phrases.rows().tolist() == np.nonzero(nt_idx_matrix)[0].tolist()
@@ -0,0 +1,67 @@
+""" Memory growth of forked DataLoader workers reading a ClassificationDataset: the dataset is held
+in flat arrays, so the workers should not copy its pages (copy-on-write after refcount updates).
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+if not os.path.exists("/proc/self/smaps_rollup"):
+    pytest.skip("requires /proc/<pid>/smaps_rollup (Linux)", allow_module_level=True)
+
+from torch.utils.data import DataLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bin"))
+
+from benchmark import read_memory, child_pids
+from self_explain.model import dataset_cache
+from self_explain.model.data import ClassificationDataset, MyCollator, ARRAY_ATTRIBUTES
+
+
+class WordTokenizer(object):
+    """ One token id per word (the test does not need a real tokenizer)
+    """
+    name_or_path = "words"
+
+    def __call__(self, sentences):
+        return {"input_ids": [[len(word) for word in sentence.split()] for sentence in sentences]}
+
+
+def random_samples(num_samples=20000, num_tokens=60, num_phrases=40, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = []
+    for _ in range(num_samples):
+        parse_tree = []
+        for _ in range(num_phrases):
+            start = int(rng.randint(num_tokens))
+            end = min(num_tokens, start + int(rng.randint(1, 10)))
+            parse_tree.append({"phrase": "", "indices": list(range(start, end))})
+        sentence = " ".join("w" * int(length) for length in rng.randint(1, 10, size=num_tokens))
+        samples.append({"sentence": sentence, "label": int(rng.randint(2)), "parse_tree": parse_tree,
+                        "num_tokens": num_tokens})
+    return samples
+
+
+def test_worker_memory_growth():
+    dataset = ClassificationDataset(WordTokenizer(), samples=random_samples())
+    dataset_kb = sum(getattr(dataset, ARRAY_ATTRIBUTES.get(key, key)).nbytes for key in dataset_cache.ARRAYS) / 1024
+    dataloader = DataLoader(dataset, batch_size=32, shuffle=True, num_workers=2, multiprocessing_context="fork",
+                            collate_fn=MyCollator("xlnet-base-cased"))
+    first, last = {}, {}
+    for i, _ in enumerate(dataloader):
+        # the first batches include the start-up allocations of the workers
+        if i >= 50 and i % 50 == 0:
+            for pid in child_pids():
+                memory = read_memory(pid)
+                first.setdefault(pid, memory)
+                last[pid] = memory
+    assert len(first) >= 2
+    for pid in first:
+        growth = {key: last[pid][key] - first[pid][key] for key in first[pid]}
+        # a worker that copied the dataset would grow by about dataset_kb
+        assert growth["Private_Dirty"] < 0.2 * dataset_kb, (growth, dataset_kb)
+        assert growth["Pss"] < 0.2 * dataset_kb, (growth, dataset_kb)
@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+
+from self_explain.model import dataset_cache
+
+
+class WordTokenizer(object):
+    name_or_path = "words"
+
+    def __call__(self, sentences):
+        return {"input_ids": [[len(word) for word in sentence.split()] for sentence in sentences]}
+
+
+SAMPLES = [
+    {"sentence": "a bb ccc", "label": 1, "num_tokens": 3,
+     "parse_tree": [{"phrase": "a bb ccc", "indices": [0, 1, 2]}, {"phrase": "bb", "indices": [1]}]},
+    {"sentence": "dddd", "label": 0, "num_tokens": 1, "parse_tree": [{"phrase": "dddd", "indices": [0]}]},
+    # dense format (before compact parse files)
+    {"sentence": "ee f", "label": 1, "nt_idx_matrix": [[1, 1], [0, 1]],
+     "parse_tree": [{"phrase": "ee f", "indices": [0, 1], "onehot": [1, 1]}, {"phrase": "f", "indices": [1], "onehot": [0, 1]}]},
+]
+
+
+def write_samples(folder):
+    data_path = os.path.join(folder, "dev_with_parse.json")
+    with open(data_path, "w") as handle:
+        for sample in SAMPLES:
+            handle.write(json.dumps(sample) + "\n")
+    return data_path
+
+
+def test_compile_samples():
+    arrays = dataset_cache.compile_samples(SAMPLES, WordTokenizer())
+    assert set(arrays) == set(dataset_cache.ARRAYS)
+    assert arrays["token_offsets"].tolist() == [0, 3, 4, 6]
+    assert arrays["input_ids"].tolist() == [1, 2, 3, 4, 2, 1]
+    assert arrays["labels"].tolist() == [1, 0, 1]
+    assert arrays["num_tokens"].tolist() == [3, 1, 2]
+    assert arrays["phrase_offsets"].tolist() == [0, 2, 3, 5]
+    offsets, indices = arrays["phrase_index_offsets"], arrays["phrase_indices"]
+    phrases = [indices[offsets[p]:offsets[p + 1]].tolist() for p in range(len(offsets) - 1)]
+    assert phrases == [[0, 1, 2], [1], [0], [0, 1], [1]]
+
+
+def test_load_or_compile(tmp_path):
+    data_path = write_samples(str(tmp_path))
+    arrays, folder = dataset_cache.load_or_compile(data_path, WordTokenizer())
+    assert folder is not None and os.path.exists(os.path.join(folder, "meta.json"))
+    assert isinstance(arrays["input_ids"], np.memmap)
+    expected = dataset_cache.compile_samples(SAMPLES, WordTokenizer())
+    for key in dataset_cache.ARRAYS:
+        assert np.array_equal(arrays[key], expected[key])
+    # the cache is reused, and rebuilt when the file changes
+    assert dataset_cache.load_or_compile(data_path, WordTokenizer())[1] == folder
+    with open(data_path, "a") as handle:
+        handle.write(json.dumps(SAMPLES[0]) + "\n")
+    arrays, new_folder = dataset_cache.load_or_compile(data_path, WordTokenizer())
+    assert new_folder != folder and arrays["labels"].size == len(SAMPLES) + 1
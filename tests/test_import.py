@@ -0,0 +1,44 @@
+""" Importing the package should stay cheap and free of side effects (see self_explain/__init__.py)
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bin"))
+
+from benchmark import import_times, HEAVY_MODULES
+
+
+def run_python(statement):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    return subprocess.run([sys.executable, "-c", statement], cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_import_does_not_load_heavy_modules(monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    monkeypatch.chdir(ROOT)
+    modules = {module.split(".")[0] for module, _, _ in import_times("import self_explain")}
+    assert "self_explain" in modules
+    assert not modules & set(HEAVY_MODULES)
+
+
+def test_import_has_no_side_effects():
+    # benepar.download and setrlimit are replaced before the import (with a low file limit), they
+    # should not be called
+    statement = "\n".join([
+        "import sys, types, resource",
+        "calls = []",
+        "resource.getrlimit = lambda *args: (256, resource.RLIM_INFINITY)",
+        "resource.setrlimit = lambda *args: calls.append('setrlimit')",
+        "benepar = types.ModuleType('benepar')",
+        "benepar.download = lambda *args, **kwargs: calls.append('benepar.download')",
+        "sys.modules['benepar'] = benepar",
+        "import self_explain",
+        "self_explain.__version__",
+        "dir(self_explain)",
+        "assert not calls, calls",
+    ])
+    result = run_python(statement)
+    assert result.returncode == 0, result.stderr
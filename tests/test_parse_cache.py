@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("nltk")
+
+from nltk.tree import Tree
+
+from self_explain.preprocessing.parse_cache import ParseCache, tree_to_string, tree_from_string
+
+
+def test_tree_round_trip():
+    tree = Tree.fromstring("(S (NP (DT the) (NN movie)) (VP (VBD was) (ADJP (JJ great))))")
+    assert tree_from_string(tree_to_string(tree)) == tree
+    # tokens with brackets
+    tree = Tree("S", [Tree("-LRB-", ["("]), Tree("NN", [")"])])
+    assert tree_from_string(tree_to_string(tree)) == tree
+
+
+def test_parse_cache_persists(tmp_path):
+    filename = str(tmp_path / "cache" / "parse_cache.sqlite")
+    cache = ParseCache(filename, "xlnet-base-cased")
+    assert "the movie" not in cache
+    cache["the movie"] = "tree 1"
+    cache.update({"a b": "tree 2", "c": "tree 3"})
+    assert cache["the movie"] == "tree 1"
+    assert cache.stats()["memory_hits"] == 1
+    # another process (or run) reads the file
+    cache = ParseCache(filename, "xlnet-base-cased")
+    assert cache["a b"] == "tree 2"
+    assert cache.stats() == dict(hits=1, memory_hits=0, misses=0, hit_rate=1.0)
+    # the key includes the tokenizer
+    assert ParseCache(filename, "roberta-base").get("a b") is None
+    with pytest.raises(KeyError):
+        cache["d"]
+
+
+def test_parse_cache_memory_limit():
+    cache = ParseCache(None, "xlnet-base-cased", max_memory_items=2)
+    cache.update({"a": "1", "b": "2"})
+    cache.get("a")
+    cache["c"] = "3"
+    # least recently used first
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
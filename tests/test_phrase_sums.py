@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("pytorch_lightning")
+pytest.importorskip("transformers")
+
+from self_explain.model.data import MyCollator
+from self_explain.model.data_utils import PhraseIndices
+from self_explain.model.SE_XLNet import SEXLNet
+
+
+def random_batch(batch_size=8, seed=0):
+    """ Samples (tokens, tokens_mask, phrases, label) with different numbers of tokens and phrases
+    """
+    rng = np.random.RandomState(seed)
+    batch = []
+    for _ in range(batch_size):
+        num_tokens = int(rng.randint(1, 30))
+        num_phrases = int(rng.randint(1, 20))
+        nt_idx_matrix = (rng.rand(num_phrases, num_tokens) < 0.3).astype(np.int64)
+        tokens = rng.randint(100, size=num_tokens + 2).tolist()
+        batch.append((tokens, None, PhraseIndices.from_matrix(nt_idx_matrix), int(rng.randint(2))))
+    return batch
+
+
+@pytest.mark.parametrize("model_name", ["xlnet-base-cased", "roberta-base"])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_phrase_sums_matches_bmm(model_name, seed):
+    batch = random_batch(seed=seed)
+    tokens, _, dense, _ = MyCollator(model_name)(batch)
+    _, _, sparse, _ = MyCollator(model_name, sparse_lil=True)(batch)
+    hidden_state = torch.randn(*tokens.size(), 16, generator=torch.Generator().manual_seed(seed))
+    expected = torch.bmm(dense, hidden_state)
+    phrase_hidden = SEXLNet.phrase_sums(hidden_state, **sparse)
+    assert phrase_hidden.size() == expected.size()
+    assert torch.allclose(phrase_hidden, expected, atol=1e-5)
+    # padding phrases are zero
+    assert not phrase_hidden[~sparse["phrase_mask"]].any()
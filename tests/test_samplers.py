@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import torch.distributed as dist
+
+from self_explain.model.samplers import BucketBatchSampler, token_budget_batches, padding_efficiency
+
+
+def random_lengths(n=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(5, 60, size=n), rng.randint(1, 20, size=n)
+
+
+def test_token_budget_batches():
+    token_lengths = [3, 5, 2, 8, 8, 1]
+    batches = token_budget_batches(range(6), token_lengths, batch_size=3, max_tokens=16)
+    assert sum(batches, []) == list(range(6))
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) == 1 or len(batch) * max(token_lengths[i] for i in batch) <= 16
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_bucket_batch_sampler_covers_dataset(shuffle):
+    token_lengths, phrase_counts = random_lengths()
+    sampler = BucketBatchSampler(token_lengths, phrase_counts, batch_size=16, max_tokens=512, shuffle=shuffle)
+    batches = list(sampler)
+    assert sorted(sum(batches, [])) == list(range(len(token_lengths)))
+    if not shuffle:
+        assert sum(batches, []) == list(range(len(token_lengths)))
+
+
+def test_bucketing_reduces_padding():
+    token_lengths, phrase_counts = random_lengths()
+    bucketed = BucketBatchSampler(token_lengths, phrase_counts, batch_size=16, shuffle=True)
+    shuffled = [list(batch) for batch in np.array_split(np.random.RandomState(0).permutation(len(token_lengths)), 63)]
+    assert bucketed.padding_efficiency()["tokens"] > padding_efficiency(shuffled, token_lengths)["tokens"]
+
+
+def test_bucket_batch_sampler_epochs_differ():
+    token_lengths, phrase_counts = random_lengths()
+    sampler = BucketBatchSampler(token_lengths, phrase_counts, batch_size=16, shuffle=True)
+    assert list(sampler) != list(sampler)
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_bucket_batch_sampler_distributed(monkeypatch, shuffle):
+    token_lengths, phrase_counts = random_lengths(n=1003)
+    num_replicas = 4
+    monkeypatch.setattr(dist, "is_available", lambda: True)
+    monkeypatch.setattr(dist, "is_initialized", lambda: True)
+    monkeypatch.setattr(dist, "get_world_size", lambda: num_replicas)
+    batches = {}
+    for rank in range(num_replicas):
+        monkeypatch.setattr(dist, "get_rank", lambda: rank)
+        sampler = BucketBatchSampler(token_lengths, phrase_counts, batch_size=16, shuffle=shuffle)
+        batches[rank] = list(sampler)
+    # the same number of batches in every process (metrics are synchronized at every step)
+    assert len({len(rank_batches) for rank_batches in batches.values()}) == 1
+    indices = sum(sum(batches.values(), []), [])
+    if shuffle:
+        assert len(indices) == len(set(indices))
+    else:
+        # evaluation: every example is evaluated, the first batches are repeated to pad the last step
+        assert set(indices) == set(range(len(token_lengths)))
+        num_batches = len(BucketBatchSampler(token_lengths, phrase_counts, batch_size=16, shuffle=False).make_batches(0))
+        assert num_batches % num_replicas != 0
+        assert len(batches[0]) == -(-num_batches // num_replicas)